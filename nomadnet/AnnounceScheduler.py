@@ -0,0 +1,167 @@
+import RNS
+import time
+import random
+import threading
+import collections
+
+# All announces sent by the program, for the peer, the node
+# and the propagation node, are placed on one timeline. The
+# scheduler spreads them out with random jitter, keeps a
+# minimum spacing between them, and holds them back for a
+# while when the interfaces are congested. This avoids a
+# burst of announces when many nodes start at the same time,
+# for example after a power outage at a site.
+#
+# Each pending announce is a job on the shared job scheduler
+# of the program, named "announce.<name>".
+
+class AnnounceScheduler:
+    START_JITTER     = 30
+    INTERVAL_JITTER  = 0.1
+    MIN_SPACING      = 5
+    BACKOFF          = 15
+    MAX_BACKOFF      = 10*60
+    MAX_DEFERRALS    = 6
+    CONGESTED_LOAD   = 50
+    STATS_MAX_AGE    = 5
+    LOG_SIZE         = 256
+    JOB_PREFIX       = "announce."
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.entries = {}
+        self.log = collections.deque(maxlen=AnnounceScheduler.LOG_SIZE)
+        self.last_sent = 0
+        self.stats = None
+        self.stats_time = 0
+        self.lock = threading.Lock()
+
+    # Registers an announce on the timeline. If an interval in
+    # seconds is given, the announce is repeated. If a delay is
+    # given, the first announce is sent after the delay, plus
+    # up to START_JITTER seconds of random jitter. Announces
+    # without a delay can still be sent with announce_now.
+    def register(self, name, callback, interval=None, delay=None):
+        with self.lock:
+            self.entries[name] = {"callback": callback, "interval": interval, "planned": None, "deferrals": 0}
+
+        if delay != None:
+            self.plan(name, delay+random.uniform(0, AnnounceScheduler.START_JITTER))
+        else:
+            self.scheduler.cancel(AnnounceScheduler.JOB_PREFIX+name)
+
+    def set_interval(self, name, interval):
+        with self.lock:
+            if not name in self.entries:
+                return
+            self.entries[name]["interval"] = interval
+
+        if interval != None:
+            self.plan(name, self.jittered(interval))
+        else:
+            self.scheduler.cancel(AnnounceScheduler.JOB_PREFIX+name)
+
+    def jittered(self, interval):
+        return interval*random.uniform(1-AnnounceScheduler.INTERVAL_JITTER, 1+AnnounceScheduler.INTERVAL_JITTER)
+
+    def plan(self, name, delay):
+        with self.lock:
+            self.entries[name]["planned"] = time.time()+delay
+            self.entries[name]["deferrals"] = 0
+
+        self.scheduler.schedule(AnnounceScheduler.JOB_PREFIX+name, lambda: self.run(name), delay=delay)
+
+    # Sends an announce right away, bypassing spacing and
+    # congestion checks, and moves the next periodic announce
+    # a full interval ahead.
+    def announce_now(self, name):
+        with self.lock:
+            if not name in self.entries:
+                return False
+            entry = self.entries[name]
+
+        self.send(name, entry, "manual")
+        return True
+
+    def send(self, name, entry, reason):
+        try:
+            entry["callback"]()
+        except Exception as e:
+            RNS.log("Error while sending "+str(name)+" announce: "+str(e), RNS.LOG_ERROR)
+
+        now = time.time()
+        with self.lock:
+            deferrals = entry["deferrals"]
+            self.log.append({
+                "name": name, "time": now, "planned": entry["planned"], "deferrals": deferrals, "reason": reason,
+            })
+            self.last_sent = now
+
+        if entry["interval"] != None:
+            self.plan(name, self.jittered(entry["interval"]))
+        else:
+            with self.lock:
+                entry["planned"] = None
+                entry["deferrals"] = 0
+            self.scheduler.cancel(AnnounceScheduler.JOB_PREFIX+name)
+
+        RNS.log("Sent "+str(name)+" announce ("+reason+", "+str(deferrals)+" deferrals)", RNS.LOG_DEBUG)
+
+    # Runs on the scheduler thread when an announce is due. A
+    # returned number of seconds holds the announce back.
+    def run(self, name):
+        with self.lock:
+            entry = self.entries[name]
+            spacing = self.last_sent+AnnounceScheduler.MIN_SPACING-time.time()
+
+        if spacing > 0:
+            return spacing
+
+        reason = "scheduled"
+        congestion = self.congestion()
+        if congestion != None:
+            if entry["deferrals"] < AnnounceScheduler.MAX_DEFERRALS:
+                backoff = min(AnnounceScheduler.MAX_BACKOFF, AnnounceScheduler.BACKOFF*2**entry["deferrals"])
+                backoff = backoff*random.uniform(1, 1.5)
+                RNS.log("Deferring "+str(name)+" announce for "+RNS.prettytime(backoff)+", "+congestion, RNS.LOG_DEBUG)
+                with self.lock:
+                    entry["deferrals"] += 1
+                return backoff
+            else:
+                reason = "forced"
+
+        self.send(name, entry, reason)
+
+    def interface_stats(self):
+        now = time.time()
+        if self.stats == None or now > self.stats_time+AnnounceScheduler.STATS_MAX_AGE:
+            self.stats = RNS.Reticulum.get_instance().get_interface_stats()
+            self.stats_time = now
+
+        return self.stats
+
+    # Returns a description of the first congested interface
+    # found, or None. Interfaces that do not report airtime or
+    # queue statistics are never considered congested.
+    def congestion(self):
+        try:
+            for interface in self.interface_stats()["interfaces"]:
+                if interface.get("announce_queue") != None and interface["announce_queue"] > 0:
+                    return str(interface["name"])+" has "+str(interface["announce_queue"])+" queued announces"
+
+                for key in ["channel_load_short", "airtime_short"]:
+                    if interface.get(key) != None and interface[key] >= AnnounceScheduler.CONGESTED_LOAD:
+                        return str(interface["name"])+" "+key.replace("_", " ")+" is "+str(round(interface[key], 1))+"%"
+
+        except Exception as e:
+            RNS.log("Could not get interface statistics for announce scheduling: "+str(e), RNS.LOG_DEBUG)
+
+        return None
+
+    def timeline(self):
+        prefix = AnnounceScheduler.JOB_PREFIX
+        return [(job["due"], job["name"][len(prefix):]) for job in self.scheduler.pending() if job["name"].startswith(prefix)]
+
+    def history(self):
+        with self.lock:
+            return list(self.log)
@@ -25,12 +25,7 @@ class Conversation:
             # Check if the announced destination is in
             # our list of conversations
             if destination_hash_text in [e[0] for e in Conversation.conversation_list(app)]:
-                if app.directory.find(destination_hash):
-                    if Conversation.created_callback != None:
-                        Conversation.created_callback()
-                else:
-                    if Conversation.created_callback != None:
-                        Conversation.created_callback()
+                app.ui_notifier.notify("conversations")
 
             # This reformats the new v0.5.0 announce data back to the expected format
             # for nomadnets storage and other handling functions.
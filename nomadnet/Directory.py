@@ -1,14 +1,19 @@
 import os
 import RNS
 import LXMF
+import math
 import time
+import bisect
+import struct
 import nomadnet
 import threading
+import collections
 import RNS.vendor.umsgpack as msgpack
 
 from LXMF import pn_announce_data_is_valid
 from nomadnet.util import strip_modifiers
 from nomadnet.util import sanitize_name
+from nomadnet.util import normalize_name
 
 class PNAnnounceHandler:
     def __init__(self, owner):
@@ -33,8 +38,385 @@ class PNAnnounceHandler:
             RNS.log("Error while evaluating propagation node announce, ignoring announce.", RNS.LOG_DEBUG)
             RNS.log("The contained exception was: "+str(e), RNS.LOG_DEBUG)
 
+# Announces of one type, newest first. Announces are kept
+# in a deque, and indexed by timestamp and by source hash.
+# Removed announces are only dropped from the indexes, and
+# are skipped when the deque is read. The deque is rebuilt
+# once it holds more removed announces than live ones.
+class AnnounceList:
+    def __init__(self, max_length, spill=None):
+        self.max_length = max_length
+        self.spill = spill
+        self.entries = collections.deque()
+        self.by_timestamp = {}
+        self.by_source = {}
+
+    def __len__(self):
+        return len(self.by_timestamp)
+
+    def __iter__(self):
+        for announce in list(self.entries):
+            if self.by_timestamp.get(announce[0]) is announce:
+                yield announce
+
+    def is_live(self, announce):
+        return self.by_timestamp.get(announce[0]) is announce
+
+    def add(self, timestamp, source_hash, app_data, announce_type):
+        while timestamp in self.by_timestamp:
+            timestamp += 0.000001
+
+        announce = (timestamp, source_hash, app_data, announce_type)
+        self.entries.appendleft(announce)
+        self.index(announce)
+        self.trim()
+        return announce
+
+    # Used when loading announces from disk, where they are
+    # stored newest first.
+    def append(self, announce):
+        if not announce[0] in self.by_timestamp:
+            self.entries.append(announce)
+            self.index(announce)
+
+    def index(self, announce):
+        self.by_timestamp[announce[0]] = announce
+        if not announce[1] in self.by_source:
+            self.by_source[announce[1]] = set()
+        self.by_source[announce[1]].add(announce[0])
+
+    def remove(self, timestamp):
+        announce = self.by_timestamp.pop(timestamp, None)
+        if announce != None:
+            timestamps = self.by_source[announce[1]]
+            timestamps.discard(timestamp)
+            if len(timestamps) == 0:
+                self.by_source.pop(announce[1])
+            self.compact()
+
+        return announce
+
+    def remove_source(self, source_hash):
+        for timestamp in self.by_source.pop(source_hash, ()):
+            self.by_timestamp.pop(timestamp, None)
+        self.compact()
+
+    def has_source(self, source_hash):
+        return source_hash in self.by_source
+
+    def trim(self):
+        while len(self.by_timestamp) > self.max_length:
+            announce = self.entries.pop()
+            if self.is_live(announce):
+                self.remove(announce[0])
+                if self.spill != None:
+                    self.spill(announce)
+
+        while len(self.entries) > 0 and not self.is_live(self.entries[-1]):
+            self.entries.pop()
+
+    def compact(self):
+        if len(self.entries) > 2*len(self.by_timestamp)+64:
+            self.entries = collections.deque(a for a in self.entries if self.is_live(a))
+
+def pack_record(record):
+    packed = msgpack.packb(record)
+    return struct.pack("!I", len(packed))+packed
+
+# Reads length-prefixed msgpack records from a file, and
+# returns them with their start and end offsets. A record
+# that was only partially written is ignored.
+def read_records(file, end=None):
+    records = []
+    while end == None or file.tell() < end:
+        header = file.read(4)
+        if len(header) < 4:
+            break
+        length = struct.unpack("!I", header)[0]
+        record = file.read(length)
+        if len(record) < length:
+            break
+        records.append((file.tell()-length-4, file.tell(), msgpack.unpackb(record)))
+
+    return records
+
+# Announces that no longer fit in the announce stream are
+# moved to an append-only log on disk, with one segment file
+# per announce type and day. Each record is a msgpack list
+# of timestamp, source hash and app data, prefixed with its
+# length. A sparse index of timestamps and file offsets is
+# built when a segment is first read, so older announces
+# can be paged in without reading whole segments.
+class AnnounceHistory:
+    SEGMENT_LENGTH = 24*60*60
+    INDEX_STRIDE   = 64
+    MAX_INDEXES    = 32
+
+    def __init__(self, storage_path, max_age):
+        self.storage_path = storage_path
+        self.max_age = max_age
+        self.indexes = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(self.storage_path):
+            os.makedirs(self.storage_path)
+
+    def segment_path(self, announce_type, segment):
+        return self.storage_path+"/"+announce_type+"."+str(segment)
+
+    def segments(self, announce_type):
+        segments = []
+        for filename in os.listdir(self.storage_path):
+            prefix, _, segment = filename.rpartition(".")
+            if prefix == announce_type and segment.isdigit():
+                segments.append(int(segment))
+
+        return sorted(segments)
+
+    def append(self, announce):
+        timestamp, source_hash, app_data, announce_type = announce
+        segment = int(timestamp//AnnounceHistory.SEGMENT_LENGTH)
+        path = self.segment_path(announce_type, segment)
+        record = pack_record([timestamp, source_hash, app_data])
+
+        try:
+            with self.lock:
+                with open(path, "ab") as file:
+                    offset = file.tell()
+                    file.write(record)
+
+                # Keep the index of the segment current, if it
+                # has already been built.
+                if path in self.indexes:
+                    index = self.indexes[path]
+                    if index["count"] % AnnounceHistory.INDEX_STRIDE == 0:
+                        index["timestamps"].append(timestamp)
+                        index["offsets"].append(offset)
+                    index["count"] += 1
+
+        except Exception as e:
+            RNS.log("Could not write announce to history: "+str(e), RNS.LOG_ERROR)
+
+    def segment_index(self, path):
+        if path in self.indexes:
+            self.indexes.move_to_end(path)
+            return self.indexes[path]
+
+        index = {"timestamps": [], "offsets": [], "count": 0}
+        with open(path, "rb") as file:
+            for offset, _, record in read_records(file):
+                if index["count"] % AnnounceHistory.INDEX_STRIDE == 0:
+                    index["timestamps"].append(record[0])
+                    index["offsets"].append(offset)
+                index["count"] += 1
+
+        self.indexes[path] = index
+        while len(self.indexes) > AnnounceHistory.MAX_INDEXES:
+            self.indexes.popitem(last=False)
+
+        return index
+
+    # Returns up to limit announces of the given type that
+    # are older than the given timestamp, newest first.
+    def page(self, announce_type, before=None, limit=100):
+        if before == None:
+            before = time.time()
+
+        results = []
+        try:
+            with self.lock:
+                last_segment = int(before//AnnounceHistory.SEGMENT_LENGTH)
+                for segment in reversed(self.segments(announce_type)):
+                    if segment > last_segment:
+                        continue
+
+                    path = self.segment_path(announce_type, segment)
+                    index = self.segment_index(path)
+                    block = bisect.bisect_left(index["timestamps"], before)
+
+                    with open(path, "rb") as file:
+                        while block > 0 and len(results) < limit:
+                            block -= 1
+                            file.seek(index["offsets"][block])
+                            if block+1 < len(index["offsets"]):
+                                end = index["offsets"][block+1]
+                            else:
+                                end = None
+
+                            records = [r for _, _, r in read_records(file, end) if r[0] < before]
+                            for record in reversed(records):
+                                results.append((record[0], record[1], record[2], announce_type))
+
+                    if len(results) >= limit:
+                        break
+
+        except Exception as e:
+            RNS.log("Could not read announce history: "+str(e), RNS.LOG_ERROR)
+
+        return results[:limit]
+
+    # Returns the timestamp and source hash of all announces
+    # of any type heard after the cutoff time, or of all
+    # announces in the history if the cutoff is None.
+    def sources_since(self, cutoff=None):
+        results = []
+        try:
+            with self.lock:
+                for filename in os.listdir(self.storage_path):
+                    segment = filename.rpartition(".")[2]
+                    if not segment.isdigit():
+                        continue
+                    if cutoff != None and int(segment) < int(cutoff//AnnounceHistory.SEGMENT_LENGTH):
+                        continue
+
+                    with open(self.storage_path+"/"+filename, "rb") as file:
+                        for _, _, record in read_records(file):
+                            if cutoff == None or record[0] > cutoff:
+                                results.append((record[0], record[1]))
+
+        except Exception as e:
+            RNS.log("Could not read announce history: "+str(e), RNS.LOG_ERROR)
+
+        return results
+
+    def expire(self):
+        cutoff = int((time.time()-self.max_age)//AnnounceHistory.SEGMENT_LENGTH)
+        with self.lock:
+            for filename in os.listdir(self.storage_path):
+                segment = filename.rpartition(".")[2]
+                if segment.isdigit() and int(segment) < cutoff:
+                    path = self.storage_path+"/"+filename
+                    try:
+                        os.unlink(path)
+                        self.indexes.pop(path, None)
+                    except Exception as e:
+                        RNS.log("Could not remove expired announce history "+str(path)+": "+str(e), RNS.LOG_ERROR)
+
+# Counts the unique sources heard within a sliding window
+# exactly, by keeping the time each source was last heard,
+# ordered from oldest to newest. Sources must be added in
+# the order they were heard.
+class WindowedCounter:
+    def __init__(self, window):
+        self.window = window
+        self.last_seen = collections.OrderedDict()
+
+    def add(self, source_hash, timestamp):
+        if source_hash in self.last_seen:
+            if self.last_seen[source_hash] >= timestamp:
+                return
+            self.last_seen.move_to_end(source_hash)
+        self.last_seen[source_hash] = timestamp
+
+    def count(self, now):
+        cutoff = now-self.window
+        while len(self.last_seen) > 0 and next(iter(self.last_seen.values())) <= cutoff:
+            self.last_seen.popitem(last=False)
+
+        return len(self.last_seen)
+
+# Estimates the unique sources heard within a sliding window
+# with HyperLogLog sketches, for windows where keeping every
+# source would take too much memory. The window is divided
+# into SLOTS time slots with a sketch each, and the sketches
+# of the slots in the window are merged when counting. The
+# window is thereby rounded up to a whole slot.
+class WindowedSketch:
+    PRECISION = 10
+    SLOTS     = 24
+
+    def __init__(self, window):
+        self.window = window
+        self.slot_length = window/WindowedSketch.SLOTS
+        self.registers = 1 << WindowedSketch.PRECISION
+        self.slots = {}
+        self.merged = None
+        self.estimate = None
+
+    def add(self, source_hash, timestamp):
+        # Source hashes are truncated SHA-256 hashes, so their
+        # bits can be used directly as the hash value.
+        value = int.from_bytes(source_hash[:8], "big")
+        register = value >> (64-WindowedSketch.PRECISION)
+        remaining = value & ((1 << (64-WindowedSketch.PRECISION))-1)
+        rank = (64-WindowedSketch.PRECISION)-remaining.bit_length()+1
+
+        slot = int(timestamp//self.slot_length)
+        if not slot in self.slots:
+            self.slots[slot] = bytearray(self.registers)
+
+        if self.slots[slot][register] < rank:
+            self.slots[slot][register] = rank
+            if self.merged != None and self.merged[register] < rank:
+                self.merged[register] = rank
+                self.estimate = None
+
+    def count(self, now):
+        oldest_slot = int((now-self.window)//self.slot_length)
+        for slot in [slot for slot in self.slots if slot < oldest_slot]:
+            self.slots.pop(slot)
+            self.merged = None
+
+        if self.merged == None:
+            self.merged = bytearray(self.registers)
+            for registers in self.slots.values():
+                for i in range(self.registers):
+                    if registers[i] > self.merged[i]:
+                        self.merged[i] = registers[i]
+            self.estimate = None
+
+        if self.estimate == None:
+            m = self.registers
+            alpha = 0.7213/(1+1.079/m)
+            estimate = alpha*m*m/sum(2.0**-r for r in self.merged)
+            zeros = self.merged.count(0)
+            if estimate <= 2.5*m and zeros > 0:
+                estimate = m*math.log(m/zeros)
+            self.estimate = int(round(estimate))
+
+        return self.estimate
+
+# Keeps counts of unique sources heard over a set of time
+# windows, updated as announces arrive. Windows up to
+# EXACT_LIMIT are counted exactly, longer ones are estimated.
+class PeerCounter:
+    WINDOWS     = [30*60, 60*60, 24*60*60, 7*24*60*60]
+    EXACT_LIMIT = 24*60*60
+
+    def __init__(self, windows=WINDOWS):
+        self.counters = {}
+        self.lock = threading.Lock()
+        for window in windows:
+            if window <= PeerCounter.EXACT_LIMIT:
+                self.counters[window] = WindowedCounter(window)
+            else:
+                self.counters[window] = WindowedSketch(window)
+
+    def add(self, source_hash, timestamp):
+        with self.lock:
+            for counter in self.counters.values():
+                counter.add(source_hash, timestamp)
+
+    def has_window(self, window):
+        return window in self.counters
+
+    def is_estimate(self, window):
+        return isinstance(self.counters.get(window, None), WindowedSketch)
+
+    def count(self, window):
+        with self.lock:
+            return self.counters[window].count(time.time())
+
+# The directory is stored as a snapshot of all entries and
+# the announce stream, plus a journal of changes to entries
+# made since the snapshot was written. Changes are appended
+# to the journal, and once it holds JOURNAL_MAX_RECORDS, it
+# is compacted into a new snapshot. The announce stream is
+# only saved with snapshots.
 class Directory:
-    ANNOUNCE_STREAM_MAXLENGTH = 256
+    ANNOUNCE_STREAM_MAXLENGTH = 4096
+    HISTORY_EXPIRY_INTERVAL   = 60*60
+    JOURNAL_MAX_RECORDS       = 512
 
     aspect_filter = "nomadnetwork.node"
     @staticmethod
@@ -58,53 +440,124 @@ class Directory:
 
     @property
     def announce_stream(self):
-        return self._node_announces+self._peer_announces+self._pn_announces
-
-    def _clean_node_announces(self):
-        while len(self._node_announces) > Directory.ANNOUNCE_STREAM_MAXLENGTH:
-            self._node_announces.pop()
-
-    def _clean_peer_announces(self):
-        while len(self._peer_announces) > Directory.ANNOUNCE_STREAM_MAXLENGTH:
-            self._peer_announces.pop()
-
-    def _clean_pn_announces(self):
-        while len(self._pn_announces) > Directory.ANNOUNCE_STREAM_MAXLENGTH:
-            self._pn_announces.pop()
+        return list(self._node_announces)+list(self._peer_announces)+list(self._pn_announces)
 
     def __init__(self, app):
         self.directory_entries = {}
-        self._node_announces = []
-        self._peer_announces = []
-        self._pn_announces   = []
+        self.name_index = {}
+        self.node_list = None
+        self.node_list_version = 0
         self.app = app
+
+        # The peer counter is kept in memory for all displayed
+        # windows, whatever the announce history retains. On
+        # startup, it is seeded from the announce stream and
+        # as much of the history as is available.
+        self.peer_counter = PeerCounter()
+        if self.app.announce_history_days > 0:
+            history_age = self.app.announce_history_days*24*60*60
+            self.history = AnnounceHistory(self.app.storagepath+"/announces", history_age)
+            spill = self.history.append
+            self.app.scheduler.schedule("directory.history_expiry", self.history.expire, interval=Directory.HISTORY_EXPIRY_INTERVAL)
+        else:
+            self.history = None
+            spill = None
+
+        stream_length = self.app.announce_stream_length
+        self._node_announces = AnnounceList(stream_length, spill=spill)
+        self._peer_announces = AnnounceList(stream_length, spill=spill)
+        self._pn_announces   = AnnounceList(stream_length, spill=spill)
         self.announce_lock = threading.Lock()
+        self.persist_lock = threading.RLock()
+        self.journal_path = self.app.directorypath+".journal"
+        self.journal_records = 0
         self.load_from_disk()
 
         self.pn_announce_handler = PNAnnounceHandler(self)
         RNS.Transport.register_announce_handler(self.pn_announce_handler)
 
 
+    def pack_entry(self, e):
+        return (e.source_hash, e.display_name, e.trust_level, e.hosts_node, e.preferred_delivery, e.identify, e.sort_rank)
+
+    def unpack_entry(self, e):
+        e = list(e)
+        if e[1] == None:
+            e[1] = "Undefined"
+
+        if len(e) > 3:
+            hosts_node = e[3]
+        else:
+            hosts_node = False
+
+        if len(e) > 4:
+            preferred_delivery = e[4]
+        else:
+            preferred_delivery = None
+
+        if len(e) > 5:
+            identify = e[5]
+        else:
+            identify = False
+
+        if len(e) > 6:
+            sort_rank = e[6]
+        else:
+            sort_rank = None
+
+        return DirectoryEntry(e[0], e[1], e[2], hosts_node, preferred_delivery=preferred_delivery, identify_on_connect=identify, sort_rank=sort_rank)
+
+    # Writes a full snapshot of the directory, and clears the
+    # journal, since all changes in it are now contained in
+    # the snapshot.
     def save_to_disk(self):
-        try:
-            packed_list = []
-            for source_hash in self.directory_entries:
-                e = self.directory_entries[source_hash]
-                packed_list.append((e.source_hash, e.display_name, e.trust_level, e.hosts_node, e.preferred_delivery, e.identify, e.sort_rank))
+        with self.persist_lock:
+            try:
+                packed_list = []
+                for e in list(self.directory_entries.values()):
+                    packed_list.append(self.pack_entry(e))
+
+                directory = {
+                    "entry_list": packed_list,
+                    "announce_stream": self.announce_stream
+                }
+
+                tmp_path = self.app.directorypath+".tmp"
+                with open(tmp_path, "wb") as file:
+                    file.write(msgpack.packb(directory))
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, self.app.directorypath)
+
+                with open(self.journal_path, "wb") as file:
+                    file.flush()
+                    os.fsync(file.fileno())
+                self.journal_records = 0
+
+            except Exception as e:
+                RNS.log("Could not write directory to disk. Then contained exception was: "+str(e), RNS.LOG_ERROR)
 
-            directory = {
-                "entry_list": packed_list,
-                "announce_stream": self.announce_stream
-            }
+    def journal(self, record):
+        with self.persist_lock:
+            try:
+                with open(self.journal_path, "ab") as file:
+                    file.write(pack_record(record))
+                    file.flush()
+                    os.fsync(file.fileno())
+                self.journal_records += 1
 
-            file = open(self.app.directorypath, "wb")
-            file.write(msgpack.packb(directory))
-            file.close()
+            except Exception as e:
+                RNS.log("Could not write directory change to journal, writing full directory instead. The contained exception was: "+str(e), RNS.LOG_ERROR)
+                self.save_to_disk()
 
-        except Exception as e:
-            RNS.log("Could not write directory to disk. Then contained exception was: "+str(e), RNS.LOG_ERROR)
+            if self.journal_records >= Directory.JOURNAL_MAX_RECORDS:
+                self.save_to_disk()
+
+    def journal_entry(self, entry):
+        self.journal(["remember", self.pack_entry(entry)])
 
     def load_from_disk(self):
+        entries = {}
         if os.path.isfile(self.app.directorypath):
             try:
                 file = open(self.app.directorypath, "rb")
@@ -112,85 +565,78 @@ class Directory:
                 unpacked_list = unpacked_directory["entry_list"]
                 file.close()
 
-                entries = {}
                 for e in unpacked_list:
+                    entries[e[0]] = self.unpack_entry(e)
 
-                    if e[1] == None:
-                        e[1] = "Undefined"
-
-                    if len(e) > 3:
-                        hosts_node = e[3]
-                    else:
-                        hosts_node = False
+                announce_lists = {"node": self._node_announces, "peer": self._peer_announces, "pn": self._pn_announces}
+                for e in unpacked_directory["announce_stream"]:
+                    if e[3] in announce_lists:
+                        announce_lists[e[3]].append(tuple(e))
 
-                    if len(e) > 4:
-                        preferred_delivery = e[4]
-                    else:
-                        preferred_delivery = None
+                for announce_list in announce_lists.values():
+                    announce_list.trim()
 
-                    if len(e) > 5:
-                        identify = e[5]
-                    else:
-                        identify = False
+                heard = [(announce[0], announce[1]) for announce in self.announce_stream]
+                if self.history != None:
+                    heard.extend(self.history.sources_since(time.time()-max(PeerCounter.WINDOWS)))
 
-                    if len(e) > 6:
-                        sort_rank = e[6]
-                    else:
-                        sort_rank = None
+                for timestamp, source_hash in sorted(heard):
+                    self.peer_counter.add(source_hash, timestamp)
 
-                    entries[e[0]] = DirectoryEntry(e[0], e[1], e[2], hosts_node, preferred_delivery=preferred_delivery, identify_on_connect=identify, sort_rank=sort_rank)
-
-                self.directory_entries = entries
+            except Exception as e:
+                RNS.log("Could not load directory from disk. The contained exception was: "+str(e), RNS.LOG_ERROR)
 
-                astream = unpacked_directory["announce_stream"]
-                self._node_announces = [e for e in astream if e[3] == "node"]
-                self._peer_announces = [e for e in astream if e[3] == "peer"]
-                self._pn_announces = [e for e in astream if e[3] == "pn"]
+        if os.path.isfile(self.journal_path):
+            try:
+                with open(self.journal_path, "r+b") as file:
+                    records = read_records(file)
+
+                    # Drop any partially written record at the end
+                    # of the journal, so that new records can be
+                    # appended after the last complete one.
+                    valid_length = records[-1][1] if len(records) > 0 else 0
+                    if file.seek(0, os.SEEK_END) != valid_length:
+                        RNS.log("Truncating incomplete record at end of directory journal", RNS.LOG_WARNING)
+                        file.truncate(valid_length)
+
+                for _, _, record in records:
+                    if record[0] == "remember":
+                        entries[record[1][0]] = self.unpack_entry(record[1])
+                    elif record[0] == "forget":
+                        entries.pop(record[1], None)
+
+                self.journal_records = len(records)
+                if self.journal_records > 0:
+                    RNS.log("Replayed "+str(self.journal_records)+" directory changes from journal", RNS.LOG_DEBUG)
 
             except Exception as e:
-                RNS.log("Could not load directory from disk. The contained exception was: "+str(e), RNS.LOG_ERROR)
+                RNS.log("Could not replay directory journal. The contained exception was: "+str(e), RNS.LOG_ERROR)
+
+        self.directory_entries = entries
+        self.name_index = {}
+        for entry in entries.values():
+            self.index_name(entry)
+        self.invalidate_nodes()
 
     def lxmf_announce_received(self, source_hash, app_data):
         with self.announce_lock:
             if app_data != None:
                 if self.app.compact_stream:
-                    try:
-                        remove_announces = []
-                        for announce in self._peer_announces:
-                            if announce[1] == source_hash: remove_announces.append(announce)
-
-                        for a in remove_announces: self._peer_announces.remove(a)
-                    
-                    except Exception as e:
-                        RNS.log("An error occurred while compacting the announce stream. The contained exception was:"+str(e), RNS.LOG_ERROR)
+                    self._peer_announces.remove_source(source_hash)
 
-                timestamp = time.time()
-                self._peer_announces.insert(0, (timestamp, source_hash, app_data, "peer"))
-                self._clean_peer_announces()
+                announce = self._peer_announces.add(time.time(), source_hash, app_data, "peer")
+                self.peer_counter.add(source_hash, announce[0])
 
-                if hasattr(self.app, "ui") and self.app.ui != None:
-                    if hasattr(self.app.ui, "main_display"):
-                        self.app.ui.main_display.sub_displays.network_display.directory_change_callback()
+                self.app.ui_notifier.notify("directory")
 
     def node_announce_received(self, source_hash, app_data, associated_peer):
         with self.announce_lock:
             if app_data != None:
                 if self.app.compact_stream:
-                    try:
-                        remove_announces = []
-                        for announce in self._node_announces:
-                            if announce[1] == source_hash:
-                                remove_announces.append(announce)
-
-                        for a in remove_announces:
-                            self._node_announces.remove(a)
-                    
-                    except Exception as e:
-                        RNS.log("An error occurred while compacting the announce stream. The contained exception was:"+str(e), RNS.LOG_ERROR)
+                    self._node_announces.remove_source(source_hash)
 
-                timestamp = time.time()
-                self._node_announces.insert(0, (timestamp, source_hash, app_data, "node"))
-                self._clean_node_announces()
+                announce = self._node_announces.add(time.time(), source_hash, app_data, "node")
+                self.peer_counter.add(source_hash, announce[0])
 
                 if self.trust_level(associated_peer) == DirectoryEntry.TRUSTED:
                     existing_entry = self.find(source_hash)
@@ -198,72 +644,35 @@ class Directory:
                         node_entry = DirectoryEntry(source_hash, display_name=app_data.decode("utf-8"), trust_level=DirectoryEntry.TRUSTED, hosts_node=True)
                         self.remember(node_entry)
                 
-                if hasattr(self.app.ui, "main_display"):
-                    self.app.ui.main_display.sub_displays.network_display.directory_change_callback()
+                self.app.ui_notifier.notify("directory")
 
     def pn_announce_received(self, source_hash, app_data, associated_peer, associated_node):
         with self.announce_lock:
-            found_node = None
-            for sh in self.directory_entries:
-                if sh == associated_node:
-                    found_node = True
-                    break
-
-            for e in self._pn_announces:
-                if e[1] == associated_node:
-                    found_node = True
-                    break
+            found_node = associated_node in self.directory_entries or self._pn_announces.has_source(associated_node)
 
             # TODO: Remove debug and rethink this (needs way to set PN when node is saved)
             if True or not found_node:
                 if self.app.compact_stream:
-                    try:
-                        remove_announces = []
-                        for announce in self._pn_announces:
-                            if announce[1] == source_hash:
-                                remove_announces.append(announce)
-
-                        for a in remove_announces:
-                            self._pn_announces.remove(a)
-                    
-                    except Exception as e:
-                        RNS.log("An error occurred while compacting the announce stream. The contained exception was:"+str(e), RNS.LOG_ERROR)
+                    self._pn_announces.remove_source(source_hash)
 
-                timestamp = time.time()
-                self._pn_announces.insert(0, (timestamp, source_hash, app_data, "pn"))
-                self._clean_pn_announces()
+                announce = self._pn_announces.add(time.time(), source_hash, app_data, "pn")
+                self.peer_counter.add(source_hash, announce[0])
                 
-                if hasattr(self.app, "ui") and hasattr(self.app.ui, "main_display"):
-                    self.app.ui.main_display.sub_displays.network_display.directory_change_callback()
+                self.app.ui_notifier.notify("directory")
+
+    # Returns announces of the given type, older than the given
+    # timestamp, from the on-disk announce history.
+    def announce_history(self, announce_type, before=None, limit=100):
+        if self.history == None:
+            return []
+        else:
+            return self.history.page(announce_type, before=before, limit=limit)
 
     def remove_announce_with_timestamp(self, timestamp):
-        selected_announce = None
-        for announce in self._node_announces:
-            if announce[0] == timestamp:
-                selected_announce = announce
-                break
-
-        if selected_announce != None:
-            self._node_announces.remove(selected_announce)
-            return
-
-        for announce in self._peer_announces:
-            if announce[0] == timestamp:
-                selected_announce = announce
-                break
-
-        if selected_announce != None:
-            self._peer_announces.remove(selected_announce)
-            return
-
-        for announce in self._pn_announces:
-            if announce[0] == timestamp:
-                selected_announce = announce
-                break
-
-        if selected_announce != None:
-            self._pn_announces.remove(selected_announce)
-            return
+        with self.announce_lock:
+            for announce_list in [self._node_announces, self._peer_announces, self._pn_announces]:
+                if announce_list.remove(timestamp) != None:
+                    return
 
     def display_name(self, source_hash):
         if source_hash in self.directory_entries:
@@ -300,17 +709,40 @@ class Directory:
             return None
 
 
+    # Display names are indexed by their normalized form, so
+    # that impostor checks can find other entries using the
+    # same name, or a name that only looks the same.
+    def index_name(self, entry):
+        name = normalize_name(entry.display_name)
+        if name:
+            if not name in self.name_index:
+                self.name_index[name] = set()
+            self.name_index[name].add(entry.source_hash)
+
+    def unindex_name(self, entry):
+        name = normalize_name(entry.display_name)
+        if name and name in self.name_index:
+            self.name_index[name].discard(entry.source_hash)
+            if len(self.name_index[name]) == 0:
+                self.name_index.pop(name)
+
+    def sources_with_name(self, display_name):
+        name = normalize_name(display_name)
+        if name and name in self.name_index:
+            return set(self.name_index[name])
+        else:
+            return set()
+
     def trust_level(self, source_hash, announced_display_name=None):
         if source_hash in self.directory_entries:
             if announced_display_name == None:
                 return self.directory_entries[source_hash].trust_level
             else:
                 if not self.directory_entries[source_hash].trust_level == DirectoryEntry.TRUSTED:
-                    for entry in self.directory_entries:
-                        e = self.directory_entries[entry]
-                        if e.display_name == announced_display_name:
-                            if e.source_hash != source_hash:
-                                return DirectoryEntry.WARNING
+                    name = normalize_name(announced_display_name)
+                    if name and name in self.name_index:
+                        if len(self.name_index[name]-{source_hash}) > 0:
+                            return DirectoryEntry.WARNING
 
                 return self.directory_entries[source_hash].trust_level
         else:
@@ -335,7 +767,11 @@ class Directory:
             return DirectoryEntry.DIRECT
 
     def remember(self, entry):
+        if entry.source_hash in self.directory_entries:
+            self.unindex_name(self.directory_entries[entry.source_hash])
         self.directory_entries[entry.source_hash] = entry
+        self.index_name(entry)
+        self.invalidate_nodes()
 
         identity = RNS.Identity.recall(entry.source_hash)
         if identity != None:
@@ -343,12 +779,16 @@ class Directory:
             if associated_node in self.directory_entries:
                 node_entry = self.directory_entries[associated_node]
                 node_entry.trust_level = entry.trust_level
+                self.invalidate_nodes()
+                self.journal_entry(node_entry)
 
-        self.save_to_disk()
+        self.journal_entry(entry)
 
     def forget(self, source_hash):
         if source_hash in self.directory_entries:
-            self.directory_entries.pop(source_hash)
+            self.unindex_name(self.directory_entries.pop(source_hash))
+            self.invalidate_nodes()
+            self.journal(["forget", source_hash])
 
     def find(self, source_hash):
         if source_hash in self.directory_entries:
@@ -379,30 +819,61 @@ class Directory:
         if source_hash in self.directory_entries:
             entry = self.directory_entries[source_hash]
             entry.identify = state
+            self.journal_entry(entry)
     
+    # The sorted list of known nodes is kept until a directory
+    # entry changes. The version counter makes sure a list that
+    # was built while entries changed is not kept.
+    def invalidate_nodes(self):
+        self.node_list_version += 1
+        self.node_list = None
+
     def known_nodes(self):
-        node_list = []
-        for eh in self.directory_entries:
-            e = self.directory_entries[eh]
-            if e.hosts_node:
-                node_list.append(e)
+        node_list = self.node_list
+        if node_list == None:
+            version = self.node_list_version
+            node_list = []
+            for e in list(self.directory_entries.values()):
+                if e.hosts_node:
+                    node_list.append(e)
 
-        node_list.sort(key = lambda e: (e.sort_rank if e.sort_rank != None else 2^32, DirectoryEntry.TRUSTED-e.trust_level, e.display_name if e.display_name != None else "_"))
-        return node_list
+            node_list.sort(key = lambda e: (e.sort_rank if e.sort_rank != None else 2^32, DirectoryEntry.TRUSTED-e.trust_level, e.display_name if e.display_name != None else "_"))
+            if version == self.node_list_version:
+                self.node_list = node_list
 
-    def number_of_known_nodes(self):
-        return len(self.known_nodes())
+        return list(node_list)
 
+    def number_of_known_nodes(self):
+        node_list = self.node_list
+        if node_list == None:
+            return len(self.known_nodes())
+        else:
+            return len(node_list)
+
+    # Counts the unique sources heard within the lookback
+    # time, or over all retained announces if it is None.
+    # Every window covers the announce stream plus the
+    # announce history. Windows kept by the peer counter are
+    # read from it, and any other window is counted by
+    # reading the history, which is slower.
     def number_of_known_peers(self, lookback_seconds=None):
-        unique_hashes = []
-        cutoff_time = time.time()-lookback_seconds
-        for entry in self.announce_stream:
-            if not entry[1] in unique_hashes:
-                if lookback_seconds == None or entry[0] > cutoff_time:
-                    unique_hashes.append(entry[1])
+        if lookback_seconds != None and self.peer_counter.has_window(lookback_seconds):
+            return self.peer_counter.count(lookback_seconds)
+
+        if lookback_seconds == None:
+            cutoff_time = None
+        else:
+            cutoff_time = time.time()-lookback_seconds
+
+        unique_hashes = set(entry[1] for entry in self.announce_stream if cutoff_time == None or entry[0] > cutoff_time)
+        if self.history != None:
+            unique_hashes.update(source_hash for _, source_hash in self.history.sources_since(cutoff_time))
 
         return len(unique_hashes)
 
+    def peer_count_is_estimate(self, lookback_seconds):
+        return self.peer_counter.is_estimate(lookback_seconds)
+
 class DirectoryEntry:
     WARNING   = 0x00
     UNTRUSTED = 0x01
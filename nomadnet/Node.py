@@ -1,15 +1,1373 @@
+import io
 import os
 import sys
+import bz2
+import signal
 
 import RNS
+import json
 import time
+import hashlib
+import bisect
+import struct
 import threading
 import subprocess
+import collections
 import RNS.vendor.umsgpack as msgpack
+from .Template import TemplateCache
+from .util import format_stats
+
+class PageCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, file_path):
+        st = os.stat(file_path)
+        with self.lock:
+            if file_path in self.entries:
+                mtime, size, data = self.entries[file_path]
+                if mtime == st.st_mtime_ns and size == st.st_size:
+                    self.entries.move_to_end(file_path)
+                    self.hits += 1
+                    return data
+                else:
+                    self.__evict(file_path)
+
+            self.misses += 1
+
+        fh = open(file_path, "rb")
+        data = fh.read()
+        fh.close()
+
+        if len(data) == st.st_size and st.st_size <= self.max_size:
+            with self.lock:
+                if file_path in self.entries:
+                    self.__evict(file_path)
+                self.entries[file_path] = (st.st_mtime_ns, st.st_size, data)
+                self.size += st.st_size
+                while self.size > self.max_size:
+                    self.__evict(next(iter(self.entries)))
+
+        return data
+
+    def remove(self, file_path):
+        with self.lock:
+            if file_path in self.entries:
+                self.__evict(file_path)
+
+    def __evict(self, file_path):
+        mtime, size, data = self.entries.pop(file_path)
+        self.size -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "size": self.size, "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+class AccessControl:
+    SUFFIX = ".allowed"
+
+    def __init__(self, base_path):
+        self.base_path = base_path.rstrip("/")
+        self.lists = {}
+        self.lock = threading.Lock()
+
+    def applicable_lists(self, file_path):
+        acl_paths = []
+        path = file_path
+        while True:
+            acl_path = path+AccessControl.SUFFIX
+            if os.path.isfile(acl_path):
+                acl_paths.append(acl_path)
+
+            if len(path) <= len(self.base_path) or not path.startswith(self.base_path):
+                break
+
+            path = os.path.dirname(path)
+            if len(path) <= len(self.base_path):
+                break
+
+        return acl_paths
+
+    # When many files are checked at once, a dictionary can
+    # be passed as lists, so every list is only read, or its
+    # script only run, once for all of the checks.
+    def is_allowed(self, file_path, remote_identity, lists=None):
+        acl_paths = self.applicable_lists(file_path)
+        if len(acl_paths) == 0:
+            return True
+
+        if not hasattr(remote_identity, "hash"):
+            return False
+
+        for acl_path in acl_paths:
+            if lists != None:
+                if not acl_path in lists:
+                    lists[acl_path] = self.identities(acl_path)
+                allowed = lists[acl_path]
+            else:
+                allowed = self.identities(acl_path)
+
+            if allowed == None:
+                continue
+
+            if not remote_identity.hash in allowed:
+                return False
+
+        return True
+
+    # Returns None if the list was removed after it was
+    # found, in which case it no longer applies.
+    def identities(self, acl_path):
+        try:
+            st = os.stat(acl_path)
+        except OSError:
+            with self.lock:
+                self.lists.pop(acl_path, None)
+            return None
+
+        executable = os.access(acl_path, os.X_OK)
+        now = time.time()
+
+        with self.lock:
+            if acl_path in self.lists:
+                mtime, size, expires, allowed = self.lists[acl_path]
+                if mtime == st.st_mtime_ns and size == st.st_size:
+                    if not executable or now < expires:
+                        return allowed
+
+        ttl = 0
+        allowed_list = []
+        try:
+            if executable:
+                allowed_result = subprocess.run([acl_path], stdout=subprocess.PIPE)
+                allowed_input = allowed_result.stdout
+
+            else:
+                fh = open(acl_path, "rb")
+                allowed_input = fh.read()
+                fh.close()
+
+            for hash_str in allowed_input.splitlines():
+                hash_str = hash_str.strip()
+                if hash_str.startswith(b"#!c="):
+                    try:
+                        ttl = max(0, int(hash_str[4:]))
+                    except Exception as e:
+                        RNS.log("Invalid cache header in "+str(acl_path)+": "+str(hash_str), RNS.LOG_DEBUG)
+
+                elif len(hash_str) == RNS.Identity.TRUNCATED_HASHLENGTH//8*2:
+                    try:
+                        allowed_hash = bytes.fromhex(hash_str.decode("utf-8"))
+                        allowed_list.append(allowed_hash)
+
+                    except Exception as e:
+                        RNS.log("Could not decode RNS Identity hash from: "+str(hash_str), RNS.LOG_DEBUG)
+                        RNS.log("The contained exception was: "+str(e), RNS.LOG_DEBUG)
+
+        except Exception as e:
+            RNS.log("Error while fetching list of allowed identities for request: "+str(e), RNS.LOG_ERROR)
+            return frozenset()
+
+        allowed = frozenset(allowed_list)
+        if not executable or ttl > 0:
+            with self.lock:
+                self.lists[acl_path] = (st.st_mtime_ns, st.st_size, now+ttl, allowed)
+
+        return allowed
+
+    def clear(self):
+        with self.lock:
+            self.lists.clear()
+
+class PageOutputError(Exception):
+    pass
+
+# Spool files are removed as soon as they are closed, which
+# happens when the resource sending them has concluded.
+class SpoolFile(io.FileIO):
+    def close(self):
+        was_closed = self.closed
+        super().close()
+        if not was_closed:
+            try:
+                os.unlink(self.name)
+            except Exception:
+                pass
+
+def open_spool(spool_path):
+    return io.BufferedReader(SpoolFile(spool_path, "rb"))
+
+class PageOutput:
+    CHUNK_SIZE = 64*1024
+
+    # Output from dynamic pages is collected in memory until
+    # it reaches the spool threshold, after which it is moved
+    # to a spool file in the temporary files directory, so
+    # large output can be sent as a file resource. Output
+    # over the maximum size is discarded with an error.
+    def __init__(self, spool_dir, spool_threshold, max_size):
+        self.spool_dir = spool_dir
+        self.spool_threshold = spool_threshold
+        self.max_size = max_size
+        self.reset()
+
+    def reset(self):
+        self.discard()
+        self.buffer = io.BytesIO()
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size > 0 and self.size > self.max_size:
+            raise PageOutputError("Page output exceeded "+str(self.max_size)+" bytes")
+
+        if self.spool != None:
+            self.spool.write(data)
+        else:
+            self.buffer.write(data)
+            if self.spool_threshold > 0 and self.size >= self.spool_threshold:
+                self.spool_path = self.spool_dir+"/"+Node.SPOOL_PREFIX+RNS.hexrep(os.urandom(8), delimit=False)
+                self.spool = open(self.spool_path, "wb")
+                self.spool.write(self.buffer.getvalue())
+                self.buffer = None
+
+    # Reads from the stream until it ends, or until the
+    # given number of bytes has been read.
+    def read_from(self, stream, length=None):
+        remaining = length
+        while remaining == None or remaining > 0:
+            if remaining == None:
+                chunk = stream.read1(PageOutput.CHUNK_SIZE)
+            else:
+                chunk = stream.read(min(remaining, PageOutput.CHUNK_SIZE))
+
+            if not chunk:
+                if remaining != None:
+                    raise IOError("Output ended before all data was received")
+                break
+
+            self.write(chunk)
+            if remaining != None:
+                remaining -= len(chunk)
+
+    def result(self):
+        if self.spool != None:
+            self.spool.close()
+            self.spool = None
+            return open_spool(self.spool_path)
+        else:
+            return self.buffer.getvalue()
+
+    def discard(self):
+        if getattr(self, "spool", None) != None:
+            try:
+                self.spool.close()
+                os.unlink(self.spool_path)
+            except Exception:
+                pass
+
+        self.spool = None
+        self.spool_path = None
+
+class PageWorkerPool:
+    WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "PageWorker.py")
+
+    def __init__(self, script_path, concurrency):
+        self.script_path = script_path
+        self.concurrency = concurrency
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.idle_workers = []
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.restarts = 0
+        self.closed = False
+
+    def spawn_worker(self):
+        env_map = {}
+        if "PATH" in os.environ:
+            env_map["PATH"] = os.environ["PATH"]
+
+        return subprocess.Popen(
+            [sys.executable, PageWorkerPool.WORKER_PATH, self.script_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env_map)
+
+    # Runs the script with the given environment, and reads
+    # its output into a PageOutput instance. Returns True if
+    # the output was received, or False if the worker failed,
+    # timed out, or produced too much output.
+    def execute(self, env_map, output, timeout=0):
+        with self.slots:
+            with self.lock:
+                self.requests += 1
+                if len(self.idle_workers) > 0:
+                    worker = self.idle_workers.pop()
+                else:
+                    worker = None
+
+            # If an idle worker has crashed or been killed
+            # since it was last used, the request is retried
+            # once on a freshly started worker. Requests that
+            # crash a fresh worker are not retried.
+            for attempt in range(2):
+                if worker == None or worker.poll() != None:
+                    if worker != None:
+                        self.restarts += 1
+                    worker = self.spawn_worker()
+                    fresh_worker = True
+                else:
+                    fresh_worker = False
+
+                timer = None
+                timed_out = threading.Event()
+                try:
+                    payload = json.dumps(env_map).encode("utf-8")
+                    worker.stdin.write(struct.pack("!I", len(payload))+payload)
+                    worker.stdin.flush()
+
+                    if timeout > 0:
+                        timer = threading.Timer(timeout, self.expire_worker, args=[worker, timed_out])
+                        timer.daemon = True
+                        timer.start()
+
+                    header = worker.stdout.read(4)
+                    if len(header) < 4:
+                        raise IOError("Page worker exited while handling request")
+
+                    length = struct.unpack("!I", header)[0]
+                    if output.max_size > 0 and length-1 > output.max_size:
+                        raise PageOutputError("Page output exceeded "+str(output.max_size)+" bytes")
+
+                    status = worker.stdout.read(1)
+                    if len(status) < 1:
+                        raise IOError("Page worker exited while sending response")
+
+                    output.read_from(worker.stdout, length-1)
+                    if timer != None:
+                        timer.cancel()
+
+                    with self.lock:
+                        if self.closed:
+                            self.kill_worker(worker)
+                        else:
+                            self.idle_workers.append(worker)
+
+                    if status[0] != 0x00:
+                        RNS.log("Page script "+str(self.script_path)+" did not complete successfully", RNS.LOG_DEBUG)
+
+                    return True
+
+                except Exception as e:
+                    if timed_out.is_set():
+                        RNS.log("Page worker for "+str(self.script_path)+" timed out after "+str(timeout)+" seconds", RNS.LOG_WARNING)
+                    else:
+                        RNS.log("Page worker for "+str(self.script_path)+" failed: "+str(e), RNS.LOG_ERROR)
+                    self.kill_worker(worker)
+                    output.reset()
+                    worker = None
+                    if fresh_worker or timed_out.is_set() or isinstance(e, PageOutputError):
+                        break
+
+                finally:
+                    if timer != None:
+                        timer.cancel()
+
+            return False
+
+    def expire_worker(self, worker, timed_out):
+        timed_out.set()
+        self.kill_worker(worker)
+
+    def kill_worker(self, worker):
+        try:
+            worker.kill()
+            worker.wait()
+        except Exception as e:
+            pass
+
+    # Kills all idle workers. Workers that are handling a
+    # request are killed once they have finished it.
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+            workers = self.idle_workers
+            self.idle_workers = []
+
+        for worker in workers:
+            self.kill_worker(worker)
+
+class ResponseCache:
+    MAX_ENTRIES = 1024
+    WAIT_TIMEOUT = 60
+
+    def __init__(self, max_entries=MAX_ENTRIES, wait_timeout=WAIT_TIMEOUT):
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self.entries = collections.OrderedDict()
+        self.key_vars = {}
+        self.cacheable = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Dynamic pages declare their server-side cache time
+    # with the same #!c= header that clients use, on the
+    # first line of the output. By default, cached output
+    # is only re-used for requests with identical request
+    # variables, on the same link and from the same remote
+    # identity. A page can declare a
+    # narrower key with a #!k= header listing the variable
+    # names that affect its output, for example
+    # "#!k=var_topic,field_page". An empty #!k= header
+    # means all visitors are served the same output.
+    @staticmethod
+    def parse_headers(output):
+        cache_time = None
+        key_vars = None
+        for line_number, line in enumerate(output.split(b"\n", 8)[:8]):
+            if not line.startswith(b"#!"):
+                break
+
+            try:
+                if line_number == 0 and line.startswith(b"#!c="):
+                    cache_time = int(line[4:])
+                elif line.startswith(b"#!k="):
+                    key_vars = tuple(sorted(k.strip() for k in line[4:].decode("utf-8").split(",") if k.strip() != ""))
+            except Exception as e:
+                RNS.log("Invalid header in dynamic page output: "+str(line), RNS.LOG_DEBUG)
+
+        return cache_time, key_vars
+
+    def request_key(self, file_path, env_map):
+        key_vars = self.key_vars.get(file_path, None)
+        if key_vars == None:
+            key_vars = sorted(k for k in env_map if k.startswith("field_") or k.startswith("var_") or k == "link_id" or k == "remote_identity")
+
+        return (file_path, tuple((k, ResponseCache.key_value(env_map.get(k, None))) for k in key_vars))
+
+    # Request fields can hold lists and dicts, which are
+    # converted to tuples so they can be part of a key.
+    @staticmethod
+    def key_value(value):
+        if isinstance(value, dict):
+            return tuple(sorted(((repr(k), ResponseCache.key_value(v)) for k, v in value.items()), key=lambda e: e[0]))
+        elif isinstance(value, (list, tuple)):
+            return tuple(ResponseCache.key_value(v) for v in value)
+        elif isinstance(value, (bytearray, memoryview)):
+            return bytes(value)
+        else:
+            try:
+                hash(value)
+                return value
+            except TypeError:
+                return repr(value)
+
+    # Concurrent requests for the same key only wait for a
+    # single run of the page if the page is known to produce
+    # cacheable output. Pages that have not been seen yet, or
+    # that do not declare a cache time, run for every request.
+    # If a limiter is given, waiting requests give up their
+    # slot in it until the run they are waiting for is done.
+    def fetch(self, file_path, env_map, generator, limiter=None, identity_key=None):
+        mtime = os.stat(file_path).st_mtime_ns
+        owner = False
+
+        while True:
+            with self.lock:
+                key = self.request_key(file_path, env_map)
+                if key in self.entries:
+                    entry_mtime, expires, output = self.entries[key]
+                    if entry_mtime == mtime and time.time() < expires:
+                        self.entries.move_to_end(key)
+                        self.hits += 1
+                        return output
+                    else:
+                        self.entries.pop(key)
+
+                if not self.cacheable.get(file_path, False):
+                    in_progress = None
+                elif key in self.pending:
+                    in_progress = self.pending[key]
+                else:
+                    in_progress = None
+                    self.pending[key] = threading.Event()
+                    owner = True
+
+                if in_progress == None:
+                    self.misses += 1
+
+            if in_progress == None:
+                break
+
+            # Another request is already generating output
+            # for this key, so wait for it and check again.
+            # If it does not finish in time, the output is
+            # generated for this request instead.
+            if limiter != None:
+                limiter.suspend(identity_key)
+            try:
+                finished = in_progress.wait(self.wait_timeout)
+            finally:
+                if limiter != None:
+                    limiter.resume(identity_key)
+
+            if not finished:
+                with self.lock:
+                    self.misses += 1
+                break
+
+        output = None
+        try:
+            output = generator()
+
+        finally:
+            with self.lock:
+                # Only output held in memory is cached. Output
+                # spooled to disk is always generated again.
+                if isinstance(output, bytes):
+                    cache_time, key_vars = ResponseCache.parse_headers(output)
+                    if key_vars != None:
+                        self.key_vars[file_path] = key_vars
+                    elif file_path in self.key_vars:
+                        self.key_vars.pop(file_path)
+
+                    self.cacheable[file_path] = cache_time != None and cache_time > 0
+                    if self.cacheable[file_path]:
+                        stored_key = self.request_key(file_path, env_map)
+                        self.entries[stored_key] = (mtime, time.time()+cache_time, output)
+                        self.entries.move_to_end(stored_key)
+                        while len(self.entries) > self.max_entries:
+                            self.entries.popitem(last=False)
+
+                elif output != None:
+                    self.cacheable[file_path] = False
+
+                if owner:
+                    self.pending.pop(key).set()
+
+        return output
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.key_vars.clear()
+            self.cacheable.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+class RequestLimiter:
+    def __init__(self, max_active, max_per_identity, max_queued, queue_timeout):
+        self.max_active = max_active
+        self.max_per_identity = max_per_identity
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.active = 0
+        self.active_by_identity = {}
+        self.queued = 0
+        self.max_queued_seen = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.waited = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def can_run(self, identity_key):
+        if self.active >= self.max_active:
+            return False
+        if self.active_by_identity.get(identity_key, 0) >= self.max_per_identity:
+            return False
+        return True
+
+    def acquire(self, identity_key):
+        with self.condition:
+            if not self.can_run(identity_key):
+                if self.queued >= self.max_queued:
+                    self.rejected += 1
+                    return False
+
+                started_waiting = time.time()
+                deadline = started_waiting+self.queue_timeout
+                self.queued += 1
+                self.max_queued_seen = max(self.max_queued_seen, self.queued)
+                try:
+                    while not self.can_run(identity_key):
+                        remaining = deadline-time.time()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            return False
+                        self.condition.wait(remaining)
+
+                finally:
+                    self.queued -= 1
+                    waited = time.time()-started_waiting
+                    self.waited += 1
+                    self.total_wait += waited
+                    self.max_wait = max(self.max_wait, waited)
+
+            self.active += 1
+            self.active_by_identity[identity_key] = self.active_by_identity.get(identity_key, 0)+1
+            self.admitted += 1
+            return True
+
+    def release(self, identity_key):
+        with self.condition:
+            self.active -= 1
+            remaining = self.active_by_identity[identity_key]-1
+            if remaining > 0:
+                self.active_by_identity[identity_key] = remaining
+            else:
+                self.active_by_identity.pop(identity_key)
+
+            self.condition.notify_all()
+
+    # A request that waits for work done by another request
+    # can give up its slot while waiting. When it resumes, it
+    # takes the slot back without queueing, since it was
+    # already admitted once.
+    def suspend(self, identity_key):
+        self.release(identity_key)
+
+    def resume(self, identity_key):
+        with self.condition:
+            self.active += 1
+            self.active_by_identity[identity_key] = self.active_by_identity.get(identity_key, 0)+1
+
+    def stats(self):
+        with self.condition:
+            if self.waited > 0:
+                average_wait = self.total_wait/self.waited
+            else:
+                average_wait = 0
+
+            return {
+                "active": self.active,
+                "queued": self.queued,
+                "max_queued": self.max_queued_seen,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "waited": self.waited,
+                "average_wait": average_wait,
+                "max_wait": self.max_wait,
+            }
+
+class RequestMetrics:
+    STATIC   = "static"
+    DYNAMIC  = "dynamic"
+    TEMPLATE = "template"
+    FILE     = "file"
+    ACL      = "acl"
+    KINDS    = [STATIC, DYNAMIC, TEMPLATE, FILE, ACL]
+
+    # Upper bounds of the latency histogram buckets in
+    # milliseconds. An extra last bucket counts everything
+    # slower than the largest bound.
+    LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+    # Memory use is fixed, since only the most recently
+    # requested paths are tracked, and identity request
+    # rates are calculated from a ring of recent requests.
+    MAX_PATHS   = 256
+    MAX_EVENTS  = 4096
+    RATE_WINDOW = 10*60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.paths = collections.OrderedDict()
+            self.latency = {kind: [0]*(len(RequestMetrics.LATENCY_BUCKETS)+1) for kind in RequestMetrics.KINDS}
+            self.events = collections.deque(maxlen=RequestMetrics.MAX_EVENTS)
+            self.evicted_paths = 0
+
+    @staticmethod
+    def bucket(duration):
+        return bisect.bisect_left(RequestMetrics.LATENCY_BUCKETS, duration*1000)
+
+    @staticmethod
+    def response_size(response):
+        try:
+            if isinstance(response, bytes):
+                return len(response)
+            elif isinstance(response, list) and len(response) > 0 and hasattr(response[0], "fileno"):
+                return os.fstat(response[0].fileno()).st_size
+        except Exception:
+            pass
+
+        return 0
+
+    # Returns the upper bound in milliseconds of the bucket
+    # containing the given quantile, or None if it falls in
+    # the last bucket, or nothing was recorded.
+    @staticmethod
+    def quantile(histogram, q):
+        total = sum(histogram)
+        if total == 0:
+            return None
+
+        target = q*total
+        seen = 0
+        for index, count in enumerate(histogram):
+            seen += count
+            if seen >= target:
+                if index < len(RequestMetrics.LATENCY_BUCKETS):
+                    return RequestMetrics.LATENCY_BUCKETS[index]
+                else:
+                    return None
+
+        return None
+
+    def path_entry(self, path):
+        if path in self.paths:
+            self.paths.move_to_end(path)
+        else:
+            self.paths[path] = {
+                "requests": 0, "errors": 0, "rejected": 0, "bytes": 0, "time": 0.0,
+                "kind": None, "latency": [0]*(len(RequestMetrics.LATENCY_BUCKETS)+1),
+            }
+            while len(self.paths) > RequestMetrics.MAX_PATHS:
+                self.paths.popitem(last=False)
+                self.evicted_paths += 1
+
+        return self.paths[path]
+
+    def record(self, path, kind, duration, response, remote_identity, acl_time=None):
+        size = RequestMetrics.response_size(response)
+        bucket = RequestMetrics.bucket(duration)
+        if remote_identity != None:
+            identity_hash = remote_identity.hash
+        else:
+            identity_hash = None
+
+        with self.lock:
+            entry = self.path_entry(path)
+            entry["requests"] += 1
+            entry["bytes"] += size
+            entry["time"] += duration
+            entry["kind"] = kind
+            entry["latency"][bucket] += 1
+            if response == None:
+                entry["errors"] += 1
+
+            self.latency[kind][bucket] += 1
+            if acl_time != None:
+                self.latency[RequestMetrics.ACL][RequestMetrics.bucket(acl_time)] += 1
+
+            self.events.append((time.time(), identity_hash))
+
+    def record_rejected(self, path):
+        with self.lock:
+            self.path_entry(path)["rejected"] += 1
+
+    def identity_rates(self, window=RATE_WINDOW):
+        now = time.time()
+        counts = {}
+        with self.lock:
+            for timestamp, identity_hash in reversed(self.events):
+                if timestamp < now-window:
+                    break
+                counts[identity_hash] = counts.get(identity_hash, 0)+1
+
+            window = min(window, max(1, now-self.started))
+
+        rates = [(identity_hash, count, count/(window/60)) for identity_hash, count in counts.items()]
+        rates.sort(key=lambda e: e[1], reverse=True)
+        return rates
+
+    def snapshot(self):
+        identities = []
+        for identity_hash, count, rate in self.identity_rates():
+            if identity_hash == None:
+                identity_str = "anonymous"
+            else:
+                identity_str = RNS.hexrep(identity_hash, delimit=False)
+            identities.append({"identity": identity_str, "requests": count, "per_minute": round(rate, 2)})
+
+        with self.lock:
+            paths = {}
+            for path, entry in self.paths.items():
+                paths[path] = dict(entry)
+                paths[path]["latency"] = list(entry["latency"])
+                paths[path]["p50_ms"] = RequestMetrics.quantile(entry["latency"], 0.5)
+                paths[path]["p95_ms"] = RequestMetrics.quantile(entry["latency"], 0.95)
+
+            return {
+                "started": self.started,
+                "updated": time.time(),
+                "buckets_ms": list(RequestMetrics.LATENCY_BUCKETS),
+                "latency": {kind: list(self.latency[kind]) for kind in self.latency},
+                "paths": paths,
+                "evicted_paths": self.evicted_paths,
+                "identities": identities,
+                "rate_window": RequestMetrics.RATE_WINDOW,
+            }
+
+    def hot_paths(self, count=10):
+        snapshot = self.snapshot()
+        paths = sorted(snapshot["paths"].items(), key=lambda e: e[1]["time"], reverse=True)
+        return paths[:count]
+
+    def micron(self):
+        snapshot = self.snapshot()
+
+        def latency_str(value):
+            if value == None:
+                return ">"+str(RequestMetrics.LATENCY_BUCKETS[-1])+"ms"
+            else:
+                return "<"+str(value)+"ms"
+
+        lines = ["#!c=0", ">Node Metrics", ""]
+        lines.append("Collected since "+time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["started"])))
+        lines.append("")
+        lines.append(">>Latency")
+        lines.append("`!{:<10}{:>10}{:>10}{:>10}`!".format("Kind", "Requests", "p50", "p95"))
+        for kind in RequestMetrics.KINDS:
+            histogram = snapshot["latency"][kind]
+            if sum(histogram) > 0:
+                lines.append("{:<10}{:>10}{:>10}{:>10}".format(kind, sum(histogram),
+                    latency_str(RequestMetrics.quantile(histogram, 0.5)), latency_str(RequestMetrics.quantile(histogram, 0.95))))
+
+        lines.append("")
+        lines.append(">>Paths")
+        lines.append("`!{:<40}{:>10}{:>8}{:>8}{:>12}{:>10}{:>10}`!".format("Path", "Requests", "Errors", "Busy", "Bytes", "p50", "p95"))
+        paths = sorted(snapshot["paths"].items(), key=lambda e: e[1]["time"], reverse=True)
+        for path, entry in paths:
+            lines.append("{:<40}{:>10}{:>8}{:>8}{:>12}{:>10}{:>10}".format(path[:39], entry["requests"], entry["errors"], entry["rejected"],
+                entry["bytes"], latency_str(entry["p50_ms"]), latency_str(entry["p95_ms"])).replace("`", "\\`"))
+
+        lines.append("")
+        lines.append(">>Identities")
+        lines.append("Requests per identity in the last "+str(RequestMetrics.RATE_WINDOW//60)+" minutes")
+        lines.append("")
+        lines.append("`!{:<34}{:>10}{:>12}`!".format("Identity", "Requests", "Per Minute"))
+        for entry in snapshot["identities"]:
+            lines.append("{:<34}{:>10}{:>12}".format(entry["identity"], entry["requests"], entry["per_minute"]))
+
+        return "\n".join(lines)+"\n"
+
+    def export(self, json_path, micron_path):
+        try:
+            for export_path, content in [(json_path, json.dumps(self.snapshot(), indent=2)), (micron_path, self.micron())]:
+                tmp_path = export_path+".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as fh:
+                    fh.write(content)
+                os.replace(tmp_path, export_path)
+
+            return True
+
+        except Exception as e:
+            RNS.log("Could not export node metrics: "+str(e), RNS.LOG_ERROR)
+            return False
+
+class RateLimiter:
+    MAX_ENTRIES = 4096
+
+    # Rules are (prefix, requests per minute, burst) tuples,
+    # and each path is limited by the rule with the longest
+    # matching prefix. Buckets are kept per rule and client
+    # key, and the least recently used buckets are dropped
+    # when the table is full, which at worst gives a client
+    # a fresh bucket.
+    def __init__(self, rules, max_entries=MAX_ENTRIES):
+        self.rules = sorted(rules, key=lambda r: len(r[0]), reverse=True)
+        self.max_entries = max_entries
+        self.buckets = collections.OrderedDict()
+        self.path_rules = {}
+        self.lock = threading.Lock()
+        self.limited = 0
+        self.evicted = 0
+
+    def rule(self, path):
+        if path in self.path_rules:
+            return self.path_rules[path]
+
+        matched = None
+        for rule in self.rules:
+            prefix = rule[0].rstrip("/")
+            if path == prefix or path.startswith(prefix+"/"):
+                matched = rule
+                break
+
+        if len(self.path_rules) >= self.max_entries:
+            self.path_rules.clear()
+        self.path_rules[path] = matched
+
+        return matched
+
+    def allow(self, path, key):
+        with self.lock:
+            rule = self.rule(path)
+            if rule == None:
+                return True
+
+            prefix, rate, burst = rule
+            now = time.time()
+            bucket_key = (prefix, key)
+            bucket = self.buckets.get(bucket_key, None)
+            if bucket == None:
+                bucket = [burst, now]
+                self.buckets[bucket_key] = bucket
+                if len(self.buckets) > self.max_entries:
+                    self.buckets.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self.buckets.move_to_end(bucket_key)
+                bucket[0] = min(burst, bucket[0]+(now-bucket[1])*rate/60)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+            else:
+                self.limited += 1
+                return False
+
+    def stats(self):
+        with self.lock:
+            return {"rules": len(self.rules), "buckets": len(self.buckets), "limited": self.limited, "evicted": self.evicted}
+
+def scan_directory(dir_path, ignored_suffixes=()):
+    files = {}
+    directories = set()
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.name[:1] == ".":
+                continue
+
+            try:
+                if entry.is_dir():
+                    directories.add(entry.name)
+                elif entry.is_file() and not entry.name.endswith(ignored_suffixes):
+                    st = entry.stat()
+                    files[entry.name] = (st.st_size, st.st_mtime_ns, st.st_mode & 0o111 != 0)
+
+            except OSError as e:
+                RNS.log("Could not stat "+str(entry.path)+": "+str(e), RNS.LOG_DEBUG)
+
+    return files, directories
+
+def walk_content(base_path, ignored_suffixes=()):
+    manifest = []
+    pending = [base_path.rstrip("/")]
+    while len(pending) > 0:
+        dir_path = pending.pop()
+        files, directories = scan_directory(dir_path, tuple(ignored_suffixes))
+        for name in files:
+            size, mtime, executable = files[name]
+            manifest.append((dir_path+"/"+name, size, mtime, executable))
+
+        for name in directories:
+            pending.append(dir_path+"/"+name)
+
+    return manifest
+
+class ContentRegistry:
+    # Directories modified within this many seconds of
+    # being scanned are scanned again on the next refresh,
+    # since further changes within the same timestamp
+    # granularity would not be visible in their mtime.
+    MTIME_RESOLUTION = 2
+
+    def __init__(self, base_path, ignored_suffixes=()):
+        self.base_path = base_path.rstrip("/")
+        self.ignored_suffixes = tuple(ignored_suffixes)
+        self.directories = {}
+        self.files = set()
+        self.total_size = 0
+        self.lock = threading.Lock()
+
+    def request_path(self, prefix, file_path):
+        return prefix+file_path[len(self.base_path):]
+
+    def manifest(self):
+        with self.lock:
+            manifest = []
+            for dir_path in self.directories:
+                files = self.directories[dir_path][1]
+                for name in files:
+                    size, mtime, executable = files[name]
+                    manifest.append((dir_path+"/"+name, size, mtime, executable))
+
+            return manifest
+
+    # Refreshing only re-lists directories whose mtime has
+    # changed since the last refresh, so the cost of a refresh
+    # is one stat per directory, plus the actual changes.
+    def refresh(self):
+        with self.lock:
+            added = []
+            removed = []
+            visited = set()
+            pending = [self.base_path]
+            now = time.time()
+
+            while len(pending) > 0:
+                dir_path = pending.pop()
+                try:
+                    mtime = os.stat(dir_path).st_mtime_ns
+                except OSError:
+                    continue
+
+                visited.add(dir_path)
+                cached = self.directories.get(dir_path, None)
+                if cached != None and cached[0] != None and cached[0] == mtime:
+                    directories = cached[2]
+                else:
+                    try:
+                        files, directories = scan_directory(dir_path, self.ignored_suffixes)
+                    except OSError as e:
+                        RNS.log("Could not scan directory "+str(dir_path)+": "+str(e), RNS.LOG_ERROR)
+                        visited.discard(dir_path)
+                        continue
+
+                    if cached != None:
+                        previous_files = cached[1]
+                    else:
+                        previous_files = {}
+
+                    added.extend(dir_path+"/"+name for name in files if not name in previous_files)
+                    removed.extend(dir_path+"/"+name for name in previous_files if not name in files)
+                    self.total_size += sum(e[0] for e in files.values())-sum(e[0] for e in previous_files.values())
+
+                    if now-mtime/1e9 < ContentRegistry.MTIME_RESOLUTION:
+                        mtime = None
+                    self.directories[dir_path] = (mtime, files, directories)
+
+                for name in directories:
+                    pending.append(dir_path+"/"+name)
+
+            for dir_path in list(self.directories.keys()):
+                if not dir_path in visited:
+                    files = self.directories.pop(dir_path)[1]
+                    removed.extend(dir_path+"/"+name for name in files)
+                    self.total_size -= sum(e[0] for e in files.values())
+
+            self.files.difference_update(removed)
+            self.files.update(added)
+
+            return added, removed
+
+class FileManifest:
+    HASH_CHUNK_SIZE = 1024*1024
+
+    def __init__(self, registry, storage_path):
+        self.registry = registry
+        self.storage_path = storage_path
+        self.entries = {}
+        self.updated = None
+        self.lock = threading.Lock()
+        self.updating = False
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.storage_path):
+            try:
+                fh = open(self.storage_path, "rb")
+                stored = msgpack.unpackb(fh.read())
+                fh.close()
+                self.entries = {e: tuple(stored["entries"][e]) for e in stored["entries"]}
+                self.updated = stored["updated"]
+
+            except Exception as e:
+                RNS.log("Could not load file manifest from "+str(self.storage_path)+": "+str(e), RNS.LOG_ERROR)
+                self.entries = {}
+
+    def save(self):
+        try:
+            with self.lock:
+                packed = msgpack.packb({"entries": self.entries, "updated": self.updated})
+
+            tmp_path = self.storage_path+".tmp"
+            with open(tmp_path, "wb") as fh:
+                fh.write(packed)
+            os.replace(tmp_path, self.storage_path)
+
+        except Exception as e:
+            RNS.log("Could not save file manifest to "+str(self.storage_path)+": "+str(e), RNS.LOG_ERROR)
+
+    def start_update(self):
+        with self.lock:
+            if self.updating:
+                return
+            self.updating = True
+
+        update_thread = threading.Thread(target=self.update, daemon=True)
+        update_thread.start()
+
+    # Files are only hashed again when their size or
+    # mtime has changed since they were last hashed, so
+    # updating the manifest is cheap once it has been
+    # built for the first time.
+    def update(self):
+        try:
+            changed = False
+            present = set()
+            for file_path in sorted(self.registry.files.copy()):
+                name = self.registry.request_path("", file_path).lstrip("/")
+                try:
+                    st = os.stat(file_path)
+                    present.add(name)
+                    with self.lock:
+                        entry = self.entries.get(name, None)
+                    if entry != None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                        continue
+
+                    file_hash = hashlib.sha256()
+                    with open(file_path, "rb") as fh:
+                        while True:
+                            chunk = fh.read(FileManifest.HASH_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            file_hash.update(chunk)
+
+                    with self.lock:
+                        self.entries[name] = (st.st_size, st.st_mtime_ns, file_hash.digest())
+                    changed = True
+
+                except OSError as e:
+                    RNS.log("Could not hash "+str(file_path)+" for file manifest: "+str(e), RNS.LOG_DEBUG)
+
+            with self.lock:
+                for name in list(self.entries.keys()):
+                    if not name in present:
+                        self.entries.pop(name)
+                        changed = True
+
+            if changed or self.updated == None:
+                self.updated = time.time()
+                self.save()
+                RNS.log("File manifest updated, "+str(len(self.entries))+" files hashed", RNS.LOG_DEBUG)
+
+        except Exception as e:
+            RNS.log("Error while updating file manifest: "+str(e), RNS.LOG_ERROR)
+
+        finally:
+            with self.lock:
+                self.updating = False
+
+    # If a request path is given, only the entry for that
+    # file is included in the response.
+    def response(self, request_path=None):
+        with self.lock:
+            if request_path != None:
+                names = [request_path.replace("/file/", "", 1)] if request_path.startswith("/file/") else []
+                names = [name for name in names if name in self.entries]
+            else:
+                names = self.entries
+
+            return {
+                "updated": self.updated,
+                "files": {name: [self.entries[name][0], self.entries[name][2]] for name in names},
+            }
+
+class VariantStore:
+    SUFFIX = ".bz2"
+    CHUNK_SIZE = 1024*1024
+    MIN_SIZE = 1024
+    INDEX_NAME = "index"
+
+    def __init__(self, storage_path):
+        self.storage_path = storage_path
+        self.index_path = self.storage_path+"/"+VariantStore.INDEX_NAME
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.updating = False
+        self.update_again = False
+        self.sources = None
+        self.version = 0
+
+        if not os.path.isdir(self.storage_path):
+            os.makedirs(self.storage_path)
+
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.index_path):
+            try:
+                fh = open(self.index_path, "rb")
+                stored = msgpack.unpackb(fh.read())
+                fh.close()
+                self.entries = {e: tuple(stored[e]) for e in stored}
+
+            except Exception as e:
+                RNS.log("Could not load compressed variant index from "+str(self.index_path)+": "+str(e), RNS.LOG_ERROR)
+                self.entries = {}
+
+    def save(self):
+        try:
+            with self.lock:
+                packed = msgpack.packb(self.entries)
+
+            tmp_path = self.index_path+".tmp"
+            with open(tmp_path, "wb") as fh:
+                fh.write(packed)
+            os.replace(tmp_path, self.index_path)
+
+        except Exception as e:
+            RNS.log("Could not save compressed variant index to "+str(self.index_path)+": "+str(e), RNS.LOG_ERROR)
+
+    def variant_path(self, request_path):
+        return self.storage_path+"/"+hashlib.sha256(request_path.encode("utf-8")).hexdigest()+VariantStore.SUFFIX
+
+    # The sources argument is a callable returning a list
+    # of (request path, file path) tuples. If an update is
+    # requested while one is running, another pass is made
+    # once it completes, so no changes are missed.
+    def start_update(self, sources):
+        with self.lock:
+            self.sources = sources
+            if self.updating:
+                self.update_again = True
+                return
+            self.updating = True
+
+        update_thread = threading.Thread(target=self.update, daemon=True)
+        update_thread.start()
+
+    # Variants are only built again when the size or mtime
+    # of the source has changed. Sources that do not shrink
+    # when compressed are recorded without a variant, so they
+    # are not compressed again on every update.
+    def update(self):
+        try:
+            while True:
+                with self.lock:
+                    sources = self.sources
+                    self.update_again = False
+
+                changed = False
+                present = set()
+                for request_path, file_path in sources():
+                    try:
+                        st = os.stat(file_path)
+                        present.add(request_path)
+                        with self.lock:
+                            entry = self.entries.get(request_path, None)
+                        if entry != None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                            continue
+
+                        variant_size = None
+                        variant_path = self.variant_path(request_path)
+                        if st.st_size >= VariantStore.MIN_SIZE:
+                            variant_size = self.compress(file_path, variant_path, st.st_size)
+
+                        if variant_size == None and os.path.isfile(variant_path):
+                            os.unlink(variant_path)
+
+                        with self.lock:
+                            self.entries[request_path] = (st.st_size, st.st_mtime_ns, variant_size)
+                        changed = True
+
+                    except OSError as e:
+                        RNS.log("Could not build compressed variant of "+str(file_path)+": "+str(e), RNS.LOG_DEBUG)
+
+                with self.lock:
+                    for request_path in list(self.entries.keys()):
+                        if not request_path in present:
+                            self.entries.pop(request_path)
+                            try: os.unlink(self.variant_path(request_path))
+                            except OSError: pass
+                            changed = True
+
+                if changed:
+                    with self.lock:
+                        self.version += 1
+                    self.save()
+                    RNS.log("Compressed variants updated, "+str(len(self.index()))+" of "+str(len(self.entries))+" sources compressed", RNS.LOG_DEBUG)
+
+                with self.lock:
+                    if not self.update_again:
+                        self.updating = False
+                        break
+
+        except Exception as e:
+            RNS.log("Error while updating compressed variants: "+str(e), RNS.LOG_ERROR)
+            with self.lock:
+                self.updating = False
+
+    def compress(self, file_path, variant_path, size):
+        tmp_path = variant_path+".tmp"
+        compressor = bz2.BZ2Compressor()
+        try:
+            with open(file_path, "rb") as source, open(tmp_path, "wb") as variant:
+                while True:
+                    chunk = source.read(VariantStore.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    variant.write(compressor.compress(chunk))
+                variant.write(compressor.flush())
+                variant_size = variant.tell()
+
+        except OSError:
+            if os.path.isfile(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        if variant_size < size:
+            os.replace(tmp_path, variant_path)
+            return variant_size
+        else:
+            os.unlink(tmp_path)
+            return None
+
+    # Returns the path and size of the compressed variant
+    # for a request path, but only if it was built from the
+    # current version of the source file.
+    def get(self, request_path, file_path):
+        with self.lock:
+            entry = self.entries.get(request_path, None)
+
+        if entry == None or entry[2] == None:
+            return None
+
+        try:
+            st = os.stat(file_path)
+            if entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+                return None
+        except OSError:
+            return None
+
+        return self.variant_path(request_path), entry[2]
+
+    def index(self):
+        with self.lock:
+            return {e: self.entries[e][2] for e in self.entries if self.entries[e][2] != None}
+
+    def versioned_index(self):
+        with self.lock:
+            return self.version, {e: self.entries[e][2] for e in self.entries if self.entries[e][2] != None}
 
 class Node:
-    JOB_INTERVAL = 5
     START_ANNOUNCE_DELAY = 6
+    SPOOL_PREFIX = "spool_"
+    LINK_RATE_KEY = "links"
+    TEMPLATE_SUFFIX = ".mut"
+    SPOOL_MAX_AGE = 60*60
+    SPOOL_MAX_SIZE = 64*1024*1024
+    SPOOL_CLEAN_INTERVAL = 10*60
+    STATS_LOG_INTERVAL = 30*60
+    CONTINUATION_TIMEOUT = 10*60
+    MAX_CONTINUATIONS = 1024
+    MANIFEST_ACL_CACHE_TIME = 5*60
+    MANIFEST_ACL_ENTRIES = 256
+    MANIFEST_PATH = "/file/.manifest"
+    PAGE_VARIANT_PATH = "/page/.bz2"
+    FILE_VARIANT_PATH = "/file/.bz2"
 
     def __init__(self, app):
         RNS.log("Nomad Network Node starting...", RNS.LOG_VERBOSE)
@@ -17,19 +1375,85 @@ class Node:
         self.identity = self.app.identity
         self.destination = RNS.Destination(self.identity, RNS.Destination.IN, RNS.Destination.SINGLE, "nomadnetwork", "node")
         self.last_announce = time.time()
-        self.last_file_refresh = time.time()
-        self.last_page_refresh = time.time()
         self.announce_interval = self.app.node_announce_interval
         self.page_refresh_interval = self.app.page_refresh_interval
         self.file_refresh_interval = self.app.file_refresh_interval
-        self.job_interval = Node.JOB_INTERVAL
-        self.should_run_jobs = True
         self.app_data = None
         self.name = self.app.node_name
+        self.page_cache = PageCache(self.app.page_cache_size)
+        self.metrics = RequestMetrics()
+        self.metrics_export_interval = self.app.metrics_export_interval
+        self.access_control = AccessControl(self.app.pagespath)
+
+        if self.app.template_pages:
+            self.templates = TemplateCache(self.app.pagespath)
+        else:
+            self.templates = None
+
+        if self.app.dynamic_page_cache:
+            if self.app.page_timeout > 0:
+                self.response_cache = ResponseCache(wait_timeout=self.app.page_timeout)
+            else:
+                self.response_cache = ResponseCache()
+        else:
+            self.response_cache = None
+
+        self.rate_limiter = RateLimiter(self.app.rate_limits)
+        if self.app.max_links_per_minute > 0:
+            link_burst = max(1, int(self.app.max_links_per_minute))
+            self.link_rate_limiter = RateLimiter([(Node.LINK_RATE_KEY, self.app.max_links_per_minute, link_burst)])
+        else:
+            self.link_rate_limiter = None
+
+        self.request_limiter = RequestLimiter(
+            self.app.max_active_requests, self.app.max_active_requests_per_identity,
+            self.app.max_queued_requests, self.app.request_queue_timeout)
+
+        self.continuations = collections.OrderedDict()
+        self.continuations_lock = threading.Lock()
+
+        self.manifest_acl = collections.OrderedDict()
+        self.manifest_acl_version = None
+        self.manifest_acl_lock = threading.Lock()
+
+        self.worker_pools = {}
+        for worker_page in self.app.worker_pages:
+            script_path = self.app.pagespath+"/"+worker_page.strip("/")
+            self.worker_pools[script_path] = PageWorkerPool(script_path, self.app.worker_concurrency)
+
+        self.page_registry = ContentRegistry(self.app.pagespath, ignored_suffixes=[AccessControl.SUFFIX])
+        self.file_registry = ContentRegistry(self.app.filespath)
+        self.file_manifest = FileManifest(self.file_registry, self.app.storagepath+"/filemanifest")
+
+        if self.app.precompress_content:
+            self.variants = VariantStore(self.app.storagepath+"/variants")
+        else:
+            self.variants = None
 
         self.register_pages()
         self.register_files()
 
+        self.destination.register_request_handler(
+            Node.MANIFEST_PATH,
+            response_generator = self.serve_manifest,
+            allow = RNS.Destination.ALLOW_ALL)
+
+        # Compressed variants are sent as they are, so they
+        # are served from separate paths with compression
+        # disabled, instead of being compressed again.
+        if self.variants != None:
+            self.destination.register_request_handler(
+                Node.PAGE_VARIANT_PATH,
+                response_generator = self.serve_page_variant,
+                allow = RNS.Destination.ALLOW_ALL,
+                auto_compress = False)
+
+            self.destination.register_request_handler(
+                Node.FILE_VARIANT_PATH,
+                response_generator = self.serve_file_variant,
+                allow = RNS.Destination.ALLOW_ALL,
+                auto_compress = False)
+
         self.destination.set_link_established_callback(self.peer_connected)
 
         if self.name == None:
@@ -38,219 +1462,632 @@ class Node:
         RNS.log("Node \""+self.name+"\" ready for incoming connections on "+RNS.prettyhexrep(self.destination.hash), RNS.LOG_VERBOSE)
 
         if self.app.node_announce_at_start:
-            def delayed_announce():
-                time.sleep(Node.START_ANNOUNCE_DELAY)
-                self.announce()
+            first_announce = Node.START_ANNOUNCE_DELAY
+        else:
+            first_announce = self.announce_interval*60
 
-            da_thread = threading.Thread(target=delayed_announce)
-            da_thread.setDaemon(True)
-            da_thread.start()
+        scheduler = self.app.announce_scheduler
+        scheduler.register("node", self.announce_node, interval=self.announce_interval*60, delay=first_announce)
+        scheduler.register("propagation", self.announce_propagation_node, interval=self.announce_interval*60, delay=first_announce)
 
-        job_thread = threading.Thread(target=self.__jobs)
-        job_thread.setDaemon(True)
-        job_thread.start()
+        self.schedule_jobs()
 
 
     def register_pages(self):
-        # TODO: Deregister previously registered pages
-        # that no longer exist.
-        self.servedpages = []
-        self.scan_pages(self.app.pagespath)
+        added, removed = self.page_registry.refresh()
 
-        if not self.app.pagespath+"index.mu" in self.servedpages:
-            self.destination.register_request_handler(
-                "/page/index.mu",
-                response_generator = self.serve_default_index,
-                allow = RNS.Destination.ALLOW_ALL)
+        for page in removed:
+            request_path = self.page_registry.request_path("/page", page)
+            self.destination.deregister_request_handler(request_path)
+            self.page_cache.remove(page)
 
-        for page in self.servedpages:
-            request_path = "/page"+page.replace(self.app.pagespath, "")
+        for page in added:
+            request_path = self.page_registry.request_path("/page", page)
             self.destination.register_request_handler(
                 request_path,
                 response_generator = self.serve_page,
                 allow = RNS.Destination.ALLOW_ALL)
 
+        if not self.page_registry.base_path+"/index.mu" in self.page_registry.files:
+            self.destination.register_request_handler(
+                "/page/index.mu",
+                response_generator = self.serve_default_index,
+                allow = RNS.Destination.ALLOW_ALL)
+
+        if len(added) > 0 or len(removed) > 0:
+            RNS.log("Page refresh added "+str(len(added))+" and removed "+str(len(removed))+" pages", RNS.LOG_DEBUG)
+
+        if self.variants != None:
+            self.variants.start_update(self.variant_sources)
+
     def register_files(self):
-        # TODO: Deregister previously registered files
-        # that no longer exist.
-        self.servedfiles = []
-        self.scan_files(self.app.filespath)
+        added, removed = self.file_registry.refresh()
 
-        for file in self.servedfiles:
-            request_path = "/file"+file.replace(self.app.filespath, "")
+        for file in removed:
+            request_path = self.file_registry.request_path("/file", file)
+            self.destination.deregister_request_handler(request_path)
+
+        for file in added:
+            request_path = self.file_registry.request_path("/file", file)
             self.destination.register_request_handler(
                 request_path,
                 response_generator = self.serve_file,
                 allow = RNS.Destination.ALLOW_ALL,
                 auto_compress = 32_000_000)
 
-    def scan_pages(self, base_path):
-        files = [file for file in os.listdir(base_path) if os.path.isfile(os.path.join(base_path, file)) and file[:1] != "."]
-        directories = [file for file in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, file)) and file[:1] != "."]
+        if len(added) > 0 or len(removed) > 0:
+            RNS.log("File refresh added "+str(len(added))+" and removed "+str(len(removed))+" files", RNS.LOG_DEBUG)
 
-        for file in files:
-            if not file.endswith(".allowed"):
-                self.servedpages.append(base_path+"/"+file)
+        self.file_manifest.start_update()
+        if self.variants != None:
+            self.variants.start_update(self.variant_sources)
 
-        for directory in directories:
-            self.scan_pages(base_path+"/"+directory)
+    # Compressed variants are built for all static pages and
+    # hosted files. Executable pages generate new output for
+    # every request, so they are always compressed on demand.
+    def variant_sources(self):
+        sources = []
+        for file_path, size, mtime, executable in self.page_registry.manifest():
+            if not executable and not file_path in self.worker_pools and not self.is_template(file_path):
+                sources.append((self.page_registry.request_path("/page", file_path), file_path))
 
-    def scan_files(self, base_path):
-        files = [file for file in os.listdir(base_path) if os.path.isfile(os.path.join(base_path, file)) and file[:1] != "."]
-        directories = [file for file in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, file)) and file[:1] != "."]
+        for file_path, size, mtime, executable in self.file_registry.manifest():
+            sources.append((self.file_registry.request_path("/file", file_path), file_path))
 
-        for file in files:
-            self.servedfiles.append(base_path+"/"+file)
+        return sources
 
-        for directory in directories:
-            self.scan_files(base_path+"/"+directory)
+    # Requests for compressed variants carry the path of the
+    # requested page or file in the request data, which must
+    # be one that the node is currently serving.
+    def variant_request_path(self, data, prefix, registry):
+        if not isinstance(data, dict) or not isinstance(data.get("path", None), str):
+            return None
 
-    def serve_page(self, path, data, request_id, link_id, remote_identity, requested_at):
-        RNS.log("Page request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
-        try:
-            self.app.peer_settings["served_page_requests"] += 1
-            self.app.save_peer_settings()
-            
-        except Exception as e:
-            RNS.log("Could not increase served page request count", RNS.LOG_ERROR)
+        path = data["path"]
+        if not path.startswith(prefix+"/"):
+            return None
 
-        file_path = path.replace("/page", self.app.pagespath, 1)
+        if not registry.base_path+path[len(prefix):] in registry.files:
+            return None
 
-        allowed_path = file_path+".allowed"
-        request_allowed = False
+        return path
 
-        if os.path.isfile(allowed_path):
-            allowed_list = []
+    def request_identity_key(self, link_id, remote_identity):
+        if remote_identity != None:
+            return remote_identity.hash
+        else:
+            return link_id
 
-            try:
-                if os.access(allowed_path, os.X_OK):
-                    allowed_result = subprocess.run([allowed_path], stdout=subprocess.PIPE)
-                    allowed_input = allowed_result.stdout
+    def is_template(self, file_path):
+        return self.templates != None and file_path.endswith(Node.TEMPLATE_SUFFIX)
 
-                else:
-                    fh = open(allowed_path, "rb")
-                    allowed_input = fh.read()
-                    fh.close()
+    # The variables available to dynamic pages and templates,
+    # which are the link and identity of the requester, and
+    # any fields and variables sent with the request.
+    def request_variables(self, data, link_id, remote_identity):
+        variables = {}
+        if link_id != None:
+            variables["link_id"] = RNS.hexrep(link_id, delimit=False)
+        if remote_identity != None:
+            variables["remote_identity"] = RNS.hexrep(remote_identity.hash, delimit=False)
 
-                allowed_hash_strs = allowed_input.splitlines()
+        if data != None and isinstance(data, dict):
+            for e in data:
+                if isinstance(e, str) and (e.startswith("field_") or e.startswith("var_")):
+                    variables[e] = data[e]
 
-                for hash_str in allowed_hash_strs:
-                    if len(hash_str) == RNS.Identity.TRUNCATED_HASHLENGTH//8*2:
-                        try:
-                            allowed_hash = bytes.fromhex(hash_str.decode("utf-8"))
-                            allowed_list.append(allowed_hash)
+        return variables
 
-                        except Exception as e:
-                            RNS.log("Could not decode RNS Identity hash from: "+str(hash_str), RNS.LOG_DEBUG)
-                            RNS.log("The contained exception was: "+str(e), RNS.LOG_DEBUG)
+    # All requests pass through admission control, which
+    # checks the rate limit for the path, and then waits for
+    # a slot in the request limiter. The handler is only run
+    # if the request was admitted, otherwise a page telling
+    # the client why it was rejected is returned. Requests
+    # that continue an admitted transfer are not charged
+    # against the rate limit.
+    def admit(self, kind, path, request_id, link_id, remote_identity, handler, charge=True):
+        identity_key = self.request_identity_key(link_id, remote_identity)
+        if charge and not self.rate_limiter.allow(path, identity_key):
+            RNS.log("Rate limit exceeded, rejecting "+kind+" request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
+            self.metrics.record_rejected(path)
+            return DEFAULT_RATELIMITED.encode("utf-8")
 
-            except Exception as e:
-                RNS.log("Error while fetching list of allowed identities for request: "+str(e), RNS.LOG_ERROR)
+        if not self.request_limiter.acquire(identity_key):
+            RNS.log("Node is busy, rejecting "+kind+" request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
+            self.metrics.record_rejected(path)
+            return DEFAULT_BUSY.encode("utf-8")
 
-            if hasattr(remote_identity, "hash") and remote_identity.hash in allowed_list:
-                request_allowed = True
-            else:
-                request_allowed = False
-                RNS.log("Denying request, remote identity was not in list of allowed identities", RNS.LOG_VERBOSE)
+        try:
+            return handler()
+        finally:
+            self.request_limiter.release(identity_key)
 
-        else:
-            request_allowed = True
+    def serve_page(self, path, data, request_id, link_id, remote_identity, requested_at):
+        return self.admit("page", path, request_id, link_id, remote_identity,
+            lambda: self.handle_page_request(path, data, request_id, link_id, remote_identity, requested_at))
+
+    def serve_page_variant(self, path, data, request_id, link_id, remote_identity, requested_at):
+        page_path = self.variant_request_path(data, "/page", self.page_registry)
+        if page_path == None:
+            RNS.log("Invalid compressed page request "+RNS.prettyhexrep(request_id), RNS.LOG_DEBUG)
+            return None
+
+        return self.admit("page", page_path, request_id, link_id, remote_identity,
+            lambda: self.handle_page_request(page_path, data, request_id, link_id, remote_identity, requested_at, variant=True))
+
+    def handle_page_request(self, path, data, request_id, link_id, remote_identity, requested_at, variant=False):
+        RNS.log("Page request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
+        try:
+            self.app.peer_settings["served_page_requests"] += 1
+            self.app.save_peer_settings(deferred=True)
+            
+        except Exception as e:
+            RNS.log("Could not increase served page request count", RNS.LOG_ERROR)
+
+        started = time.time()
+        kind = RequestMetrics.STATIC
+        response = None
+        file_path = path.replace("/page", self.app.pagespath, 1)
+        identity_key = self.request_identity_key(link_id, remote_identity)
+
+        request_allowed = self.access_control.is_allowed(file_path, remote_identity)
+        acl_time = time.time()-started
+        if not request_allowed:
+            RNS.log("Denying request, remote identity was not in list of allowed identities", RNS.LOG_VERBOSE)
 
         try:
             if request_allowed:
                 RNS.log("Serving page: "+file_path, RNS.LOG_VERBOSE)
-                if not RNS.vendor.platformutils.is_windows() and os.access(file_path, os.X_OK):
+                if self.is_template(file_path):
+                    kind = RequestMetrics.TEMPLATE
+                    variables = self.request_variables(data, link_id, remote_identity)
+                    render = lambda: self.templates.render(file_path, variables).encode("utf-8")
+                    if self.response_cache != None:
+                        response = self.response_cache.fetch(file_path, variables, render, self.request_limiter, identity_key)
+                    else:
+                        response = render()
+
+                elif not RNS.vendor.platformutils.is_windows() and os.access(file_path, os.X_OK):
+                    kind = RequestMetrics.DYNAMIC
                     env_map = {}
                     if "PATH" in os.environ:
                         env_map["PATH"] = os.environ["PATH"]
-                    if link_id != None:
-                        env_map["link_id"] = RNS.hexrep(link_id, delimit=False)
-                    if remote_identity != None:
-                        env_map["remote_identity"] = RNS.hexrep(remote_identity.hash, delimit=False)
-
-                    if data != None and isinstance(data, dict):
-                        for e in data:
-                            if isinstance(e, str) and (e.startswith("field_") or e.startswith("var_")):
-                                env_map[e] = data[e]
-
-                    generated = subprocess.run([file_path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env_map)
-                    return generated.stdout
+                    env_map.update(self.request_variables(data, link_id, remote_identity))
+
+                    if self.response_cache != None:
+                        response = self.response_cache.fetch(
+                            file_path, env_map, lambda: self.execute_page(file_path, env_map), self.request_limiter, identity_key)
+                    else:
+                        response = self.execute_page(file_path, env_map)
+
+                    # Large output is spooled to disk, and sent as a
+                    # file resource if the client supports it.
+                    if isinstance(response, io.BufferedReader):
+                        if isinstance(data, dict) and data.get("file_response", False) == True:
+                            response = [response, {"name": os.path.basename(file_path).encode("utf-8")}]
+                        else:
+                            spooled = response
+                            response = spooled.read()
+                            spooled.close()
                 else:
-                    fh = open(file_path, "rb")
-                    response_data = fh.read()
-                    fh.close()
-                    return response_data
+                    compressed = None
+                    if variant and self.variants != None:
+                        compressed = self.variants.get(path, file_path)
+
+                    if compressed != None:
+                        RNS.log("Sending compressed variant of page: "+file_path, RNS.LOG_DEBUG)
+                        metadata = {"name": os.path.basename(file_path).encode("utf-8"), "encoding": "bz2", "decompressed_size": os.path.getsize(file_path)}
+                        response = [open(compressed[0], "rb"), metadata]
+
+                    elif self.app.page_file_threshold > 0 and os.path.getsize(file_path) >= self.app.page_file_threshold:
+                        # Large pages are not kept in the page cache. If the
+                        # client can receive pages as file resources, the
+                        # page is sent directly from disk, without reading
+                        # it into memory first.
+                        if isinstance(data, dict) and data.get("file_response", False) == True:
+                            response = [open(file_path, "rb"), {"name": os.path.basename(file_path).encode("utf-8")}]
+                        else:
+                            fh = open(file_path, "rb")
+                            response = fh.read()
+                            fh.close()
+                    else:
+                        response = self.read_static(file_path)
             else:
                 RNS.log("Request denied", RNS.LOG_VERBOSE)
-                return DEFAULT_NOTALLOWED.encode("utf-8")
+                response = DEFAULT_NOTALLOWED.encode("utf-8")
 
         except Exception as e:
             RNS.log("Error occurred while handling request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_ERROR)
             RNS.log("The contained exception was: "+str(e), RNS.LOG_ERROR)
+
+        self.metrics.record(path, kind, time.time()-started, response, remote_identity, acl_time=acl_time)
+        return response
+
+    # Returns the output of the page as bytes, or as an open
+    # spool file if it was larger than the page file threshold.
+    # Scripts that run for longer than the page timeout, or
+    # produce more than the maximum output, are killed.
+    def execute_page(self, file_path, env_map):
+        output = PageOutput(self.app.tmpfilespath, self.app.page_file_threshold, self.app.max_page_output)
+        timeout = self.app.page_timeout
+
+        if file_path in self.worker_pools:
+            if self.worker_pools[file_path].execute(env_map, output, timeout):
+                return output.result()
+            else:
+                return None
+
+        process = subprocess.Popen([file_path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env_map, start_new_session=True)
+        timer = None
+        timed_out = threading.Event()
+        if timeout > 0:
+            timer = threading.Timer(timeout, self.expire_page, args=[process, timed_out])
+            timer.daemon = True
+            timer.start()
+
+        try:
+            output.read_from(process.stdout)
+            process.wait()
+
+        except Exception as e:
+            RNS.log("Error while reading output of "+str(file_path)+": "+str(e), RNS.LOG_ERROR)
+            self.expire_page(process, None)
+            output.discard()
             return None
 
+        finally:
+            if timer != None:
+                timer.cancel()
+            process.stdout.close()
+
+        if timed_out.is_set():
+            RNS.log("Page "+str(file_path)+" timed out after "+str(timeout)+" seconds and was killed", RNS.LOG_WARNING)
+            output.discard()
+            return None
+
+        return output.result()
+
+    # Pages are started in their own process group, so any
+    # programs started by the page are killed along with it.
+    def expire_page(self, process, timed_out):
+        if timed_out != None:
+            timed_out.set()
+
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except Exception:
+            pass
+
+        try:
+            process.wait()
+        except Exception:
+            pass
+
+    def read_static(self, file_path):
+        if self.page_cache.max_size > 0:
+            return self.page_cache.get(file_path)
+        else:
+            fh = open(file_path, "rb")
+            data = fh.read()
+            fh.close()
+            return data
+
     # TODO: Improve file handling, this will be slow for large files
-    def serve_file(self, path, data, request_id, remote_identity, requested_at):
+    def serve_file(self, path, data, request_id, link_id, remote_identity, requested_at):
+        charge = not self.is_continuation(path, data, link_id, remote_identity, False)
+        return self.admit("file", path, request_id, link_id, remote_identity,
+            lambda: self.handle_file_request(path, data, request_id, link_id, remote_identity, requested_at), charge)
+
+    def serve_file_variant(self, path, data, request_id, link_id, remote_identity, requested_at):
+        file_path = self.variant_request_path(data, "/file", self.file_registry)
+        if file_path == None:
+            RNS.log("Invalid compressed file request "+RNS.prettyhexrep(request_id), RNS.LOG_DEBUG)
+            return None
+
+        charge = not self.is_continuation(file_path, data, link_id, remote_identity, True)
+        return self.admit("file", file_path, request_id, link_id, remote_identity,
+            lambda: self.handle_file_request(file_path, data, request_id, link_id, remote_identity, requested_at, variant=True), charge)
+
+    # When a range of a file is served, and more of the file
+    # remains, the end of the range is remembered, so that a
+    # request for the following range from the same client
+    # is recognised as continuing the same transfer.
+    def expect_continuation(self, path, link_id, remote_identity, variant, offset):
+        key = (self.request_identity_key(link_id, remote_identity), path, variant)
+        with self.continuations_lock:
+            self.continuations[key] = (offset, time.time()+Node.CONTINUATION_TIMEOUT)
+            self.continuations.move_to_end(key)
+            while len(self.continuations) > Node.MAX_CONTINUATIONS:
+                self.continuations.popitem(last=False)
+
+    def is_continuation(self, path, data, link_id, remote_identity, variant):
+        if not isinstance(data, dict) or not "range" in data:
+            return False
+
+        try:
+            start = int(data["range"][0])
+        except Exception:
+            return False
+
+        key = (self.request_identity_key(link_id, remote_identity), path, variant)
+        with self.continuations_lock:
+            expected = self.continuations.pop(key, None)
+
+        return expected != None and start > 0 and expected[0] == start and time.time() < expected[1]
+
+    def handle_file_request(self, path, data, request_id, link_id, remote_identity, requested_at, variant=False):
         RNS.log("File request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
         try:
             self.app.peer_settings["served_file_requests"] += 1
-            self.app.save_peer_settings()
+            self.app.save_peer_settings(deferred=True)
             
         except Exception as e:
             RNS.log("Could not increase served file request count", RNS.LOG_ERROR)
 
+        started = time.time()
+        response = None
         file_path = path.replace("/file", self.app.filespath, 1)
         file_name = path.replace("/file/", "", 1)
         try:
-            RNS.log("Serving file: "+file_path, RNS.LOG_VERBOSE)
-            return [open(file_path, "rb"), {"name": file_name.encode("utf-8")}]
+            metadata = {"name": file_name.encode("utf-8")}
+
+            # When a compressed variant is requested and available,
+            # it is served in place of the file, and any requested
+            # range refers to the compressed data.
+            if variant and self.variants != None:
+                compressed = self.variants.get(path, file_path)
+                if compressed != None:
+                    metadata["decompressed_size"] = os.path.getsize(file_path)
+                    file_path = compressed[0]
+                    metadata["encoding"] = "bz2"
+
+            file_size = os.path.getsize(file_path)
+            metadata["size"] = file_size
+
+            # Clients can request a byte range of the file, to
+            # download it in parts and resume interrupted transfers.
+            # The range is always clamped to a non-empty part of the
+            # file, and the actual range served is returned in the
+            # response metadata.
+            if isinstance(data, dict) and "range" in data and file_size > 0:
+                start, end = data["range"]
+                if end == None or end > file_size:
+                    end = file_size
+                start = max(0, min(int(start), file_size-1))
+                end = max(start+1, int(end))
+                metadata["range"] = [start, end]
+
+                if start > 0 or end < file_size:
+                    spooled = self.spool_range(file_path, start, end)
+                    if spooled == None:
+                        RNS.log("Spool is full, rejecting file request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
+                        self.metrics.record_rejected(path)
+                        return DEFAULT_BUSY.encode("utf-8")
+
+                    RNS.log("Serving bytes "+str(start)+" to "+str(end)+" of file: "+file_path, RNS.LOG_VERBOSE)
+                    response = [spooled, metadata]
+                    if end < file_size:
+                        self.expect_continuation(path, link_id, remote_identity, variant, end)
+
+            if response == None:
+                RNS.log("Serving file: "+file_path, RNS.LOG_VERBOSE)
+                response = [open(file_path, "rb"), metadata]
 
         except Exception as e:
             RNS.log("Error occurred while handling request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_ERROR)
             RNS.log("The contained exception was: "+str(e), RNS.LOG_ERROR)
+
+        self.metrics.record(path, RequestMetrics.FILE, time.time()-started, response, remote_identity)
+        return response
+
+    # Resources are sent from a file on disk, so slices of
+    # files are copied to a spool file in the temporary files
+    # directory, which is removed once the resource has been
+    # sent. If the spool files currently on disk would exceed
+    # SPOOL_MAX_SIZE with the new slice, None is returned.
+    def spool_range(self, file_path, start, end):
+        if self.spool_size()+(end-start) > Node.SPOOL_MAX_SIZE:
             return None
 
+        spool_path = self.app.tmpfilespath+"/"+Node.SPOOL_PREFIX+RNS.hexrep(os.urandom(8), delimit=False)
+        with open(file_path, "rb") as source, open(spool_path, "wb") as spool:
+            source.seek(start)
+            remaining = end-start
+            while remaining > 0:
+                chunk = source.read(min(remaining, 256*1024))
+                if not chunk:
+                    break
+                spool.write(chunk)
+                remaining -= len(chunk)
+
+        return open_spool(spool_path)
+
+    def spool_size(self):
+        size = 0
+        with os.scandir(self.app.tmpfilespath) as entries:
+            for entry in entries:
+                if entry.name.startswith(Node.SPOOL_PREFIX):
+                    try:
+                        size += entry.stat().st_size
+                    except Exception:
+                        pass
+
+        return size
+
+    # Spool files are normally removed when they are closed,
+    # but transfers that fail can leave them behind, so old
+    # spool files are also removed periodically.
+    def clean_spool(self):
+        try:
+            now = time.time()
+            with os.scandir(self.app.tmpfilespath) as entries:
+                for entry in entries:
+                    if entry.name.startswith(Node.SPOOL_PREFIX) and now > entry.stat().st_mtime+Node.SPOOL_MAX_AGE:
+                        os.unlink(entry.path)
+
+        except Exception as e:
+            RNS.log("Error while cleaning spooled response files: "+str(e), RNS.LOG_ERROR)
+
+    def serve_manifest(self, path, data, request_id, link_id, remote_identity, requested_at):
+        return self.admit("manifest", path, request_id, link_id, remote_identity,
+            lambda: self.handle_manifest_request(path, data, request_id, link_id, remote_identity, requested_at))
+
+    # Clients can look up a single file or page by sending
+    # its request path as the "path" item of the request
+    # data, in which case only its entry is returned.
+    def handle_manifest_request(self, path, data, request_id, link_id, remote_identity, requested_at):
+        lookup = None
+        if isinstance(data, dict) and isinstance(data.get("path", None), str):
+            lookup = data["path"]
+
+        if lookup != None:
+            RNS.log("Serving file manifest entry for "+str(lookup)+" for request "+RNS.prettyhexrep(request_id), RNS.LOG_VERBOSE)
+        else:
+            RNS.log("Serving file manifest for request "+RNS.prettyhexrep(request_id), RNS.LOG_VERBOSE)
+
+        response = self.file_manifest.response(lookup)
+        if self.variants != None:
+            # Pages the requester is not allowed to see are
+            # left out, so their names are not disclosed.
+            version, variants = self.variants.versioned_index()
+            if lookup != None:
+                variants = {lookup: variants[lookup]} if lookup in variants else {}
+                hidden = self.hidden_pages(variants, remote_identity)
+            else:
+                hidden = self.cached_hidden_pages(variants, version, remote_identity)
+
+            response["variants"] = {request_path: variants[request_path] for request_path in variants if not request_path in hidden}
+
+        return response
+
+    def hidden_pages(self, variants, remote_identity):
+        hidden = set()
+        lists = {}
+        for request_path in variants:
+            if request_path.startswith("/page/"):
+                file_path = request_path.replace("/page", self.app.pagespath, 1)
+                if not self.access_control.is_allowed(file_path, remote_identity, lists):
+                    hidden.add(request_path)
+
+        return hidden
+
+    # Checking every page against the access lists for each
+    # full manifest request could run executable lists many
+    # times, so the pages hidden from each identity are kept
+    # until the compressed variants change, or for at most
+    # MANIFEST_ACL_CACHE_TIME.
+    def cached_hidden_pages(self, variants, version, remote_identity):
+        identity_key = remote_identity.hash if hasattr(remote_identity, "hash") else None
+        now = time.time()
+        with self.manifest_acl_lock:
+            if self.manifest_acl_version != version:
+                self.manifest_acl.clear()
+                self.manifest_acl_version = version
+
+            cached = self.manifest_acl.get(identity_key, None)
+            if cached != None and now < cached[0]:
+                return cached[1]
+
+        hidden = self.hidden_pages(variants, remote_identity)
+        with self.manifest_acl_lock:
+            if self.manifest_acl_version == version:
+                self.manifest_acl[identity_key] = (now+Node.MANIFEST_ACL_CACHE_TIME, hidden)
+                self.manifest_acl.move_to_end(identity_key)
+                while len(self.manifest_acl) > Node.MANIFEST_ACL_ENTRIES:
+                    self.manifest_acl.popitem(last=False)
+
+        return hidden
+
+    def export_metrics(self):
+        return self.metrics.export(self.app.storagepath+"/metrics.json", self.app.storagepath+"/metrics.mu")
+
     def serve_default_index(self, path, data, request_id, remote_identity, requested_at):
         RNS.log("Serving default index for request "+RNS.prettyhexrep(request_id)+" for: "+str(path), RNS.LOG_VERBOSE)
         return DEFAULT_INDEX.encode("utf-8")
 
     def announce(self):
+        self.app.announce_scheduler.announce_now("node")
+        self.app.announce_scheduler.announce_now("propagation")
+
+    def announce_node(self):
         self.app_data = self.name.encode("utf-8")
         self.last_announce = time.time()
         self.app.peer_settings["node_last_announce"] = self.last_announce
+        self.app.save_peer_settings(deferred=True)
         self.destination.announce(app_data=self.app_data)
+
+    def announce_propagation_node(self):
         self.app.message_router.announce_propagation_node()
 
-    def __jobs(self):
-        while self.should_run_jobs:
-            now = time.time()
-            
-            if now > self.last_announce + self.announce_interval*60:
-                self.announce()
-                
-            if self.page_refresh_interval > 0:
-                if now > self.last_page_refresh + self.page_refresh_interval*60:
-                    self.register_pages()
-                    self.last_page_refresh = time.time()
+    # Places the periodic jobs of the node on the shared job
+    # scheduler. This can be called again after the intervals
+    # in the configuration have changed, and will reschedule
+    # or cancel the jobs accordingly.
+    def schedule_jobs(self):
+        scheduler = self.app.scheduler
+        self.page_refresh_interval = self.app.page_refresh_interval
+        self.file_refresh_interval = self.app.file_refresh_interval
+        self.metrics_export_interval = self.app.metrics_export_interval
+
+        jobs = [
+            ("node.page_refresh", self.register_pages, self.page_refresh_interval*60),
+            ("node.file_refresh", self.register_files, self.file_refresh_interval*60),
+            ("node.metrics_export", self.export_metrics, self.metrics_export_interval*60),
+        ]
 
-            if self.file_refresh_interval > 0:
-                if now > self.last_file_refresh + self.file_refresh_interval*60:
-                    self.register_files()
-                    self.last_file_refresh = time.time()
+        for name, callback, interval in jobs:
+            if interval > 0:
+                scheduler.schedule(name, callback, delay=interval, interval=interval)
+            else:
+                scheduler.cancel(name)
 
-            time.sleep(self.job_interval)
+        if not scheduler.is_scheduled("node.spool_clean"):
+            scheduler.schedule("node.spool_clean", self.clean_spool, interval=Node.SPOOL_CLEAN_INTERVAL)
+
+        if not scheduler.is_scheduled("node.stats_log"):
+            scheduler.schedule("node.stats_log", self.log_stats, delay=Node.STATS_LOG_INTERVAL, interval=Node.STATS_LOG_INTERVAL)
+
+        if self.announce_interval != self.app.node_announce_interval:
+            self.announce_interval = self.app.node_announce_interval
+            self.app.announce_scheduler.set_interval("node", self.announce_interval*60)
+            self.app.announce_scheduler.set_interval("propagation", self.announce_interval*60)
 
     def peer_connected(self, link):
+        if self.link_rate_limiter != None and not self.link_rate_limiter.allow(Node.LINK_RATE_KEY, None):
+            RNS.log("Link rate limit exceeded, closing incoming link to "+str(self.destination), RNS.LOG_VERBOSE)
+            link.teardown()
+            return
+
         RNS.log("Peer connected to "+str(self.destination), RNS.LOG_VERBOSE)
         try:
             self.app.peer_settings["node_connects"] += 1
-            self.app.save_peer_settings()
+            self.app.save_peer_settings(deferred=True)
 
         except Exception as e:
             RNS.log("Could not increase node connection count", RNS.LOG_ERROR)
 
         link.set_link_closed_callback(self.peer_disconnected)
 
+    # The counters of the caches and request limits used by
+    # the node are logged periodically at the verbose level.
+    def log_stats(self):
+        if RNS.loglevel < RNS.LOG_VERBOSE:
+            return
+
+        sources = [("Page cache", self.page_cache), ("Request limiter", self.request_limiter), ("Rate limiter", self.rate_limiter)]
+        if self.response_cache != None:
+            sources.append(("Dynamic page cache", self.response_cache))
+        if self.templates != None:
+            sources.append(("Template cache", self.templates))
+
+        for name, source in sources:
+            RNS.log(name+": "+format_stats(source.stats()), RNS.LOG_VERBOSE)
+
+    def shutdown(self):
+        RNS.log("Stopping page workers...", RNS.LOG_VERBOSE)
+        for worker_pool in self.worker_pools.values():
+            worker_pool.shutdown()
+
     def peer_disconnected(self, link):
         RNS.log("Peer disconnected from "+str(self.destination), RNS.LOG_VERBOSE)
         pass
@@ -266,3 +2103,15 @@ DEFAULT_NOTALLOWED = '''>Request Not Allowed
 
 You are not authorised to carry out the request.
 '''
+
+DEFAULT_RATELIMITED = '''#!c=0
+>Too Many Requests
+
+You have sent too many requests to this node in a short time. Please wait a moment before trying again.
+'''
+
+DEFAULT_BUSY = '''#!c=0
+>Node Busy
+
+This node is currently handling too many requests. Please try again in a little while.
+'''
@@ -14,6 +14,10 @@ import LXMF
 import nomadnet
 
 from nomadnet.Directory import DirectoryEntry
+from nomadnet.AnnounceScheduler import AnnounceScheduler
+from nomadnet.Scheduler import Scheduler
+from nomadnet.Notifier import Notifier
+from nomadnet.util import format_stats
 from datetime import datetime
 
 import RNS.vendor.umsgpack as msgpack
@@ -34,13 +38,21 @@ class NomadNetworkApp:
         configdir = userdir+"/.nomadnetwork"
 
     START_ANNOUNCE_DELAY = 3
+    STATS_LOG_INTERVAL   = 30*60
 
     def exit_handler(self):
-        self.should_run_jobs = False
+        self.scheduler.stop()
+
+        if getattr(self, "node", None) != None:
+            self.node.shutdown()
 
         RNS.log("Saving directory...", RNS.LOG_VERBOSE)
         self.directory.save_to_disk()
 
+        if self.peer_settings_dirty:
+            RNS.log("Saving peer settings...", RNS.LOG_VERBOSE)
+            self.flush_peer_settings()
+
         if hasattr(self.ui, "restore_ixon"):
             if self.ui.restore_ixon:
                 try:
@@ -117,12 +129,34 @@ class NomadNetworkApp:
         self.downloads_path    = os.path.expanduser("~/Downloads")
         self.attachment_save_path = None
 
+        self.peer_settings_lock     = threading.RLock()
+        self.peer_settings_dirty    = False
+        self.settings_flush_delay   = 60
+        self.scheduler              = Scheduler()
+        self.ui_refresh_interval    = 2
+
         self.firstrun               = False
-        self.should_run_jobs        = True
         self.job_interval           = 5
         self.defer_jobs             = 90
         self.page_refresh_interval  = 0
         self.file_refresh_interval  = 0
+        self.page_cache_size        = 4*1000*1000
+        self.page_file_threshold    = 1000*1000
+        self.worker_pages           = []
+        self.worker_concurrency     = 2
+        self.dynamic_page_cache     = True
+        self.template_pages         = True
+        self.page_timeout           = 60
+        self.max_page_output        = 16*1000*1000
+        self.precompress_content    = False
+        self.metrics_export_interval = 0
+
+        self.max_active_requests              = 8
+        self.max_active_requests_per_identity = 2
+        self.max_queued_requests              = 32
+        self.request_queue_timeout            = 10
+        self.rate_limits                      = [("/page", 60, 20), ("/file", 120, 40)]
+        self.max_links_per_minute             = 0
 
         self.static_peers            = []
         self.peer_announce_at_start  = True
@@ -139,6 +173,8 @@ class NomadNetworkApp:
         self.lxmf_sync_interval = 360*60
         self.lxmf_sync_limit    = 8
         self.compact_stream     = False
+        self.announce_stream_length = nomadnet.Directory.ANNOUNCE_STREAM_MAXLENGTH
+        self.announce_history_days  = 7
         
         self.required_stamp_cost   = None
         self.accept_invalid_stamps = False
@@ -299,6 +335,7 @@ class NomadNetworkApp:
             except Exception as e:
                 RNS.log("Error while loading list of ignored destinations: "+str(e), RNS.LOG_ERROR)
 
+        self.ui_notifier = Notifier(self.scheduler, self.ui_refresh_interval)
         self.directory = nomadnet.Directory(self)
 
         static_peers = []
@@ -335,6 +372,12 @@ class NomadNetworkApp:
 
         RNS.log("LXMF Router ready to receive on: "+RNS.prettyhexrep(self.lxmf_destination.hash))
 
+        self.announce_scheduler = AnnounceScheduler(self.scheduler)
+        if self.peer_announce_at_start:
+            self.announce_scheduler.register("peer", self.announce_peer, delay=NomadNetworkApp.START_ANNOUNCE_DELAY)
+        else:
+            self.announce_scheduler.register("peer", self.announce_peer)
+
         if self.enable_node:
             self.message_router.set_message_storage_limit(megabytes=self.message_storage_limit)
             for dest_str in self.prioritised_lxmf_destinations:
@@ -383,21 +426,10 @@ class NomadNetworkApp:
 
         self.autoselect_propagation_node()
 
-        if self.peer_announce_at_start:
-            def delayed_announce():
-                time.sleep(NomadNetworkApp.START_ANNOUNCE_DELAY)
-                self.announce_now()
-
-            da_thread = threading.Thread(target=delayed_announce)
-            da_thread.setDaemon(True)
-            da_thread.start()
-
         atexit.register(self.exit_handler)
         sys.excepthook = self.exception_handler
 
-        job_thread = threading.Thread(target=self.__jobs)
-        job_thread.setDaemon(True)
-        job_thread.start()
+        self.schedule_jobs()
 
         # Override UI choice from config on --daemon switch
         if daemon:
@@ -424,19 +456,41 @@ class NomadNetworkApp:
                 RNS.log("The contained exception was: "+str(e), RNS.LOG_ERROR)
 
 
-    def __jobs(self):
+    # Places the periodic jobs of the program on the shared
+    # job scheduler. This can be called again after the
+    # configuration has changed, to reschedule the jobs.
+    def schedule_jobs(self):
         RNS.log("Deferring scheduled jobs for "+str(self.defer_jobs)+" seconds...", RNS.LOG_DEBUG)
-        time.sleep(self.defer_jobs)
-
-        RNS.log("Starting job scheduler now", RNS.LOG_DEBUG)
-        while self.should_run_jobs:
-            now = time.time()
-            
-            if now > self.peer_settings["last_lxmf_sync"] + self.lxmf_sync_interval:
-                RNS.log("Initiating automatic LXMF sync", RNS.LOG_VERBOSE)
-                self.request_lxmf_sync(limit=self.lxmf_sync_limit)
-
-            time.sleep(self.job_interval)
+        self.scheduler.schedule("lxmf_sync", self.lxmf_sync_job, delay=self.defer_jobs)
+        self.scheduler.schedule("stats_log", self.log_stats, delay=NomadNetworkApp.STATS_LOG_INTERVAL, interval=NomadNetworkApp.STATS_LOG_INTERVAL)
+
+    def lxmf_sync_job(self):
+        if time.time() > self.peer_settings["last_lxmf_sync"] + self.lxmf_sync_interval:
+            RNS.log("Initiating automatic LXMF sync", RNS.LOG_VERBOSE)
+            self.request_lxmf_sync(limit=self.lxmf_sync_limit)
+
+        # If a sync could not be started because another one
+        # is still in progress, it is retried shortly.
+        next_sync = self.peer_settings["last_lxmf_sync"] + self.lxmf_sync_interval
+        return max(self.job_interval, next_sync-time.time())
+
+    # The pending jobs, the announce timeline, a summary of
+    # recently sent announces and the user interface notifier
+    # counters are logged periodically at the verbose level.
+    def log_stats(self):
+        if RNS.loglevel < RNS.LOG_VERBOSE:
+            return
+
+        now = time.time()
+        jobs = [job["name"]+" in "+RNS.prettytime(max(0, job["due"]-now)) for job in self.scheduler.pending()]
+        RNS.log("Scheduled jobs: "+", ".join(jobs), RNS.LOG_VERBOSE)
+
+        timeline = [name+" in "+RNS.prettytime(max(0, due-now)) for due, name in self.announce_scheduler.timeline()]
+        history = self.announce_scheduler.history()
+        deferred = len([entry for entry in history if entry["deferrals"] > 0])
+        forced = len([entry for entry in history if entry["reason"] == "forced"])
+        RNS.log("Announces: "+str(len(history))+" recently sent, "+str(deferred)+" deferred, "+str(forced)+" forced, next "+(", ".join(timeline) or "none"), RNS.LOG_VERBOSE)
+        RNS.log("Interface notifications: "+format_stats(self.ui_notifier.stats()), RNS.LOG_VERBOSE)
 
     def set_display_name(self, display_name):
         self.peer_settings["display_name"] = display_name
@@ -519,6 +573,9 @@ class NomadNetworkApp:
             self.message_router.cancel_propagation_node_requests()
 
     def announce_now(self):
+        self.announce_scheduler.announce_now("peer")
+
+    def announce_peer(self):
         self.message_router.set_inbound_stamp_cost(self.lxmf_destination.hash, self.required_stamp_cost)
         self.lxmf_destination.display_name = self.peer_settings["display_name"]
         self.message_router.announce(self.lxmf_destination.hash)
@@ -565,10 +622,36 @@ class NomadNetworkApp:
     def get_default_propagation_node(self):
         return self.message_router.get_outbound_propagation_node()
 
-    def save_peer_settings(self):
-        tmp_path = f"{self.peersettingspath}.tmp"
-        with open(tmp_path, "wb") as file: file.write(msgpack.packb(self.peer_settings))
-        os.replace(tmp_path, self.peersettingspath)
+    def save_peer_settings(self, deferred=False):
+        # Deferred saves only mark the settings as changed,
+        # and are coalesced into a single write that happens
+        # at most settings_flush_delay seconds later.
+        if deferred and self.settings_flush_delay > 0:
+            with self.peer_settings_lock:
+                self.peer_settings_dirty = True
+                if not self.scheduler.is_scheduled("settings_flush"):
+                    self.scheduler.schedule("settings_flush", self.flush_peer_settings, delay=self.settings_flush_delay)
+        else:
+            self.flush_peer_settings()
+
+    def flush_peer_settings(self):
+        with self.peer_settings_lock:
+            self.scheduler.cancel("settings_flush")
+
+            self.peer_settings_dirty = False
+            packed_settings = msgpack.packb(self.peer_settings)
+
+            try:
+                tmp_path = f"{self.peersettingspath}.tmp"
+                with open(tmp_path, "wb") as file:
+                    file.write(packed_settings)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, self.peersettingspath)
+
+            except Exception as e:
+                self.peer_settings_dirty = True
+                raise e
 
     def lxmf_delivery(self, message):
         time_string = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message.timestamp))
@@ -801,6 +884,18 @@ class NomadNetworkApp:
                     value = self.config["client"].as_bool(option)
                     self.compact_stream = value
 
+                if option == "announce_stream_length":
+                    value = self.config["client"].as_int(option)
+                    if value < 16:
+                        value = 16
+                    self.announce_stream_length = value
+
+                if option == "announce_history_days":
+                    value = self.config["client"].as_float(option)
+                    if value < 0:
+                        value = 0
+                    self.announce_history_days = value
+
                 if option == "notify_on_new_message":
                     value = self.config["client"].as_bool(option)
                     self.notify_on_new_message = value
@@ -848,6 +943,15 @@ class NomadNetworkApp:
                             else:
                                 self.config["textui"]["animation_interval"] = self.config["textui"].as_int("animation_interval")
 
+                            if not "refresh_interval" in self.config["textui"]:
+                                self.config["textui"]["refresh_interval"] = self.ui_refresh_interval
+                            else:
+                                value = self.config["textui"].as_float("refresh_interval")
+                                if value < 0:
+                                    value = 0
+                                self.config["textui"]["refresh_interval"] = value
+                                self.ui_refresh_interval = value
+
                             if not "colormode" in self.config["textui"]:
                                 self.config["textui"]["colormode"] = nomadnet.ui.COLORMODE_16
                             else:
@@ -959,6 +1063,145 @@ class NomadNetworkApp:
                 if value < 0:
                     value = 0
                 self.file_refresh_interval = value
+
+            if not "page_cache_size" in self.config["node"]:
+                self.page_cache_size = 4*1000*1000
+            else:
+                value = self.config["node"].as_float("page_cache_size")
+                if value < 0:
+                    value = 0
+                self.page_cache_size = int(value*1000*1000)
+
+            if not "page_file_threshold" in self.config["node"]:
+                self.page_file_threshold = 1000*1000
+            else:
+                value = self.config["node"].as_float("page_file_threshold")
+                if value < 0:
+                    value = 0
+                self.page_file_threshold = int(value*1000*1000)
+
+            if "worker_pages" in self.config["node"]:
+                self.worker_pages = self.config["node"].as_list("worker_pages")
+            else:
+                self.worker_pages = []
+
+            if not "settings_flush_delay" in self.config["node"]:
+                self.settings_flush_delay = 60
+            else:
+                value = self.config["node"].as_float("settings_flush_delay")
+                if value < 0:
+                    value = 0
+                self.settings_flush_delay = value
+
+            if not "worker_concurrency" in self.config["node"]:
+                self.worker_concurrency = 2
+            else:
+                value = self.config["node"].as_int("worker_concurrency")
+                if value < 1:
+                    value = 1
+                self.worker_concurrency = value
+
+            if not "dynamic_page_cache" in self.config["node"]:
+                self.dynamic_page_cache = True
+            else:
+                self.dynamic_page_cache = self.config["node"].as_bool("dynamic_page_cache")
+
+            if not "page_timeout" in self.config["node"]:
+                self.page_timeout = 60
+            else:
+                value = self.config["node"].as_float("page_timeout")
+                if value < 0:
+                    value = 0
+                self.page_timeout = value
+
+            if not "max_page_output" in self.config["node"]:
+                self.max_page_output = 16*1000*1000
+            else:
+                value = self.config["node"].as_float("max_page_output")
+                if value < 0:
+                    value = 0
+                self.max_page_output = int(value*1000*1000)
+
+            if not "template_pages" in self.config["node"]:
+                self.template_pages = True
+            else:
+                self.template_pages = self.config["node"].as_bool("template_pages")
+
+            if not "precompress_content" in self.config["node"]:
+                self.precompress_content = False
+            else:
+                self.precompress_content = self.config["node"].as_bool("precompress_content")
+
+            if not "metrics_export_interval" in self.config["node"]:
+                self.metrics_export_interval = 0
+            else:
+                value = self.config["node"].as_float("metrics_export_interval")
+                if value < 0:
+                    value = 0
+                self.metrics_export_interval = value
+
+            if not "max_active_requests" in self.config["node"]:
+                self.max_active_requests = 8
+            else:
+                value = self.config["node"].as_int("max_active_requests")
+                if value < 1:
+                    value = 1
+                self.max_active_requests = value
+
+            if not "max_active_requests_per_identity" in self.config["node"]:
+                self.max_active_requests_per_identity = 2
+            else:
+                value = self.config["node"].as_int("max_active_requests_per_identity")
+                if value < 1:
+                    value = 1
+                self.max_active_requests_per_identity = value
+
+            if not "max_queued_requests" in self.config["node"]:
+                self.max_queued_requests = 32
+            else:
+                value = self.config["node"].as_int("max_queued_requests")
+                if value < 0:
+                    value = 0
+                self.max_queued_requests = value
+
+            if not "request_queue_timeout" in self.config["node"]:
+                self.request_queue_timeout = 10
+            else:
+                value = self.config["node"].as_float("request_queue_timeout")
+                if value < 0:
+                    value = 0
+                self.request_queue_timeout = value
+
+            if "rate_limits" in self.config["node"]:
+                self.rate_limits = []
+                for rule in self.config["node"].as_list("rate_limits"):
+                    rule = rule.strip()
+                    if rule.lower() == "none" or rule == "":
+                        continue
+                    try:
+                        components = rule.split(":")
+                        if len(components) < 2 or len(components) > 3 or not components[0].startswith("/"):
+                            raise ValueError("Invalid format")
+                        rate = float(components[1])
+                        if len(components) == 3:
+                            burst = int(components[2])
+                        else:
+                            burst = max(1, int(rate))
+                        if rate <= 0 or burst < 1:
+                            raise ValueError("Rate and burst must be positive")
+                        self.rate_limits.append((components[0], rate, burst))
+                    except Exception as e:
+                        RNS.log("Ignoring invalid rate limit \""+str(rule)+"\" in configuration: "+str(e), RNS.LOG_ERROR)
+            else:
+                self.rate_limits = [("/page", 60, 20), ("/file", 120, 40)]
+
+            if not "max_links_per_minute" in self.config["node"]:
+                self.max_links_per_minute = 0
+            else:
+                value = self.config["node"].as_float("max_links_per_minute")
+                if value < 0:
+                    value = 0
+                self.max_links_per_minute = value
                 
 
             if "prioritise_destinations" in self.config["node"]:
@@ -1137,6 +1380,16 @@ max_accepted_size = 500
 # been received, for every destination.
 compact_announce_stream = yes
 
+# The number of announces of each type that are
+# kept in memory and shown in the announce stream.
+# announce_stream_length = 4096
+
+# Announces that no longer fit in the announce
+# stream are kept on disk for this many days, and
+# can be paged in from the announce stream. Set
+# to 0 to disable the announce history.
+# announce_history_days = 7
+
 [textui]
 
 # Amount of time to show intro screen
@@ -1188,6 +1441,11 @@ hide_guide = no
 # announces.
 sanitize_names = yes
 
+# When announces arrive, the announce stream
+# and conversation list are refreshed at most
+# once per this many seconds.
+# refresh_interval = 2
+
 [node]
 
 # Whether to enable node hosting
@@ -1312,7 +1570,9 @@ max_sync_size = 10240
 # You can specify the interval in minutes for
 # rescanning the hosted pages path. By default,
 # this option is disabled, and the pages path
-# will only be scanned on startup.
+# will only be scanned on startup. A rescan
+# only re-reads directories that have changed,
+# and stops serving pages that were removed.
 
 # page_refresh_interval = 0
 
@@ -1323,6 +1583,123 @@ max_sync_size = 10240
 
 # file_refresh_interval = 0
 
+# Static pages are kept in an in-memory cache,
+# and are only read from disk again when they
+# change. You can set the maximum amount of
+# memory used for the page cache in megabytes,
+# or set it to 0 to disable the cache.
+
+# page_cache_size = 4
+
+# Static pages larger than this size in mega-
+# bytes are not kept in the page cache, and are
+# instead sent directly from disk to clients
+# that support it. Set to 0 to disable.
+
+# page_file_threshold = 1
+
+# Node statistics such as the number of served
+# pages are written to disk in batches, at most
+# this many seconds after they change, and when
+# the program exits. Set to 0 to write them on
+# every request.
+
+# settings_flush_delay = 60
+
+# Executable Python pages are normally run in a
+# new interpreter for every request. You can
+# list pages (relative to the pages path) that
+# should instead be served by a pool of long-
+# lived worker processes, and set how many
+# requests each page may handle concurrently.
+
+# worker_pages = index.mu, board/list.mu
+# worker_concurrency = 2
+
+# If the output of a dynamic page starts with a
+# cache header (#!c=X), the node will re-use the
+# output for X seconds, for requests with the
+# same request variables. You can disable this
+# server-side cache here.
+
+# dynamic_page_cache = yes
+
+# Executable pages that run for longer than
+# this many seconds are stopped, and output
+# larger than the maximum size in megabytes
+# is discarded. Output larger than the page
+# file threshold is written to a temporary
+# file instead of being kept in memory. Set
+# either option to 0 to disable the limit.
+
+# page_timeout = 60
+# max_page_output = 16
+
+# Pages ending in .mut are micron templates,
+# that the node renders itself, without
+# starting a separate program for each
+# request. You can disable template pages
+# here, in which case they are served as
+# static pages.
+
+# template_pages = yes
+
+# Static pages and hosted files are compressed
+# in the background when they are added or
+# change, and the compressed versions are sent
+# to clients that support it, so they do not
+# need to be compressed again for every
+# request. The compressed versions are stored
+# in the storage directory, which can take up
+# as much space again as the content itself,
+# so this is disabled by default.
+
+# precompress_content = no
+
+# The node keeps request metrics for each page
+# and file, which can be viewed in the Network
+# section of the program. You can also have
+# them written to metrics.json and metrics.mu
+# in the storage directory at an interval in
+# minutes. By default, they are only written
+# when exported from the user interface.
+
+# metrics_export_interval = 0
+
+# To avoid overloading the node when many
+# requests arrive at once, you can limit how
+# many page and file requests are handled at
+# the same time, in total and per remote
+# identity. Requests over the limit wait in a
+# queue of limited length for up to the
+# specified number of seconds, and are then
+# answered with a short "Node Busy" page.
+
+# max_active_requests = 8
+# max_active_requests_per_identity = 2
+# max_queued_requests = 32
+# request_queue_timeout = 10
+
+# Requests are also rate limited per remote
+# identity, or per link for peers that have
+# not identified. Limits are set for path
+# prefixes as prefix:requests_per_minute:burst,
+# and the longest matching prefix applies.
+# Requests over the limit are answered with a
+# short "Too Many Requests" page. Requests for
+# the next part of a file download that is in
+# progress are not counted. Set to none to
+# disable rate limiting.
+
+# rate_limits = /page:60:20, /file:120:40
+
+# You can also limit how many incoming links
+# the node accepts per minute in total. Links
+# over the limit are closed immediately. The
+# default of 0 disables this limit.
+
+# max_links_per_minute = 0
+
 [printing]
 
 # You can configure Nomad Network to print
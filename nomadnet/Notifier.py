@@ -0,0 +1,79 @@
+import RNS
+import time
+import threading
+
+# Announce handlers and other background threads use the
+# notifier to tell the user interface that something has
+# changed. Notifications are coalesced per name, and each
+# callback runs at most once per interval, no matter how
+# many notifications arrive in between.
+#
+# If the user interface sets a dispatcher, callbacks are
+# handed to it, so they can be run on the thread of the
+# user interface. Otherwise they run on the scheduler
+# thread.
+
+class Notifier:
+    JOB_PREFIX = "notify."
+
+    def __init__(self, scheduler, interval):
+        self.scheduler = scheduler
+        self.interval = interval
+        self.callbacks = {}
+        self.pending = set()
+        self.last_delivery = {}
+        self.dispatcher = None
+        self.lock = threading.Lock()
+        self.counters = {"notified": 0, "merged": 0, "dropped": 0, "delivered": 0}
+
+    def register(self, name, callback):
+        with self.lock:
+            self.callbacks[name] = callback
+
+    def set_dispatcher(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    def notify(self, name):
+        with self.lock:
+            self.counters["notified"] += 1
+            if not name in self.callbacks:
+                self.counters["dropped"] += 1
+                return
+
+            if name in self.pending:
+                self.counters["merged"] += 1
+                return
+
+            self.pending.add(name)
+            last_delivery = self.last_delivery.get(name, 0)
+            delay = max(0, last_delivery+self.interval-time.time())
+
+        self.scheduler.schedule(Notifier.JOB_PREFIX+name, lambda: self.dispatch(name), delay=delay)
+
+    def dispatch(self, name):
+        if self.dispatcher == None:
+            self.deliver(name)
+        else:
+            try:
+                self.dispatcher(lambda: self.deliver(name))
+            except Exception as e:
+                RNS.log("Could not dispatch "+str(name)+" notification: "+str(e), RNS.LOG_ERROR)
+                with self.lock:
+                    self.pending.discard(name)
+                    self.counters["dropped"] += 1
+
+    def deliver(self, name):
+        with self.lock:
+            self.pending.discard(name)
+            self.last_delivery[name] = time.time()
+            self.counters["delivered"] += 1
+            callback = self.callbacks.get(name)
+
+        try:
+            callback()
+        except Exception as e:
+            RNS.log("Error while delivering "+str(name)+" notification: "+str(e), RNS.LOG_ERROR)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
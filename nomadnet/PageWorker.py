@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# This program is started by the Nomad Network node
+# to serve a single Python page script from a long-
+# lived process, instead of starting a new interpreter
+# for every request. It must only depend on the
+# standard library, so that it starts quickly.
+#
+# Requests and responses are exchanged over stdin and
+# stdout as frames, each consisting of a 4-byte big-
+# endian length followed by the payload. A request
+# payload is the JSON-encoded environment for the
+# page script, and a response payload is a status
+# byte followed by the output generated by the script.
+
+import io
+import os
+import sys
+import json
+import struct
+
+STATUS_OK    = 0x00
+STATUS_ERROR = 0x01
+
+def read_frame(stream):
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+
+    length = struct.unpack("!I", header)[0]
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+
+    return payload
+
+def write_frame(stream, payload):
+    stream.write(struct.pack("!I", len(payload))+payload)
+    stream.flush()
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(2)
+
+    script_path = sys.argv[1]
+    script_dir  = os.path.dirname(os.path.abspath(script_path))
+    if not script_dir in sys.path:
+        sys.path.insert(0, script_dir)
+
+    # Keep private copies of the original stdin and stdout
+    # for the request protocol, and point the standard
+    # descriptors at /dev/null, so nothing the page script
+    # or its children write can corrupt the frame stream.
+    requests  = os.fdopen(os.dup(0), "rb")
+    responses = os.fdopen(os.dup(1), "wb")
+    devnull   = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+
+    code  = None
+    mtime = None
+
+    while True:
+        request = read_frame(requests)
+        if request == None:
+            break
+
+        output = io.BytesIO()
+        status = STATUS_OK
+        try:
+            st = os.stat(script_path)
+            if code == None or mtime != st.st_mtime_ns:
+                with open(script_path, "rb") as fh:
+                    source = fh.read()
+                code  = compile(source, script_path, "exec")
+                mtime = st.st_mtime_ns
+
+            env_map = json.loads(request.decode("utf-8"))
+            os.environ.clear()
+            os.environ.update(env_map)
+
+            sys.argv   = [script_path]
+            sys.stdout = io.TextIOWrapper(output, encoding="utf-8", write_through=True)
+            try:
+                exec(code, {"__name__": "__main__", "__file__": script_path, "__builtins__": __builtins__})
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    status = STATUS_ERROR
+
+        except Exception as e:
+            status = STATUS_ERROR
+
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stdout.detach()
+            except Exception:
+                pass
+            sys.stdout = sys.__stdout__
+
+        write_frame(responses, bytes([status])+output.getvalue())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import RNS
+import time
+import heapq
+import threading
+
+# The scheduler runs all timed jobs of the program on a
+# single thread. Jobs are kept in a heap ordered by their
+# due time, and the thread sleeps until the next job is
+# due, or until the set of jobs changes.
+#
+# Jobs are identified by name. Scheduling a job with the
+# name of a pending job replaces it, which is also how jobs
+# are rescheduled when their settings change. A job with an
+# interval runs repeatedly, and a job callback can return a
+# number of seconds to override the delay until its next run.
+
+class Job:
+    def __init__(self, name, callback, due, interval):
+        self.name = name
+        self.callback = callback
+        self.due = due
+        self.interval = interval
+        self.cancelled = False
+        self.runs = 0
+        self.last_run = None
+
+    def __lt__(self, other):
+        return self.due < other.due
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = {}
+        self.heap = []
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.should_run = True
+
+        scheduler_thread = threading.Thread(target=self.__run)
+        scheduler_thread.setDaemon(True)
+        scheduler_thread.start()
+
+    def schedule(self, name, callback, delay=0, interval=None):
+        with self.condition:
+            if name in self.jobs:
+                self.jobs[name].cancelled = True
+
+            job = Job(name, callback, time.time()+delay, interval)
+            self.jobs[name] = job
+            heapq.heappush(self.heap, job)
+            self.condition.notify()
+
+        return job
+
+    # Moves a pending job to a new due time, and optionally
+    # changes its interval. Returns False if no job with the
+    # name is pending.
+    def reschedule(self, name, delay, interval=False):
+        with self.condition:
+            if not name in self.jobs:
+                return False
+
+            job = self.jobs[name]
+            if interval != False:
+                job.interval = interval
+
+            job.cancelled = True
+            self.push(job, time.time()+delay)
+            self.condition.notify()
+            return True
+
+    def cancel(self, name):
+        with self.condition:
+            if name in self.jobs:
+                self.jobs.pop(name).cancelled = True
+                self.condition.notify()
+                return True
+
+            return False
+
+    def is_scheduled(self, name):
+        with self.lock:
+            return name in self.jobs
+
+    # Cancelled jobs stay in the heap until they are reached,
+    # so a replaced or rescheduled job is pushed as a copy.
+    def push(self, job, due):
+        pushed = Job(job.name, job.callback, due, job.interval)
+        pushed.runs = job.runs
+        pushed.last_run = job.last_run
+        self.jobs[job.name] = pushed
+        heapq.heappush(self.heap, pushed)
+        return pushed
+
+    def pending(self):
+        with self.lock:
+            jobs = sorted(self.jobs.values())
+            return [{"name": job.name, "due": job.due, "interval": job.interval, "runs": job.runs, "last_run": job.last_run} for job in jobs]
+
+    def stop(self):
+        with self.condition:
+            self.should_run = False
+            self.condition.notify()
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while self.should_run and len(self.heap) > 0 and self.heap[0].cancelled:
+                    heapq.heappop(self.heap)
+
+                if not self.should_run:
+                    return
+                elif len(self.heap) == 0:
+                    self.condition.wait()
+                    continue
+
+                now = time.time()
+                if self.heap[0].due > now:
+                    self.condition.wait(self.heap[0].due-now)
+                    continue
+
+                job = heapq.heappop(self.heap)
+
+            next_delay = None
+            try:
+                next_delay = job.callback()
+            except Exception as e:
+                RNS.log("Error while running scheduled job "+str(job.name)+": "+str(e), RNS.LOG_ERROR)
+
+            with self.condition:
+                job.runs += 1
+                job.last_run = time.time()
+                if job.cancelled:
+                    continue
+
+                if isinstance(next_delay, (int, float)) and not isinstance(next_delay, bool):
+                    self.push(job, job.last_run+next_delay)
+                elif job.interval != None:
+                    self.push(job, job.last_run+job.interval)
+                else:
+                    self.jobs.pop(job.name)
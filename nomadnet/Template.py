@@ -0,0 +1,375 @@
+import os
+import re
+import ast
+import time
+import threading
+
+# Micron templates are pages ending in .mut, that are
+# rendered by the node itself instead of being run as a
+# separate program. Templates are plain micron, with these
+# additions:
+#
+#   {{ expression }}                 Inserts the value of the
+#                                    expression, with micron
+#                                    formatting escaped.
+#   {% if expression %} ... {% elif expression %} ...
+#   {% else %} ... {% endif %}
+#   {% for name in expression %} ... {% endfor %}
+#   {% for key, value in expression %} ... {% endfor %}
+#   {% include "other.mut" %}
+#
+# Expressions are a small, safe subset of Python. Only
+# names from the request context and the functions listed
+# in TemplateRenderer can be used, and attribute access,
+# lambdas, comprehensions and assignments are not allowed.
+
+class TemplateError(Exception):
+    pass
+
+class Raw(str):
+    pass
+
+# Names that are not set, such as fields that were not
+# submitted with the request, evaluate to None.
+class TemplateNames(dict):
+    def __missing__(self, key):
+        return None
+
+# Multiplication is routed through this function, so that
+# expressions can not build huge strings or lists.
+def safe_multiply(a, b):
+    for sequence, count in [(a, b), (b, a)]:
+        if isinstance(sequence, (str, list, tuple)) and isinstance(count, int):
+            if len(sequence)*count > TemplateRenderer.MAX_OUTPUT:
+                raise TemplateError("Result of multiplication too large")
+
+    return a*b
+
+FORMAT_SPEC_RE = re.compile(r"%(?:\([^)]*\))?[#0\- +]*(\*|\d+)?(?:\.(\*|\d*))?[hlL]?.", re.DOTALL)
+
+# String formatting with % is routed through this function,
+# since a width or precision in the format string can pad
+# the result to any size before it is emitted.
+def safe_format(a, b):
+    if isinstance(a, str):
+        padding = 0
+        for width, precision in FORMAT_SPEC_RE.findall(a):
+            if width == "*" or precision == "*":
+                raise TemplateError("Variable width or precision is not supported in formatting")
+            padding += max(int(width or 0), int(precision or 0))
+            if padding > TemplateRenderer.MAX_OUTPUT:
+                raise TemplateError("Result of formatting too large")
+
+    return a % b
+
+class OperatorTransformer(ast.NodeTransformer):
+    FUNCTIONS = {ast.Mult: "_multiply", ast.Mod: "_format"}
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if type(node.op) in OperatorTransformer.FUNCTIONS:
+            function = OperatorTransformer.FUNCTIONS[type(node.op)]
+            call = ast.Call(func=ast.Name(id=function, ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+            return ast.copy_location(call, node)
+        else:
+            return node
+
+class TemplateParser:
+    TOKEN_RE = re.compile(r"(\{\{.*?\}\}|\{%.*?%\})", re.DOTALL)
+    FOR_RE = re.compile(r"^for\s+([A-Za-z_]\w*)(?:\s*,\s*([A-Za-z_]\w*))?\s+in\s+(.+)$", re.DOTALL)
+    INCLUDE_RE = re.compile(r"^include\s+(\"[^\"]+\"|'[^']+')$")
+
+    ALLOWED_NODES = (
+        ast.Expression, ast.Constant, ast.Name, ast.Load, ast.Subscript, ast.Slice,
+        ast.Tuple, ast.List, ast.Dict, ast.Compare, ast.BoolOp, ast.UnaryOp, ast.BinOp,
+        ast.IfExp, ast.Call, ast.And, ast.Or, ast.Not, ast.USub, ast.UAdd,
+        ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+        ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn, ast.Is, ast.IsNot,
+    )
+
+    def __init__(self, source, name):
+        self.source = source
+        self.name = name
+
+    def compile_expression(self, expression):
+        try:
+            tree = ast.parse(expression.strip(), mode="eval")
+        except SyntaxError as e:
+            raise TemplateError("Invalid expression \""+expression.strip()+"\" in "+str(self.name)+": "+str(e.msg))
+
+        for node in ast.walk(tree):
+            if not isinstance(node, TemplateParser.ALLOWED_NODES):
+                raise TemplateError("Unsupported "+type(node).__name__+" in expression \""+expression.strip()+"\" in "+str(self.name))
+            if isinstance(node, ast.Name) and node.id.startswith("_"):
+                raise TemplateError("Invalid name "+node.id+" in "+str(self.name))
+            if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or len(node.keywords) > 0):
+                raise TemplateError("Only plain function calls are allowed in "+str(self.name))
+
+        tree = ast.fix_missing_locations(OperatorTransformer().visit(tree))
+        return compile(tree, self.name, "eval")
+
+    # Templates are compiled to a tree of nodes, where each
+    # node is a tuple with the node type as its first item:
+    #
+    #   ("text", string)
+    #   ("expr", code)
+    #   ("if", [(code, body), ...], else_body)
+    #   ("for", name, value_name, code, body)
+    #   ("include", path)
+    def parse(self):
+        root = []
+        stack = [("root", root)]
+
+        for token in TemplateParser.TOKEN_RE.split(self.source):
+            if token == "":
+                continue
+
+            body = stack[-1][1]
+            if token.startswith("{{") and token.endswith("}}"):
+                body.append(("expr", self.compile_expression(token[2:-2])))
+
+            elif token.startswith("{%") and token.endswith("%}"):
+                statement = token[2:-2].strip()
+                keyword = statement.split(None, 1)[0] if len(statement) > 0 else ""
+
+                if keyword == "if":
+                    node = ("if", [(self.compile_expression(statement[2:]), [])], [])
+                    body.append(node)
+                    stack.append(("if", node[1][0][1], node))
+
+                elif keyword == "elif" or keyword == "else":
+                    if stack[-1][0] != "if" and stack[-1][0] != "else":
+                        raise TemplateError("Unexpected "+keyword+" in "+str(self.name))
+                    if stack[-1][0] == "else":
+                        raise TemplateError("Unexpected "+keyword+" after else in "+str(self.name))
+                    node = stack.pop()[2]
+                    if keyword == "elif":
+                        branch = (self.compile_expression(statement[4:]), [])
+                        node[1].append(branch)
+                        stack.append(("if", branch[1], node))
+                    else:
+                        stack.append(("else", node[2], node))
+
+                elif keyword == "endif":
+                    if stack[-1][0] != "if" and stack[-1][0] != "else":
+                        raise TemplateError("Unexpected endif in "+str(self.name))
+                    stack.pop()
+
+                elif keyword == "for":
+                    match = TemplateParser.FOR_RE.match(statement)
+                    if match == None:
+                        raise TemplateError("Invalid for statement \""+statement+"\" in "+str(self.name))
+                    node = ("for", match.group(1), match.group(2), self.compile_expression(match.group(3)), [])
+                    body.append(node)
+                    stack.append(("for", node[4], node))
+
+                elif keyword == "endfor":
+                    if stack[-1][0] != "for":
+                        raise TemplateError("Unexpected endfor in "+str(self.name))
+                    stack.pop()
+
+                elif keyword == "include":
+                    match = TemplateParser.INCLUDE_RE.match(statement)
+                    if match == None:
+                        raise TemplateError("Invalid include statement \""+statement+"\" in "+str(self.name))
+                    body.append(("include", match.group(1)[1:-1]))
+
+                else:
+                    raise TemplateError("Unknown statement \""+statement+"\" in "+str(self.name))
+
+            else:
+                body.append(("text", token))
+
+        if len(stack) > 1:
+            raise TemplateError("Unclosed "+stack[-1][0]+" block in "+str(self.name))
+
+        return root
+
+class TemplateCache:
+    # Compiled templates are kept until the template file
+    # changes. The number of cached templates is limited,
+    # and the oldest templates are dropped first.
+    MAX_ENTRIES = 256
+
+    def __init__(self, base_path, max_entries=MAX_ENTRIES):
+        self.base_path = os.path.realpath(base_path)
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_path):
+        st = os.stat(file_path)
+        with self.lock:
+            if file_path in self.entries:
+                mtime, size, tree = self.entries[file_path]
+                if mtime == st.st_mtime_ns and size == st.st_size:
+                    self.hits += 1
+                    return tree
+
+            self.misses += 1
+
+        with open(file_path, "rb") as fh:
+            source = fh.read().decode("utf-8")
+
+        tree = TemplateParser(source, file_path).parse()
+        with self.lock:
+            if len(self.entries) >= self.max_entries and not file_path in self.entries:
+                self.entries.pop(next(iter(self.entries)))
+            self.entries[file_path] = (st.st_mtime_ns, st.st_size, tree)
+
+        return tree
+
+    def resolve(self, file_path):
+        resolved = os.path.realpath(file_path)
+        if resolved != self.base_path and not resolved.startswith(self.base_path+os.sep):
+            raise TemplateError("Path "+str(file_path)+" is outside the pages directory")
+        return resolved
+
+    def render(self, file_path, context):
+        return TemplateRenderer(self, context).render(file_path)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+class TemplateRenderer:
+    MAX_INCLUDE_DEPTH = 8
+    MAX_ITERATIONS = 10000
+    MAX_RANGE = 10000
+    MAX_OUTPUT = 1000*1000
+
+    def __init__(self, cache, context):
+        self.cache = cache
+        self.iterations = 0
+        self.output_size = 0
+        self.names = TemplateNames({
+            "len": len, "str": str, "int": int, "float": float, "bool": bool,
+            "round": round, "min": min, "max": max, "abs": abs, "sorted": sorted,
+            "reversed": lambda v: list(reversed(v)), "enumerate": lambda v: list(enumerate(v)),
+            "range": self.range, "lower": lambda v: str(v).lower(), "upper": lambda v: str(v).upper(),
+            "join": self.join,
+            "escape": escape, "raw": Raw, "files": self.files, "dirs": self.dirs,
+            "items": lambda v: list(v.items()), "now": time.time, "date": self.date,
+        })
+        self.names.update(context)
+        self.names["request"] = dict(context)
+        self.names["_multiply"] = safe_multiply
+        self.names["_format"] = safe_format
+
+    def range(self, *args):
+        values = range(*args)
+        if len(values) > TemplateRenderer.MAX_RANGE:
+            raise TemplateError("Range too large")
+        return values
+
+    def join(self, values, separator=""):
+        separator = str(separator)
+        parts = []
+        size = 0
+        for value in values:
+            part = str(value)
+            size += len(part)
+            if len(parts) > 0:
+                size += len(separator)
+            if size > TemplateRenderer.MAX_OUTPUT:
+                raise TemplateError("Result of join too large")
+            parts.append(part)
+
+        return separator.join(parts)
+
+    def date(self, format_string="%Y-%m-%d %H:%M", timestamp=None):
+        if timestamp == None:
+            timestamp = time.time()
+        return time.strftime(str(format_string), time.localtime(float(timestamp)))
+
+    def listing(self, path, want_dirs):
+        dir_path = self.cache.resolve(os.path.join(self.cache.base_path, str(path).lstrip("/")))
+        entries = []
+        with os.scandir(dir_path) as scanned:
+            for entry in scanned:
+                if entry.name.startswith(".") or entry.name.endswith(".allowed"):
+                    continue
+                if entry.is_dir() == want_dirs:
+                    entries.append(entry.name)
+
+        return sorted(entries)
+
+    def files(self, path="."):
+        return self.listing(path, False)
+
+    def dirs(self, path="."):
+        return self.listing(path, True)
+
+    def evaluate(self, code):
+        try:
+            return eval(code, {"__builtins__": {}}, self.names)
+        except TemplateError:
+            raise
+        except Exception as e:
+            raise TemplateError("Error in expression: "+str(e))
+
+    def emit(self, output, text):
+        self.output_size += len(text)
+        if self.output_size > TemplateRenderer.MAX_OUTPUT:
+            raise TemplateError("Template output too large")
+        output.append(text)
+
+    def render(self, file_path):
+        output = []
+        self.render_file(self.cache.resolve(file_path), output, 0)
+        return "".join(output)
+
+    def render_file(self, file_path, output, depth):
+        if depth > TemplateRenderer.MAX_INCLUDE_DEPTH:
+            raise TemplateError("Templates included too deeply in "+str(file_path))
+
+        self.render_nodes(self.cache.get(file_path), file_path, output, depth)
+
+    def render_nodes(self, nodes, file_path, output, depth):
+        for node in nodes:
+            node_type = node[0]
+            if node_type == "text":
+                self.emit(output, node[1])
+
+            elif node_type == "expr":
+                value = self.evaluate(node[1])
+                if value == None:
+                    value = ""
+                if isinstance(value, Raw):
+                    self.emit(output, value)
+                else:
+                    self.emit(output, escape(value))
+
+            elif node_type == "if":
+                for condition, body in node[1]:
+                    if self.evaluate(condition):
+                        self.render_nodes(body, file_path, output, depth)
+                        break
+                else:
+                    self.render_nodes(node[2], file_path, output, depth)
+
+            elif node_type == "for":
+                name, value_name, code, body = node[1:]
+                for item in self.evaluate(code):
+                    self.iterations += 1
+                    if self.iterations > TemplateRenderer.MAX_ITERATIONS:
+                        raise TemplateError("Too many loop iterations in "+str(file_path))
+
+                    if value_name == None:
+                        self.names[name] = item
+                    else:
+                        self.names[name], self.names[value_name] = item
+                    self.render_nodes(body, file_path, output, depth)
+
+            elif node_type == "include":
+                include_path = self.cache.resolve(os.path.join(os.path.dirname(file_path), node[1]))
+                self.render_file(include_path, output, depth+1)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("`", "\\`")
@@ -3,6 +3,7 @@ import urwid
 import time
 import os
 import platform
+import collections
 
 import nomadnet
 from nomadnet.ui.textui import *
@@ -209,6 +210,12 @@ class TextUI:
 
         self.loop = urwid.MainLoop(initial_widget, unhandled_input=self.unhandled_input, screen=self.screen, handle_mouse=mouse_enabled)
 
+        # Notifications from other threads are queued, and the
+        # main loop is woken up through a pipe to run them.
+        self.ui_calls = collections.deque()
+        self.ui_call_pipe = self.loop.watch_pipe(self.run_ui_calls)
+        self.app.ui_notifier.set_dispatcher(self.call_on_ui_thread)
+
         if intro_timeout > 0:
             self.loop.set_alarm_in(intro_timeout, self.display_main)
 
@@ -246,5 +253,14 @@ class TextUI:
         elif key == "ctrl e":
             pass
 
+    def call_on_ui_thread(self, callback):
+        self.ui_calls.append(callback)
+        os.write(self.ui_call_pipe, b"\x01")
+
+    def run_ui_calls(self, data):
+        while len(self.ui_calls) > 0:
+            self.ui_calls.popleft()()
+        return True
+
     def display_main(self, loop, user_data):
         self.loop.widget = self.main_display.widget
@@ -2,12 +2,15 @@ import RNS
 import LXMF
 import io
 import os
+import bz2
 import time
 import urwid
 import shutil
+import hashlib
 import nomadnet
 import subprocess
 import threading
+import RNS.vendor.umsgpack as msgpack
 from threading import Lock
 from .MicronParser import markup_to_attrmaps, make_style, default_state
 from nomadnet.Directory import DirectoryEntry
@@ -68,6 +71,16 @@ class Browser:
     DEFAULT_PATH       = "/page/index.mu"
     DEFAULT_TIMEOUT    = 10
     DEFAULT_CACHE_TIME = 12*60*60
+    DOWNLOAD_CHUNK_SIZE = 1024*1024
+    DOWNLOAD_RETRIES   = 5
+    DOWNLOAD_RETRY_DELAY = 5
+    MAX_DECOMPRESSED_PAGE_SIZE = 16*1024*1024
+    PART_SUFFIX        = ".part"
+    PART_INFO_SUFFIX   = ".info"
+    MANIFEST_PATH      = "/file/.manifest"
+    MANIFEST_CACHE_TIME = 10*60
+    PAGE_VARIANT_PATH  = "/page/.bz2"
+    FILE_VARIANT_PATH  = "/file/.bz2"
 
     NO_PATH            = 0x00
     PATH_REQUESTED     = 0x01
@@ -79,6 +92,7 @@ class Browser:
     REQUEST_FAILED     = 0x07
     REQUEST_TIMEOUT    = 0x08
     RECEIVING_RESPONSE = 0x09
+    RETRY_WAITING      = 0x0A
     DISCONECTED        = 0xFE
     DONE               = 0xFF
 
@@ -108,6 +122,15 @@ class Browser:
         self.saved_file_name = None
         self.saved_file_size = 0
         self.file_saved_at = 0
+        self.download_path = None
+        self.download_data = None
+        self.download_offset = 0
+        self.download_total = None
+        self.download_variant = False
+        self.download_retries = 0
+        self.retry_reason = None
+        self.file_manifests = {}
+        self.manifest_support = {}
         self.file_save_notice_timeout = 3
         self.page_data = None
         self.displayed_page_data = None
@@ -885,7 +908,210 @@ class Browser:
             self.update_display()
 
         if self.link != None and self.link.destination.hash == self.destination_hash:
-            # Send the request
+            # Looking up the file in the node's manifest, and
+            # hashing a local copy, can take a while, so the
+            # download is started from a separate thread.
+            self.status = Browser.REQUESTING
+            self.update_display()
+            download_thread = threading.Thread(target=self.__start_download, args=(path, data))
+            download_thread.setDaemon(True)
+            download_thread.start()
+
+    def __start_download(self, path, data):
+        # The node's manifest entry for the file is looked up
+        # before downloading, to find out whether a local copy
+        # is already up to date, and whether a compressed
+        # variant is available. Nodes are only asked if a local
+        # copy exists, or if they are known to serve a manifest.
+        entry = self.cached_entry(path)
+        if entry == False:
+            entry = None
+            serves_manifest = self.serves_manifest()
+            local_copy = os.path.isfile(self.app.downloads_path+"/"+os.path.basename(path))
+            if serves_manifest == True or (local_copy and serves_manifest != False):
+                entry = self.lookup_file(path)
+
+        try:
+            if self.local_copy_matches(path, entry):
+                self.status = Browser.DONE
+                self.response_progress = 0
+                self.update_display()
+                return
+
+            # If an earlier download of this file was interrupted,
+            # resume it from where the partial file ends.
+            self.download_path = path
+            self.download_data = data
+            self.download_total = None
+            self.download_offset = 0
+            self.download_retries = 0
+            self.download_variant = entry != None and entry["variant"] != None and (data == None or isinstance(data, dict))
+            part_path = self.part_path(path, compressed=self.download_variant)
+            if os.path.isfile(part_path):
+                self.download_offset = os.path.getsize(part_path)
+                RNS.log("Resuming download of "+str(path)+" from byte "+str(self.download_offset), RNS.LOG_DEBUG)
+
+            self.saved_file_name = None
+            self.saved_file_size = 0
+            self.request_file_range(self.download_offset)
+
+        except Exception as e:
+            RNS.log("An error occurred while starting download of "+str(path)+". The contained exception was: "+str(e), RNS.LOG_ERROR)
+            self.request_failed()
+
+    # Looks up a single file in the node's manifest. Nodes
+    # that do not support lookups return their full manifest,
+    # which is handled the same way. Results are cached per
+    # node and path, and failures are cached too, so nodes
+    # that do not serve a manifest are not asked every time.
+    def lookup_file(self, path):
+        cached = self.cached_entry(path)
+        if cached != False:
+            return cached
+
+        received = threading.Event()
+        result = {"entry": None}
+        def manifest_received(request_receipt):
+            response = request_receipt.response
+            if isinstance(response, dict) and isinstance(response.get("files", None), dict):
+                variants = response.get("variants", None)
+                if not isinstance(variants, dict):
+                    variants = {}
+
+                result["entry"] = {
+                    "file": response["files"].get(path.replace("/file/", "", 1), None),
+                    "variant": variants.get(path, None),
+                }
+            received.set()
+
+        def manifest_failed(request_receipt):
+            received.set()
+
+        receipt = self.link.request(Browser.MANIFEST_PATH, data={"path": path}, response_callback=manifest_received, failed_callback=manifest_failed)
+        if receipt:
+            received.wait(self.timeout)
+
+        self.file_manifests[(self.destination_hash, path)] = (time.time(), result["entry"])
+        self.manifest_support[self.destination_hash] = (time.time(), result["entry"] != None)
+        return result["entry"]
+
+    # Returns whether the current node answered its last
+    # manifest lookup, or None if it has not been asked
+    # recently.
+    def serves_manifest(self):
+        support = self.manifest_support.get(self.destination_hash, None)
+        if support != None and time.time() < support[0]+Browser.MANIFEST_CACHE_TIME:
+            return support[1]
+
+        return None
+
+    # Returns the cached manifest entry for a path, None if
+    # the lookup failed, or False if the path has not been
+    # looked up recently. This never sends a request.
+    def cached_entry(self, path):
+        cached = self.file_manifests.get((self.destination_hash, path), None)
+        if cached != None and time.time() < cached[0]+Browser.MANIFEST_CACHE_TIME:
+            return cached[1]
+
+        return False
+
+    def cached_variant(self, path):
+        entry = self.cached_entry(path)
+        return entry != None and entry != False and entry["variant"] != None
+
+    # If a file with the same name was already downloaded,
+    # the node's file manifest is used to check whether it
+    # has changed, and the download is skipped if not.
+    def local_copy_matches(self, path, entry):
+        try:
+            file_name = os.path.basename(path)
+            local_path = self.app.downloads_path+"/"+file_name
+            if not os.path.isfile(local_path):
+                return False
+
+            if entry == None or entry["file"] == None:
+                return False
+
+            entry = entry["file"]
+            if entry[0] != os.path.getsize(local_path):
+                return False
+
+            file_hash = hashlib.sha256()
+            with open(local_path, "rb") as fh:
+                while True:
+                    chunk = fh.read(1024*1024)
+                    if not chunk:
+                        break
+                    file_hash.update(chunk)
+
+            if file_hash.digest() == entry[1]:
+                RNS.log("Local copy of "+str(path)+" is identical to the file on the node, skipping download", RNS.LOG_DEBUG)
+                self.saved_file_name = file_name
+                self.saved_file_size = entry[0]
+                self.file_saved_at = time.time()
+                return True
+
+        except Exception as e:
+            RNS.log("Could not compare "+str(path)+" with local copy: "+str(e), RNS.LOG_DEBUG)
+
+        return False
+
+    # Partial files are named by the node and the path of the
+    # file on it, so files with the same name from different
+    # nodes or directories do not collide.
+    def part_path(self, path, compressed=False):
+        file_name = os.path.basename(path)
+        source = RNS.hexrep(RNS.Identity.full_hash(self.destination_hash+path.encode("utf-8"))[:8], delimit=False)
+        if compressed:
+            return self.app.downloads_path+"/"+file_name+"."+source+".bz2"+Browser.PART_SUFFIX
+        else:
+            return self.app.downloads_path+"/"+file_name+"."+source+Browser.PART_SUFFIX
+
+    # Returns the hash of a file from the node's manifest, if
+    # the file was looked up and is listed in it.
+    def manifest_hash(self, path):
+        entry = self.cached_entry(path)
+        if entry != None and entry != False and entry["file"] != None:
+            return entry["file"][1]
+
+        return None
+
+    # The expected size of the download, and the hash of the
+    # file if the node's manifest listed it, are saved next
+    # to the partial file when a download starts. A partial
+    # file is only resumed if these still match the file on
+    # the node, so a file that changed is downloaded again.
+    def write_part_info(self, part_path, total_size, file_hash):
+        with open(part_path+Browser.PART_INFO_SUFFIX, "wb") as fh:
+            fh.write(msgpack.packb({"size": total_size, "hash": file_hash}))
+
+    def part_matches(self, part_path, start, total_size, file_hash):
+        try:
+            if not os.path.isfile(part_path) or os.path.getsize(part_path) < start:
+                return False
+
+            with open(part_path+Browser.PART_INFO_SUFFIX, "rb") as fh:
+                info = msgpack.unpackb(fh.read())
+
+            if info["size"] != total_size:
+                return False
+
+            if info["hash"] != None and file_hash != None and info["hash"] != file_hash:
+                return False
+
+            return True
+
+        except Exception as e:
+            RNS.log("Could not read information for partial file "+str(part_path)+": "+str(e), RNS.LOG_DEBUG)
+            return False
+
+    def remove_part(self, part_path):
+        for remove_path in [part_path, part_path+Browser.PART_INFO_SUFFIX]:
+            if os.path.isfile(remove_path):
+                os.unlink(remove_path)
+
+    def request_file_range(self, offset):
+        if self.link != None:
             self.status = Browser.REQUESTING
             self.response_progress = 0
             self.response_speed = None
@@ -893,12 +1119,27 @@ class Browser:
             self.previous_progress = 0
             self.response_size = None
             self.response_transfer_size = None
-            self.saved_file_name = None
-            self.saved_file_size = 0
+
+            # Files are requested in ranges, so an interrupted
+            # transfer only loses the range in progress. Nodes
+            # that do not support ranges will return the whole
+            # file, which is handled like any other download.
+            data = self.download_data
+            if data == None or isinstance(data, dict):
+                data = dict(data) if data != None else {}
+                data["range"] = [offset, offset+Browser.DOWNLOAD_CHUNK_SIZE]
+
+            # If the node has a compressed variant of the file,
+            # it is downloaded instead, and decompressed once
+            # all of it has been received.
+            request_path = self.download_path
+            if self.download_variant:
+                data["path"] = self.download_path
+                request_path = Browser.FILE_VARIANT_PATH
 
             self.update_display()
             receipt = self.link.request(
-                path,
+                request_path,
                 data = data,
                 response_callback = self.file_received,
                 failed_callback = self.request_failed,
@@ -913,6 +1154,35 @@ class Browser:
             else:
                 self.link.teardown()
 
+    # Waits for a while before requesting the current range
+    # of a download again, backing off on every attempt. If
+    # the node is still busy after all retries, the request
+    # fails, but the link is kept open so the download can
+    # be resumed from the same link.
+    def retry_download(self, request_receipt):
+        self.retry_reason = response_title(request_receipt.response)
+        if self.download_retries >= Browser.DOWNLOAD_RETRIES:
+            RNS.log("Giving up download of "+str(self.download_path)+" after "+str(self.download_retries)+" retries", RNS.LOG_DEBUG)
+            self.status = Browser.REQUEST_FAILED
+            self.response_progress = 0
+            self.update_display()
+            return
+
+        delay = Browser.DOWNLOAD_RETRY_DELAY*2**self.download_retries
+        self.download_retries += 1
+        self.status = Browser.RETRY_WAITING
+        self.update_display()
+        RNS.log("Retrying download of "+str(self.download_path)+" from byte "+str(self.download_offset)+" in "+str(delay)+" seconds", RNS.LOG_DEBUG)
+
+        def job():
+            if self.status == Browser.RETRY_WAITING and self.last_request_id == request_receipt.request_id:
+                if self.link != None and self.link.status == RNS.Link.ACTIVE:
+                    self.request_file_range(self.download_offset)
+
+        timer = threading.Timer(delay, job)
+        timer.daemon = True
+        timer.start()
+
     def write_history(self):
         entry = [self.destination_hash, self.path, self.request_data]
         self.history.insert(self.history_ptr, entry)
@@ -1239,10 +1509,24 @@ class Browser:
         self.saved_file_size = 0
 
 
+        # Let the node know that large pages can be sent
+        # as file resources, so it can serve them from disk.
+        request_path = self.path
+        request_data = self.request_data
+        if request_data == None or isinstance(request_data, dict):
+            request_data = dict(request_data) if request_data != None else {}
+            request_data["file_response"] = True
+
+            # If the node's manifest lists a compressed variant
+            # of the page, it is requested instead.
+            if self.cached_variant(self.path):
+                request_data["path"] = self.path
+                request_path = Browser.PAGE_VARIANT_PATH
+
         self.update_display()
         receipt = self.link.request(
-            self.path,
-            data = self.request_data,
+            request_path,
+            data = request_data,
             response_callback = self.response_received,
             failed_callback = self.request_failed,
             progress_callback = self.response_progressed
@@ -1292,7 +1576,19 @@ class Browser:
     def response_received(self, request_receipt):
         try:
             self.status = Browser.DONE
-            self.page_data = request_receipt.response
+            if type(request_receipt.response) == io.BufferedReader:
+                file_handle = request_receipt.response
+                self.page_data = file_handle.read()
+                file_handle.close()
+                try: os.unlink(file_handle.name)
+                except: pass
+                if request_receipt.metadata != None and request_receipt.metadata.get("encoding", None) == "bz2":
+                    max_size = request_receipt.metadata.get("decompressed_size", Browser.MAX_DECOMPRESSED_PAGE_SIZE)
+                    decompressed = io.BytesIO()
+                    decompress_bounded(io.BytesIO(self.page_data), decompressed, min(max_size, Browser.MAX_DECOMPRESSED_PAGE_SIZE))
+                    self.page_data = decompressed.getvalue()
+            else:
+                self.page_data = request_receipt.response
             self.markup = self.page_data.decode("utf-8")
 
             self.page_background_color = None
@@ -1435,8 +1731,97 @@ class Browser:
 
     def file_received(self, request_receipt):
         try:
-            if type(request_receipt.response) == io.BufferedReader:
-                if request_receipt.metadata != None:
+            if type(request_receipt.response) == bytes:
+                # The node answered with a page instead of the
+                # file, which happens when it is too busy, or
+                # the rate limit was exceeded. The same range is
+                # requested again on the same link after a while,
+                # so the download can continue where it stopped.
+                RNS.log("The node did not return the requested file, it may be too busy to handle the request", RNS.LOG_DEBUG)
+                if request_receipt.request_id == self.last_request_id:
+                    self.retry_download(request_receipt)
+                return
+
+            elif type(request_receipt.response) == io.BufferedReader:
+                if request_receipt.metadata != None and "range" in request_receipt.metadata and "size" in request_receipt.metadata:
+                    file_name   = os.path.basename(request_receipt.metadata["name"].decode("utf-8"))
+                    file_handle = request_receipt.response
+                    start, end  = request_receipt.metadata["range"]
+                    total_size  = request_receipt.metadata["size"]
+                    compressed  = request_receipt.metadata.get("encoding", None) == "bz2"
+                    part_path   = self.part_path(self.download_path, compressed=compressed)
+                    file_hash   = self.manifest_hash(self.download_path)
+                    self.download_total = total_size
+
+                    if start > 0 and not self.part_matches(part_path, start, total_size, file_hash):
+                        # The partial file does not match the range we got,
+                        # or the file on the node has changed since it was
+                        # started, so start the download over.
+                        RNS.log("Partial file for "+str(self.download_path)+" does not match the file on the node, restarting download", RNS.LOG_DEBUG)
+                        self.remove_part(part_path)
+                        self.download_offset = 0
+                        self.request_file_range(0)
+                        return
+
+                    if start == 0:
+                        self.write_part_info(part_path, total_size, file_hash)
+                        part_file = open(part_path, "wb")
+                    else:
+                        part_file = open(part_path, "r+b")
+                        part_file.truncate(start)
+                        part_file.seek(start)
+
+                    shutil.copyfileobj(file_handle, part_file)
+                    part_file.close()
+                    file_handle.close()
+                    try: os.unlink(file_handle.name)
+                    except: pass
+
+                    self.download_retries = 0
+                    if end < total_size:
+                        self.download_offset = end
+                        self.request_file_range(end)
+                        return
+
+                    file_destination = self.app.downloads_path+"/"+file_name
+                    counter = 0
+                    while os.path.isfile(file_destination):
+                        counter += 1
+                        file_destination = self.app.downloads_path+"/"+file_name+"."+str(counter)
+
+                    if compressed:
+                        try:
+                            # The compressed data is never allowed to expand
+                            # beyond the size the node advertised for the file.
+                            max_size = request_receipt.metadata.get("decompressed_size", None)
+                            if max_size == None:
+                                entry = self.cached_entry(self.download_path)
+                                if entry != None and entry != False and entry["file"] != None:
+                                    max_size = entry["file"][0]
+                            if max_size == None:
+                                raise ValueError("The node did not advertise the decompressed size of the file")
+
+                            with open(part_path, "rb") as source, open(file_destination, "wb") as destination:
+                                decompress_bounded(source, destination, max_size)
+                        except Exception as e:
+                            if os.path.isfile(file_destination):
+                                os.unlink(file_destination)
+                            self.remove_part(part_path)
+                            raise e
+                        self.remove_part(part_path)
+                    else:
+                        os.replace(part_path, file_destination)
+                        self.remove_part(part_path)
+
+                    self.download_total = None
+                    self.download_offset = 0
+
+                    self.saved_file_name = file_destination.replace(self.app.downloads_path+"/", "", 1)
+                    try: self.saved_file_size = os.path.getsize(file_destination)
+                    except: self.saved_file_size = 0
+                    self.file_saved_at = time.time()
+
+                elif request_receipt.metadata != None:
                     file_name   = os.path.basename(request_receipt.metadata["name"].decode("utf-8"))
                     file_handle = request_receipt.response
                     file_destination = self.app.downloads_path+"/"+file_name
@@ -1537,6 +1922,9 @@ class Browser:
 
     def response_progressed(self, request_receipt):
         self.response_progress      = request_receipt.progress
+        if self.download_total and request_receipt.request_id == self.last_request_id:
+            chunk_size = min(Browser.DOWNLOAD_CHUNK_SIZE, self.download_total-self.download_offset)
+            self.response_progress = (self.download_offset+request_receipt.progress*chunk_size)/self.download_total
         self.response_time          = request_receipt.get_response_time()
         self.response_size          = request_receipt.response_size
         self.response_transfer_size = request_receipt.response_transfer_size
@@ -1590,6 +1978,9 @@ class Browser:
             return "Request timed out"
         elif self.status == Browser.RECEIVING_RESPONSE:
             return "Receiving response..."
+        elif self.status == Browser.RETRY_WAITING:
+            reason = self.retry_reason if self.retry_reason != None else "Node Busy"
+            return reason+", retrying download..."
         elif self.status == Browser.DONE:
             if self.saved_file_name == None: return "Done"+stats_string
             else:                            return "Saved "+str(self.saved_file_name)+stats_string
@@ -1609,6 +2000,27 @@ class ResponseProgressBar(urwid.ProgressBar):
         else: speed_str = ""
         return "Receiving response "+super().get_text().replace(" %", "%")+speed_str
 
+# Decompresses bz2 data from one file object to another,
+# and fails as soon as the output exceeds max_size.
+def decompress_bounded(source, destination, max_size, chunk_size=1024*1024):
+    decompressor = bz2.BZ2Decompressor()
+    written = 0
+    while not decompressor.eof:
+        if decompressor.needs_input:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                raise ValueError("Compressed data ended before the end of the stream")
+        else:
+            chunk = b""
+
+        output = decompressor.decompress(chunk, max_length=chunk_size)
+        written += len(output)
+        if written > max_size:
+            raise ValueError("Decompressed data exceeds the advertised size of "+str(max_size)+" bytes")
+        destination.write(output)
+
+    return written
+
 # A convenience function for printing a human-
 # readable file size
 def size_str(num, suffix='B'):
@@ -1630,6 +2042,18 @@ def size_str(num, suffix='B'):
 
     return "%.2f%s%s" % (num, last_unit, suffix)
 
+# Returns the title of a short status page sent by a node,
+# such as the busy and rate limit pages.
+def response_title(response):
+    try:
+        for line in response.decode("utf-8").split("\n"):
+            if line.startswith(">") and line.strip(">").strip() != "":
+                return line.strip(">").strip()
+    except Exception as e:
+        pass
+
+    return None
+
 class UrlDialogLineBox(urwid.LineBox):
     def keypress(self, size, key):
         if key == "esc":
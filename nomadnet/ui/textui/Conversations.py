@@ -134,6 +134,7 @@ class ConversationsDisplay():
         self.shortcuts_display = self.list_shortcuts
         self.widget = self.columns_widget
         nomadnet.Conversation.created_callback = self.update_conversation_list
+        self.app.ui_notifier.register("conversations", self.update_conversation_list)
 
     def focus_change_event(self):
         if not self.dialog_open:
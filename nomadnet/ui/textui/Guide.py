@@ -334,13 +334,28 @@ You can use a preprocessor such as PHP, bash, Python (or whatever you prefer) to
 
 Data from fields and link variables will be passed to these scipts or programs as environment variables, and can simply be read by any method for accessing such.
 
+If the output of a dynamic page starts with a cache header, the node will also keep the output for that long, and serve it to later requests on the same link with the same request variables and identity, without running the script again. If the output of your page only depends on some of the request variables, you can list them in a `!#!k=`! header, placed after the cache header, for example `!#!k=var_topic,field_page`!. Variables listed in the key header replace the default key entirely, so to share output between visitors on different links, list only the variables your page uses. An empty `!#!k=`! header means that every visitor gets the same output.
+
+Starting a new interpreter for every request can be slow on small devices. For pages written in Python, you can list them in the `*worker_pages`* option in the `*[node]`* section of the configuration file. Such pages are served by a small pool of long-lived worker processes that keep the interpreter and any imported modules loaded between requests. The script is still run from the top for every request, with the request variables set in its environment, and anything it prints to stdout is returned as the page. Output from programs started by the script is not captured in this mode.
+
+For simple dynamic pages, you can also write a micron template, which is a page with a name ending in `!.mut`!. Templates are rendered by the node itself, so no program is started for each request. A template is a normal micron page, in which `!{{ expression }}`! inserts a value, and `!{% if expression %}`!, `!{% for name in expression %}`! and `!{% include "other.mut" %}`! can be used to build the page. Expressions can use the same request variables as scripts, such as `!field_name`!, `!var_name`! and `!remote_identity`!, as well as a few helper functions like `!files("path")`!, `!len()`! and `!date("%H:%M")`!. Inserted values have micron formatting escaped, unless wrapped in `!raw()`!. Templates can not run arbitrary code, and the cache headers described above work for templates too.
+
+Scripts that run for longer than one minute are stopped, and so are any programs they started. The page is then not sent. Output larger than 16 megabytes is discarded, and large output is written to a temporary file instead of being kept in memory. You can change these limits with the `*page_timeout`* and `*max_page_output`* options.
+
 In the `!examples`! directory, you can find various small examples for the use of this feature. The currently included examples are:
 
  - A messageboard that receives messages over LXMF, contributed by trippcheng
  - A simple demonstration on how to create fields and read entered data in node-side scripts
+ - A micron template that reads fields and lists the pages of the node
 
 By default, you can find the examples in `!~/.nomadnetwork/examples`!. If you build something neat, that you feel would fit here, you are more than welcome to contribute it.
 
+>>Request Metrics and Limits
+
+To find out which pages and scripts take the most time to serve, the node keeps metrics for every requested path, with request counts, bytes served and how long requests took. The busiest paths and the current request rate are shown under `!Local Node Info`! in the `![ Network ]`! part of the program. The `!Export Metrics`! button writes the full metrics to `!metrics.mu`! and `!metrics.json`! in the storage directory, and the `*metrics_export_interval`* option can be used to write them periodically.
+
+Each remote identity, or each link for peers that have not identified, may only send a limited number of requests per minute, so a single client cannot keep the node busy. The limits can be set for different parts of the node with the `*rate_limits`* option, for example `!rate_limits = /page:60:20, /page/board:10:5, /file:120:40`!, where the numbers are the requests allowed per minute and the size of a short burst. Requests over the limit are answered with a short "Too Many Requests" page. Files are downloaded in parts, but only the first part of a download counts against the limit.
+
 >>Authenticating Users
 
 Sometimes, you don't want everyone to be able to view certain pages or execute certain scripts. In such cases, you can use `*authentication`* to control who gets to run certain requests.
@@ -359,12 +374,22 @@ d454bcdac0e64fb68ba8e267543ae110
 
 You can also dynamically generate this list, by making the file executable, and writing a script (in whatever language you want), that prints the list to stdout. Every time someone tries to request the page, Nomad Network will check the allowed identities list, and only grant access to allowed users.
 
+By default, the script is run again for every request. If the list does not need to be that current, the script can print a `!#!c=X`! line, where `!X`! is the number of seconds Nomad Network is allowed to re-use the generated list for, before running the script again.
+
+You can also protect an entire directory of pages, by adding a file with ".allowed" added to the name of the directory. If you have a directory named "private", a file named "private.allowed" next to it will apply to all pages in that directory and its subdirectories. If a page is covered by several lists, the requesting user must be allowed by all of them.
+
 By default, Nomad Network connects anonymously to all nodes. To be able to identify, and access restricted pages, you must allow identifying on a per-node basis. To allow identifying when connecting to a node, you must go to the `!Known Nodes`! list in the `![ Network ]`! part of the program, and enable the `!Identify When Connecting`! checkbox under `!Node Info`!.
 
 >>Files
 
 Like pages, you can place files you want to make available in the `!~/.nomadnetwork/storage/files`! directory. To let a peer download a file, you should create a link to it in one of your pages.
 
+Nodes also publish a list of the SHA-256 hashes of their files. If a file with the same name already exists in your downloads directory, Nomad Network checks it against this list first, and skips the download if your copy is identical.
+
+Files are downloaded in parts of up to one megabyte. If a download is interrupted, the parts received so far are kept in a file ending in `!.part`! in your downloads directory, and the download continues from there the next time you open the same link. If the file has changed on the node in the meantime, the download starts over.
+
+To save processing power on the node, static pages and files can be compressed in the background when they are added or changed, and the compressed versions are kept in the `!~/.nomadnetwork/storage/variants`! directory. Before downloading a file, Nomad Network looks it up in the file list of the node, and if a compressed version is listed, downloads that instead and decompresses it when it has been received. Since the compressed versions can take up as much disk space again as the pages and files themselves, this is disabled by default, and can be enabled with the `!precompress_content`! option in the `![node]`! section of the configuration file.
+
 >>Links and URLs
 
 Links to pages and resources in Nomad Network use a simple URL format. Here is an example:
@@ -765,6 +790,18 @@ The maximum accepted unpacked size for messages received directly from other pee
 With this option enabled, Nomad Network will only display one entry in the announce stream per destination. Older announces are culled when a new one arrives.
 <
 
+>>>
+`!announce_stream_length = 4096`!
+>>>>
+The number of announces of each type, that are kept in memory and shown in the announce stream.
+<
+
+>>>
+`!announce_history_days = 7`!
+>>>>
+Announces that no longer fit in the announce stream are moved to a history on disk, and are kept there for this many days. Older announces can be loaded from the history by selecting `!Load older announces`! at the end of the announce stream. Set to 0 to disable the announce history.
+<
+
 >> Text UI Section
 
 This section hold configuration directives related to the look and feel of the text-based user interface of the program. It is delimited by the `![textui]`! header in the configuration file. Available directives, along with their default values, are as follows:
@@ -821,6 +858,12 @@ This option allows hiding the `![ Guide ]`! section of the program.
 Sets the animation refresh rate for certain animations and graphics in the program. Must be an integer.
 <
 
+>>>
+`!refresh_interval = 2`!
+>>>>
+When announces arrive, the announce stream, known nodes and conversation list are refreshed at most once per this many seconds. Changes arriving in between are collected into a single refresh.
+<
+
 >>>
 `!colormode = 256`!
 >>>>
@@ -865,6 +908,8 @@ Determines whether your node is automatically announced on the network when the
 `!announce_interval = 360`!
 >>>>
 Determines how often, in minutes, your node is announced on the network. Defaults to 6 hours.
+
+Announces are not sent at exact times. Startup announces are delayed by up to 30 seconds, and periodic announces vary by up to 10% of the interval, so that nodes restarting at the same time do not announce all at once. If an interface reports queued announces or a high channel load, announces are held back for a while before being sent.
 <
 
 >>>
@@ -387,6 +387,9 @@ class TabButton(urwid.Button):
     button_right = urwid.Text("]")
 
 class AnnounceStream(urwid.WidgetWrap):
+    PAGE_SIZE = 200
+    TAB_TYPES = {"nodes": "node", "peers": "peer", "pn": "pn"}
+
     def __init__(self, app, parent):
         self.app = app
         self.parent = parent
@@ -397,6 +400,9 @@ class AnnounceStream(urwid.WidgetWrap):
         self.current_tab = "nodes"
         self.show_destination = False
         self.search_text = ""
+        self.shown_from_memory = 0
+        self.oldest_timestamp = None
+        self.reset_paging()
 
         self.added_entries = []
         self.widget_list = []
@@ -465,6 +471,7 @@ class AnnounceStream(urwid.WidgetWrap):
         if sel != None and hasattr(sel, "original_widget") and sel.original_widget:
             if hasattr(sel.original_widget, "timestamp"):
                 self.app.directory.remove_announce_with_timestamp(sel.original_widget.timestamp)
+                self.history_entries = [e for e in self.history_entries if e[0] != sel.original_widget.timestamp]
                 self.rebuild_widget_list()
 
     def rebuild_widget_list(self):
@@ -473,9 +480,47 @@ class AnnounceStream(urwid.WidgetWrap):
         self.widget_list = []
         self.update_widget_list()
 
+    def matches_search(self, e):
+        if self.search_text:
+            try:
+                announce_data = e[2].decode("utf-8").lower()
+            except:
+                announce_data = ""
+            if self.search_text not in announce_data:
+                return False
+
+        return True
+
+    # Only a page of announces is shown at first. Selecting
+    # the button at the end of the list shows another page,
+    # and once all announces in memory are shown, pages of
+    # older announces are loaded from the announce history.
+    def load_older_entries(self, sender=None):
+        self.display_limit += AnnounceStream.PAGE_SIZE
+        if not self.history_exhausted and self.shown_from_memory < self.display_limit:
+            if len(self.history_entries) > 0:
+                before = self.history_entries[-1][0]
+            else:
+                before = self.oldest_timestamp
+
+            announce_type = AnnounceStream.TAB_TYPES[self.current_tab]
+            page = self.app.directory.announce_history(announce_type, before=before, limit=AnnounceStream.PAGE_SIZE)
+            if len(page) < AnnounceStream.PAGE_SIZE:
+                self.history_exhausted = True
+            self.history_entries.extend(page)
+
+        self.update_widget_list()
+
+    def reset_paging(self):
+        self.display_limit = AnnounceStream.PAGE_SIZE
+        self.history_entries = []
+        self.history_exhausted = self.app.directory.history == None
+
     def update_widget_list(self):
         self.widget_list = []
         new_entries = []
+        more_entries = False
+        self.oldest_timestamp = None
 
         node_count = 0
         peer_count = 0
@@ -483,37 +528,46 @@ class AnnounceStream(urwid.WidgetWrap):
 
         for e in self.app.directory.announce_stream:
             announce_type = e[3]
+            if announce_type == True: announce_type = "node"
+            elif announce_type == False: announce_type = "peer"
 
-            if self.search_text:
-                try:
-                    announce_data = e[2].decode("utf-8").lower()
-                except:
-                    announce_data = ""
-                if self.search_text not in announce_data:
-                    continue
+            in_tab = announce_type == AnnounceStream.TAB_TYPES[self.current_tab]
+            if in_tab:
+                self.oldest_timestamp = e[0]
+
+            if not self.matches_search(e):
+                continue
 
-            if announce_type == "node" or announce_type == True:
+            if announce_type == "node":
                 node_count += 1
-                if self.current_tab == "nodes": new_entries.append(e)
-            
-            elif announce_type == "peer" or announce_type == False:
+            elif announce_type == "peer":
                 peer_count += 1
-                if self.current_tab == "peers": new_entries.append(e)
-
             elif announce_type == "pn":
                 pn_count += 1
-                if self.current_tab == "pn": new_entries.append(e)
+
+            if in_tab:
+                if len(new_entries) < self.display_limit: new_entries.append(e)
+                else: more_entries = True
+
+        self.shown_from_memory = len(new_entries)
+        for e in self.history_entries:
+            if self.matches_search(e):
+                if len(new_entries) < self.display_limit: new_entries.append(e)
+                else: more_entries = True
 
         for e in new_entries:
             nw = AnnounceStreamEntry(self.app, e, self, show_destination=self.show_destination)
             nw.timestamp = e[0]
             self.widget_list.append(nw)
 
+        if more_entries or not self.history_exhausted:
+            self.widget_list.append(urwid.Button("Load older announces", on_press=self.load_older_entries))
+
         if len(new_entries) > 0:
             self.no_content = False
         else:
             self.no_content = True
-            self.widget_list = [urwid.Text(f"No {self.current_tab} announces", align='center')]
+            self.widget_list = [urwid.Text(f"No {self.current_tab} announces", align='center')]+self.widget_list
 
         self.tab_nodes.set_label(f"Nodes ({node_count})")
         self.tab_peers.set_label(f"Peers ({peer_count})")
@@ -524,14 +578,17 @@ class AnnounceStream(urwid.WidgetWrap):
 
     def show_nodes_tab(self, button):
         self.current_tab = "nodes"
+        self.reset_paging()
         self.update_widget_list()
 
     def show_peers_tab(self, button):
         self.current_tab = "peers"
+        self.reset_paging()
         self.update_widget_list()
 
     def show_pn_tab(self, button):
         self.current_tab = "pn"
+        self.reset_paging()
         self.update_widget_list()
 
     def list_selection(self, arg1, arg2):
@@ -1201,6 +1258,7 @@ class NodeTotalPages(urwid.WidgetWrap):
         self.stat_string = "None"
         if self.app.node != None:
             self.stat_string = str(self.app.peer_settings["served_page_requests"])
+            self.stat_string += " ("+str(len(self.app.node.page_registry.files))+" hosted)"
 
         self.display_widget.set_text("Served Pages   : "+self.stat_string)
 
@@ -1233,6 +1291,7 @@ class NodeTotalFiles(urwid.WidgetWrap):
         self.stat_string = "None"
         if self.app.node != None:
             self.stat_string = str(self.app.peer_settings["served_file_requests"])
+            self.stat_string += " ("+str(len(self.app.node.file_registry.files))+" hosted)"
 
         self.display_widget.set_text("Served Files   : "+self.stat_string)
 
@@ -1251,6 +1310,57 @@ class NodeTotalFiles(urwid.WidgetWrap):
         self.started = False
 
 
+class NodeMetrics(urwid.WidgetWrap):
+    HOT_PATHS = 3
+
+    def __init__(self, app):
+        self.started = False
+        self.app = app
+        self.timeout = self.app.config["textui"]["animation_interval"]*5
+        self.display_widget = urwid.Text("")
+        self.update_stat()
+
+        super().__init__(self.display_widget)
+
+    def update_stat(self):
+        rate_string = "None"
+        path_strings = ["None"]
+        if self.app.node != None:
+            metrics = self.app.node.metrics
+            rates = metrics.identity_rates()
+            total_rate = sum(e[2] for e in rates)
+            rate_string = str(round(total_rate, 1))+"/min from "+str(len(rates))+" peers ("+str(metrics.RATE_WINDOW//60)+"m)"
+
+            hot_paths = metrics.hot_paths(NodeMetrics.HOT_PATHS)
+            if len(hot_paths) > 0:
+                path_strings = []
+                for path, entry in hot_paths:
+                    p95 = entry["p95_ms"]
+                    if p95 == None:
+                        p95_str = ">"+str(metrics.LATENCY_BUCKETS[-1])+"ms"
+                    else:
+                        p95_str = "<"+str(p95)+"ms"
+                    path_strings.append(path+", "+str(entry["requests"])+" req, p95 "+p95_str)
+
+        text = "Request Rate   : "+rate_string+"\n"
+        text += "Hot Paths      : "+("\n"+" "*17).join(path_strings)
+        self.display_widget.set_text(text)
+
+    def update_stat_callback(self, loop=None, user_data=None):
+        self.update_stat()
+        if self.started:
+            self.app.ui.loop.set_alarm_in(self.timeout, self.update_stat_callback)
+
+    def start(self):
+        was_started = self.started
+        self.started = True
+        if not was_started:
+            self.update_stat_callback()
+
+    def stop(self):
+        self.started = False
+
+
 class LocalPeer(urwid.WidgetWrap):
     announce_timer = None
 
@@ -1356,6 +1466,7 @@ class NodeInfo(urwid.WidgetWrap):
     pages_timer = None
     files_timer = None
     storage_timer = None
+    metrics_timer = None
 
     def __init__(self, app, parent):
         self.app = app
@@ -1387,6 +1498,30 @@ class NodeInfo(urwid.WidgetWrap):
                 self.app.peer_settings["served_page_requests"] = 0
                 self.app.peer_settings["served_file_requests"] = 0
                 self.app.save_peer_settings()
+                self.app.node.metrics.reset()
+
+            def export_query(sender):
+                def dismiss_dialog(sender):
+                    self.dialog_open = False
+                    options = self.parent.left_pile.options(height_type=urwid.PACK, height_amount=None)
+                    self.parent.left_pile.contents[1] = (NodeInfo(self.app, self.parent), options)
+
+                if self.app.node.export_metrics():
+                    export_text = "\n\nMetrics exported to\n"+self.app.storagepath+"/metrics.mu\nand metrics.json\n\n"
+                else:
+                    export_text = "\n\nCould not export metrics,\ncheck the log for details\n\n"
+
+                dialog = DialogLineBox(
+                    urwid.Pile([
+                        urwid.Text(export_text, align=urwid.CENTER),
+                        urwid.Button("OK", on_press=dismiss_dialog)
+                    ]), title=g["info"]
+                )
+                dialog.delegate = self
+
+                self.dialog_open = True
+                options = self.parent.left_pile.options(height_type=urwid.PACK, height_amount=None)
+                self.parent.left_pile.contents[1] = (dialog, options)
 
             def announce_query(sender):
                 def dismiss_dialog(sender):
@@ -1457,12 +1592,20 @@ class NodeInfo(urwid.WidgetWrap):
                 self.t_total_files = NodeInfo.files_timer
                 self.t_total_files.update_stat()
 
+            if NodeInfo.metrics_timer == None:
+                self.t_metrics = NodeMetrics(self.app)
+                NodeInfo.metrics_timer = self.t_metrics
+            else:
+                self.t_metrics = NodeInfo.metrics_timer
+                self.t_metrics.update_stat()
+
             lxmf_addr_str = g["sent"]+" LXMF Propagation Node Address is "+RNS.prettyhexrep(RNS.Destination.hash_from_name_and_identity("lxmf.propagation", self.app.node.destination.identity))
             e_lxmf = urwid.Text(lxmf_addr_str, align=urwid.CENTER)
 
             announce_button = urwid.Button("Announce", on_press=announce_query)
             connect_button = urwid.Button("Browse", on_press=connect_query)
             reset_button = urwid.Button("Rst Stats", on_press=stats_query)
+            export_button = urwid.Button("Export Metrics", on_press=export_query)
 
             if not self.app.disable_propagation:
                 pile = urwid.Pile([
@@ -1477,6 +1620,7 @@ class NodeInfo(urwid.WidgetWrap):
                     self.t_total_connections,
                     self.t_total_pages,
                     self.t_total_files,
+                    self.t_metrics,
                     urwid.Divider(g["divider1"]),
                     urwid.Columns([
                         (urwid.WEIGHT, 5, urwid.Button("Back", on_press=show_peer_info)),
@@ -1486,7 +1630,8 @@ class NodeInfo(urwid.WidgetWrap):
                         (urwid.WEIGHT, 8, reset_button),
                         (urwid.WEIGHT, 0.5, urwid.Text("")),
                         (urwid.WEIGHT, 7, announce_button),
-                    ])
+                    ]),
+                    urwid.Padding(export_button, urwid.CENTER, urwid.PACK),
                 ])
             else:
                 pile = urwid.Pile([
@@ -1499,6 +1644,7 @@ class NodeInfo(urwid.WidgetWrap):
                 self.t_total_connections,
                 self.t_total_pages,
                 self.t_total_files,
+                self.t_metrics,
                 urwid.Divider(g["divider1"]),
                 urwid.Columns([
                     (urwid.WEIGHT, 5, urwid.Button("Back", on_press=show_peer_info)),
@@ -1508,7 +1654,8 @@ class NodeInfo(urwid.WidgetWrap):
                     (urwid.WEIGHT, 8, reset_button),
                     (urwid.WEIGHT, 0.5, urwid.Text("")),
                     (urwid.WEIGHT, 7, announce_button),
-                ])
+                ]),
+                urwid.Padding(export_button, urwid.CENTER, urwid.PACK),
             ])
         else:
             pile = urwid.Pile([
@@ -1528,6 +1675,7 @@ class NodeInfo(urwid.WidgetWrap):
             self.t_total_connections.start()
             self.t_total_pages.start()
             self.t_total_files.start()
+            self.t_metrics.start()
 
 
 class UpdatingText(urwid.WidgetWrap):
@@ -1570,15 +1718,29 @@ class NetworkStats(urwid.WidgetWrap):
         def get_num_peers():
             return self.app.directory.number_of_known_peers(lookback_seconds=30*60)
 
+        def get_num_peers_day():
+            return self.app.directory.number_of_known_peers(lookback_seconds=24*60*60)
+
+        def get_num_peers_week():
+            lookback_seconds = 7*24*60*60
+            num_peers = self.app.directory.number_of_known_peers(lookback_seconds=lookback_seconds)
+            if self.app.directory.peer_count_is_estimate(lookback_seconds):
+                return "~"+str(num_peers)
+            else:
+                return num_peers
 
         def get_num_nodes():
             return self.app.directory.number_of_known_nodes()
 
         self.w_heard_peers = UpdatingText(self.app, "Heard Peers: ", get_num_peers, append_text=" (30m)")
+        self.w_heard_peers_day = UpdatingText(self.app, "Heard Peers: ", get_num_peers_day, append_text=" (24h)")
+        self.w_heard_peers_week = UpdatingText(self.app, "Heard Peers: ", get_num_peers_week, append_text=" (7d)")
         self.w_known_nodes = UpdatingText(self.app, "Known Nodes: ", get_num_nodes)
 
         pile = urwid.Pile([
             self.w_heard_peers,
+            self.w_heard_peers_day,
+            self.w_heard_peers_week,
             self.w_known_nodes,
         ])
 
@@ -1588,6 +1750,8 @@ class NetworkStats(urwid.WidgetWrap):
 
     def start(self):
         self.w_heard_peers.start()
+        self.w_heard_peers_day.start()
+        self.w_heard_peers_week.start()
         self.w_known_nodes.start()
 
 class NetworkLeftPile(urwid.Pile):
@@ -1660,6 +1824,8 @@ class NetworkDisplay():
         self.shortcuts_display = NetworkDisplayShortcuts(self.app)
         self.widget = self.columns
 
+        self.app.ui_notifier.register("directory", self.directory_change_callback)
+
     def toggle_list(self):
         if self.list_display != 0:
             options = self.left_pile.options(height_type=urwid.WEIGHT, height_amount=1)
@@ -141,3 +141,14 @@ def sanitize_name(name):
     name = name.strip()
     
     return name
+
+# Returns a form of the name that is used to compare display
+# names, so that names which only differ in case, modifiers
+# or symbols are treated as the same name.
+def normalize_name(name):
+    if name is None: return None
+    return sanitize_name(strip_modifiers(name)).casefold()
+
+# Formats a dictionary of statistics counters for logging.
+def format_stats(stats):
+    return ", ".join(str(k)+" "+str(round(v, 3) if isinstance(v, float) else v) for k, v in stats.items())